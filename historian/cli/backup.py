@@ -1,7 +1,7 @@
 import click
-from .common import db_session, split_gossip
-import os
-from pyln.proto.primitives import varint_decode, varint_encode
+from .common import COMPRESSION, GossipFile, GossipWriter, db_session
+from common import iter_channel_updates
+from sqlalchemy import text
 
 
 @click.group()
@@ -12,49 +12,41 @@ def backup():
 @backup.command()
 @click.argument("destination", type=click.File("wb"))
 @click.option("--db", type=str, default=None)
-def create(destination, db):
+@click.option("--version", "gsp_version", type=click.Choice(["1", "2"]), default="1")
+@click.option(
+    "--compression",
+    type=click.Choice(list(COMPRESSION.keys())),
+    default="zstd",
+    help="Block compression, only used by version 2.",
+)
+def create(destination, db, gsp_version, compression):
     with db_session(db) as session:
-        rows = session.execute("SELECT raw FROM channel_announcements")
+        rows = session.execute(text("SELECT raw FROM channel_announcements"))
 
         # Write the header now that we know we'll be writing something.
-        destination.write(b"GSP\x01")
+        writer = GossipWriter(destination, int(gsp_version), compression)
 
         for r in rows:
-            varint_encode(len(r[0]), destination)
-            destination.write(r[0])
+            writer.write(bytes(r[0]))
 
-        rows = session.execute("SELECT raw FROM channel_updates ORDER BY timestamp ASC")
-        for r in rows:
-            varint_encode(len(r[0]), destination)
-            destination.write(r[0])
+        for raw in iter_channel_updates(session):
+            writer.write(raw)
 
         rows = session.execute(
-            "SELECT raw FROM node_announcements ORDER BY timestamp ASC"
+            text("SELECT raw FROM node_announcements ORDER BY timestamp ASC")
         )
         for r in rows:
-            varint_encode(len(r[0]), destination)
-            destination.write(r[0])
+            writer.write(bytes(r[0]))
 
-        destination.close()
+        writer.close()
 
 
 @backup.command()
-@click.argument("source", type=click.File("rb"))
+@click.argument("source", type=GossipFile(decode=False))
 def read(source):
     """Load gossip messages from the specified source and print it to stdout
 
     Prints the hex-encoded raw gossip message to stdout.
     """
-    header = source.read(4)
-    if len(header) < 4:
-        raise ValueError("Could not read header")
-
-    tag, version = header[0:3], header[3]
-    if tag != b"GSP":
-        raise ValueError(f"Header mismatch, expected GSP, got {repr(tag)}")
-
-    if version != 1:
-        raise ValueError(f"Unsupported version {version}, only support up to version 1")
-
-    for m in split_gossip(source):
+    for m in source:
         print(m.hex())
@@ -0,0 +1,382 @@
+import click
+import os
+import random
+import resource
+import struct
+import tempfile
+import time
+from sqlalchemy import create_engine, text
+from common import create_schema
+
+# Bitcoin mainnet genesis block hash, as it appears on the wire.
+CHAIN_HASH = bytes.fromhex(
+    "6fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000"
+)
+
+# gossip_store record flags, in the upper half of the first header word.
+DELETED = 0x8000
+DYING = 0x0800
+
+GOSSIP_STORE_CHANNEL_AMOUNT = 4101
+GOSSIP_STORE_CHAN_DYING = 4106
+
+DAY = 86400
+
+
+@click.group()
+def bench():
+    pass
+
+
+def channel_announcement(rng, scid, node_1, node_2) -> bytes:
+    return (
+        struct.pack("!H", 256)
+        + rng.randbytes(4 * 64)
+        + struct.pack("!H", 0)
+        + CHAIN_HASH
+        + struct.pack("!Q", scid)
+        + node_1
+        + node_2
+        + b"\x02"
+        + rng.randbytes(32)
+        + b"\x03"
+        + rng.randbytes(32)
+    )
+
+
+def channel_update(rng, scid, timestamp, direction, policy) -> bytes:
+    cltv, htlc_min, fee_base, fee_ppm, htlc_max, disabled = policy
+    return (
+        struct.pack("!H", 258)
+        + rng.randbytes(64)
+        + CHAIN_HASH
+        + struct.pack(
+            "!QIBBHQIIQ",
+            scid,
+            timestamp,
+            1,
+            direction | (2 if disabled else 0),
+            cltv,
+            htlc_min,
+            fee_base,
+            fee_ppm,
+            htlc_max,
+        )
+    )
+
+
+def random_policy(rng):
+    return (
+        rng.choice([6, 18, 34, 40, 72, 144]),
+        rng.choice([0, 1, 1000]),
+        rng.choice([0, 0, 1, 1000]),
+        rng.randrange(0, 2000),
+        rng.randrange(1, 2**24) * 1000,
+        rng.random() < 0.05,
+    )
+
+
+def addresses(rng, large) -> bytes:
+    """A few IPv4/IPv6/Tor addresses, or a lot of them if `large`."""
+    count = rng.randrange(10, 16) if large else rng.randrange(0, 4)
+    result = b""
+    for _ in range(count):
+        kind = rng.choice([1, 2, 4])
+        if kind == 1:
+            result += b"\x01" + rng.randbytes(4)
+        elif kind == 2:
+            result += b"\x02" + rng.randbytes(16)
+        else:
+            result += b"\x04" + rng.randbytes(35)
+        result += struct.pack("!H", 9735)
+    return result
+
+
+def node_announcement(rng, node_id, timestamp, large) -> bytes:
+    features = rng.randbytes(rng.randrange(60, 120) if large else 3)
+    addrs = addresses(rng, large)
+    return (
+        struct.pack("!H", 257)
+        + rng.randbytes(64)
+        + struct.pack("!H", len(features))
+        + features
+        + struct.pack("!I", timestamp)
+        + node_id
+        + rng.randbytes(3)
+        + rng.randbytes(rng.randrange(1, 32)).hex()[:32].encode().ljust(32, b"\x00")
+        + struct.pack("!H", len(addrs))
+        + addrs
+    )
+
+
+class StoreWriter:
+    """Appends records to a gossip_store file.
+
+    Like lightningd, marks a record as deleted once a newer message
+    for the same channel direction or node is appended, by rewriting
+    the flags in place.
+    """
+
+    def __init__(self, f, version):
+        self.f = f
+        self.version = version
+        self.records = 0
+        self.pending_flags = []
+        f.write(struct.pack("!B", version))
+
+    def write(self, msg: bytes, timestamp: int, flags=0) -> int:
+        offset = self.f.tell()
+        if self.version <= 3:
+            # Old stores wrap the gossip messages in their own types.
+            if msg[:2] in (b"\x01\x00", b"\x01\x02", b"\x01\x01"):
+                wrapper = 4096 + struct.unpack("!H", msg[:2])[0] - 256
+                msg = struct.pack("!HH", wrapper, len(msg)) + msg
+            header = struct.pack("!HHI", flags, len(msg), 0)
+        else:
+            # historian doesn't check the CRC.
+            header = struct.pack("!HHII", flags, len(msg), 0, timestamp)
+        self.f.write(header)
+        self.f.write(msg)
+        self.records += 1
+        return offset
+
+    def set_flag(self, offset: int, flag: int) -> None:
+        self.pending_flags.append((offset, flag))
+
+    def apply_flags(self) -> None:
+        """Rewrite the flags of earlier records, in file order."""
+        self.f.flush()
+        end = self.f.tell()
+        for offset, flag in sorted(self.pending_flags):
+            self.f.seek(offset)
+            (flags,) = struct.unpack("!H", self.f.read(2))
+            self.f.seek(offset)
+            self.f.write(struct.pack("!H", flags | flag))
+        self.f.seek(end)
+        self.pending_flags = []
+
+
+def generate(
+    f,
+    channels,
+    nodes,
+    rounds,
+    policy_changes=0.1,
+    node_updates=0.3,
+    large=0.01,
+    dying=0.01,
+    version=12,
+    seed=0,
+):
+    """Write a synthetic gossip_store with `channels` channels.
+
+    The store covers `rounds` days: on the first day all channels and
+    nodes are announced, and every following day each channel direction
+    sends an update, which changes its policy with probability
+    `policy_changes` and is a keep-alive otherwise, while each node
+    re-announces itself with probability `node_updates`. A fraction
+    `large` of nodes has long feature bits and address lists, and a
+    fraction `dying` of channels is marked as closing at the end.
+    """
+    rng = random.Random(seed)
+    writer = StoreWriter(f, version)
+    start = int(time.time()) - rounds * DAY
+
+    node_ids = sorted(b"\x02" + rng.randbytes(32) for _ in range(nodes))
+    large_nodes = set(rng.sample(range(nodes), int(nodes * large)))
+    chans = []
+    for i in range(channels):
+        a, b = sorted(rng.sample(range(nodes), 2))
+        scid = (700000 + i // 1000) << 40 | (i % 1000) << 16 | rng.randrange(2)
+        chans.append((scid, a, b, [random_policy(rng), random_policy(rng)]))
+
+    latest = {}
+
+    def supersede(key, offset):
+        if key in latest:
+            writer.set_flag(latest[key], DELETED)
+        latest[key] = offset
+
+    counts = {"channel_announcements": 0, "channel_updates": 0, "node_announcements": 0}
+    for r in range(rounds):
+        day = start + r * DAY
+        for scid, a, b, policies in chans:
+            if r == 0:
+                writer.write(
+                    channel_announcement(rng, scid, node_ids[a], node_ids[b]), day
+                )
+                writer.write(
+                    struct.pack(
+                        "!HQ", GOSSIP_STORE_CHANNEL_AMOUNT, rng.randrange(10**5, 10**8)
+                    ),
+                    day,
+                )
+                counts["channel_announcements"] += 1
+            for direction in (0, 1):
+                if r > 0 and rng.random() < policy_changes:
+                    policies[direction] = random_policy(rng)
+                ts = day + rng.randrange(DAY)
+                msg = channel_update(rng, scid, ts, direction, policies[direction])
+                supersede((scid, direction), writer.write(msg, ts))
+                counts["channel_updates"] += 1
+
+        for i, node_id in enumerate(node_ids):
+            if r > 0 and rng.random() >= node_updates:
+                continue
+            ts = day + rng.randrange(DAY)
+            msg = node_announcement(rng, node_id, ts, i in large_nodes)
+            supersede(node_id, writer.write(msg, ts))
+            counts["node_announcements"] += 1
+        writer.apply_flags()
+
+    end = start + rounds * DAY
+    for scid, _, _, _ in rng.sample(chans, int(channels * dying)):
+        for direction in (0, 1):
+            writer.set_flag(latest[(scid, direction)], DYING)
+        writer.write(
+            struct.pack("!HQI", GOSSIP_STORE_CHAN_DYING, scid, 700000 + rounds), end
+        )
+    writer.apply_flags()
+    counts["records"] = writer.records
+    return counts
+
+
+@bench.command("generate")
+@click.argument("destination", type=click.Path(dir_okay=False))
+@click.option("--channels", type=int, default=10000)
+@click.option("--nodes", type=int, default=None, help="Defaults to channels / 4.")
+@click.option("--days", type=int, default=14)
+@click.option(
+    "--large-fraction",
+    type=float,
+    default=0.01,
+    help="Fraction of nodes with large announcements.",
+)
+@click.option(
+    "--dying-fraction",
+    type=float,
+    default=0.01,
+    help="Fraction of channels marked as closing.",
+)
+@click.option("--store-version", type=click.IntRange(3, 15), default=12)
+@click.option("--seed", type=int, default=0)
+def generate_store(
+    destination,
+    channels,
+    nodes,
+    days,
+    large_fraction,
+    dying_fraction,
+    store_version,
+    seed,
+):
+    """Write a synthetic gossip_store to DESTINATION.
+
+    The same options and seed always produce the same messages, apart
+    from their timestamps, which end at the current time.
+    """
+    if nodes is None:
+        nodes = max(2, channels // 4)
+    with open(destination, "w+b") as f:
+        counts = generate(
+            f,
+            channels,
+            nodes,
+            days,
+            large=large_fraction,
+            dying=dying_fraction,
+            version=store_version,
+            seed=seed,
+        )
+    size = os.path.getsize(destination)
+    click.echo(
+        f"Wrote {counts['records']} records ({size / 2**20:.1f} MiB): "
+        f"{counts['channel_announcements']} channel_announcements, "
+        f"{counts['channel_updates']} channel_updates, "
+        f"{counts['node_announcements']} node_announcements",
+        err=True,
+    )
+
+
+def db_size(engine):
+    """Size of the database in bytes, if we know how to measure it."""
+    if engine.dialect.name == "sqlite" and engine.url.database:
+        return os.path.getsize(engine.url.database)
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            return conn.execute(
+                text("SELECT pg_database_size(current_database())")
+            ).scalar()
+    return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@bench.command()
+@click.argument("gossip_store", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--db",
+    "dsns",
+    type=str,
+    multiple=True,
+    help="Database to ingest into, may be repeated. Defaults to a fresh "
+    "sqlite database. Use empty databases, messages that are already "
+    "stored are skipped.",
+)
+@click.option(
+    "--dedup",
+    type=click.Choice(["off", "keep-signature", "drop-signature"]),
+    default="off",
+)
+@click.option("--interval", type=float, default=10, help="Seconds between commits.")
+def ingest(gossip_store, dsns, dedup, interval):
+    """Ingest GOSSIP_STORE the way the plugin does and report throughput.
+
+    Drives the plugin's FileTailer and Flusher over the whole file, and
+    reports messages per second, peak memory and the resulting
+    database size for each database.
+    """
+    # Imported here since the plugin pulls in its own dependencies.
+    import historian
+
+    tmpdir = None
+    if not dsns:
+        tmpdir = tempfile.TemporaryDirectory()
+        dsns = [f"sqlite:///{tmpdir.name}/bench.sqlite3"]
+
+    for dsn in dsns:
+        engine = create_engine(os.path.expandvars(dsn), echo=False)
+        create_schema(engine)
+        flusher = historian.Flusher(
+            engine, dedup, filename=gossip_store, interval=interval
+        )
+        flusher.RABBITMQ_URL = None
+        flusher.tailer = historian.FileTailer(gossip_store)
+
+        messages = 0
+
+        def counted(it):
+            nonlocal messages
+            for msg in it:
+                messages += 1
+                yield msg
+
+        started = time.time()
+        flusher.ingest(counted(flusher.tailer.resume()))
+        elapsed = time.time() - started
+
+        stored = sum(flusher.counters.counts.values())
+        size = db_size(engine)
+        size = f"{size / 2**20:.1f} MiB" if size is not None else "unknown"
+        click.echo(
+            f"{engine.url.render_as_string()}: {messages} messages, {stored} rows "
+            f"in {elapsed:.1f}s ({messages / elapsed:.0f} msgs/s), "
+            f"peak RSS {peak_rss() / 2**20:.0f} MiB, database {size}"
+        )
+        engine.dispose()
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
@@ -0,0 +1,38 @@
+import click
+import logging
+from .common import get_engine
+from ingest import Collector
+
+
+@click.group()
+def collector():
+    pass
+
+
+@collector.command()
+@click.argument("address", type=str)
+@click.option("--db", type=str, default=None)
+@click.option(
+    "--dedup",
+    type=click.Choice(["off", "keep-signature", "drop-signature"]),
+    default="off",
+    help="Same as the historian-dedup-updates plugin option.",
+)
+@click.option("--batch-size", type=int, default=1000)
+@click.option(
+    "--interval",
+    type=float,
+    default=1.0,
+    help="Maximum number of seconds to wait for a batch to fill up.",
+)
+def listen(address, db, dedup, batch_size, interval):
+    """Store messages forwarded by historian plugins in a single database.
+
+    ADDRESS is either host:port or the path of a UNIX socket. Plugins
+    forward their messages here when started with the
+    historian-forward option pointing at ADDRESS.
+    """
+    logging.basicConfig(level=logging.INFO)
+    engine = get_engine(db)
+    click.echo(f"Collecting gossip on {address}", err=True)
+    Collector(engine, dedup, batch_size, interval).serve(address)
@@ -2,24 +2,36 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from contextlib import contextmanager
 import os
-from common import Base
+from common import create_schema
 import io
-from pyln.proto.primitives import varint_decode
+from pyln.proto.primitives import varint_decode, varint_encode
 from gossipd import parse
+import bisect
 import click
 import bz2
+import gossipd
+import logging
+import shlex
+import struct
+import subprocess
 
 default_db = "sqlite:///$HOME/.lightning/bitcoin/historian.sqlite3"
 
 
-@contextmanager
-def db_session(dsn):
-    """Tiny contextmanager to facilitate sqlalchemy session management"""
+def get_engine(dsn):
+    """Create an engine for `dsn` and make sure the schema exists."""
     if dsn is None:
         dsn = default_db
     dsn = os.path.expandvars(dsn)
     engine = create_engine(dsn, echo=False)
-    Base.metadata.create_all(engine)
+    create_schema(engine)
+    return engine
+
+
+@contextmanager
+def db_session(dsn):
+    """Tiny contextmanager to facilitate sqlalchemy session management"""
+    engine = get_engine(dsn)
     session_maker = sessionmaker(bind=engine)
     session = session_maker()
     try:
@@ -45,23 +57,213 @@ def split_gossip(reader: io.BytesIO):
         yield msg
 
 
+# GSP v2 files start with a fixed header: the magic, the block
+# compression, the time range and message counts of the file, and the
+# offset of the trailing index.
+HEADER_V2 = struct.Struct("!4sB3xQQQQQQ")
+# Each block is prefixed with its compressed and uncompressed size.
+BLOCK_HEADER = struct.Struct("!II")
+# The index lists the blocks that contain messages for each scid and
+# node_id, sorted so they can be binary searched.
+INDEX_HEADER = struct.Struct("!II")
+SCID_ENTRY = struct.Struct("!QQ")
+NODE_ENTRY = struct.Struct("!33sQ")
+
+COMPRESSION = {"none": 0, "zstd": 1}
+
+
+def zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise click.ClickException(
+            "zstandard is required for compressed GSP v2 files, please install it"
+        )
+    return zstandard
+
+
+def message_keys(msg):
+    """Extract the (scid, node_id, timestamp) a raw message is indexed by."""
+    m = parse(msg)
+    if isinstance(m, gossipd.ChannelAnnouncement):
+        return m.num_short_channel_id, None, None
+    if isinstance(m, gossipd.ChannelUpdate):
+        return m.num_short_channel_id, None, m.timestamp
+    if isinstance(m, gossipd.NodeAnnouncement):
+        return None, m.node_id, m.timestamp
+    return None, None, None
+
+
+class GossipWriter:
+    """Writes gossip messages into a GSP file.
+
+    Version 1 files are a plain stream of length-prefixed messages.
+    Version 2 files group the messages into (optionally zstd
+    compressed) blocks, followed by an index mapping each scid and
+    node_id to the blocks containing its messages. The header is
+    filled in on `close`, so version 2 needs a seekable destination.
+    """
+
+    def __init__(self, stream, version=1, compression="zstd", block_size=2**20):
+        if version not in (1, 2):
+            raise ValueError(f"Unsupported version {version}")
+        self.stream = stream
+        self.version = version
+        self.block_size = block_size
+        self.counts = {256: 0, 257: 0, 258: 0}
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+        if version == 1:
+            self.stream.write(b"GSP\x01")
+            return
+
+        if not self.stream.seekable():
+            raise ValueError("GSP v2 files need to be written to a seekable file")
+        self.compression = COMPRESSION[compression]
+        self.compressor = None
+        if self.compression == COMPRESSION["zstd"]:
+            self.compressor = zstandard().ZstdCompressor()
+        self.block = io.BytesIO()
+        self.block_scids, self.block_nodes = set(), set()
+        self.scid_index, self.node_index = [], []
+        self.stream.write(HEADER_V2.pack(b"GSP\x02", self.compression, *[0] * 6))
+
+    def write(self, msg: bytes) -> None:
+        (typ,) = struct.unpack_from("!H", msg)
+        if typ in self.counts:
+            self.counts[typ] += 1
+
+        if self.version == 1:
+            varint_encode(len(msg), self.stream)
+            self.stream.write(msg)
+            return
+
+        scid, node_id, timestamp = message_keys(msg)
+        if scid is not None:
+            self.block_scids.add(scid)
+        if node_id is not None:
+            self.block_nodes.add(node_id)
+        if timestamp is not None:
+            if self.first_timestamp is None or timestamp < self.first_timestamp:
+                self.first_timestamp = timestamp
+            if self.last_timestamp is None or timestamp > self.last_timestamp:
+                self.last_timestamp = timestamp
+
+        varint_encode(len(msg), self.block)
+        self.block.write(msg)
+        if self.block.tell() >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self) -> None:
+        data = self.block.getvalue()
+        if not data:
+            return
+        offset = self.stream.tell()
+        if self.compressor is not None:
+            payload = self.compressor.compress(data)
+        else:
+            payload = data
+        self.stream.write(BLOCK_HEADER.pack(len(payload), len(data)))
+        self.stream.write(payload)
+
+        self.scid_index.extend((scid, offset) for scid in self.block_scids)
+        self.node_index.extend((node_id, offset) for node_id in self.block_nodes)
+        self.block = io.BytesIO()
+        self.block_scids, self.block_nodes = set(), set()
+
+    def close(self) -> None:
+        if self.version == 2:
+            self.flush_block()
+            index_offset = self.stream.tell()
+            self.scid_index.sort()
+            self.node_index.sort()
+            self.stream.write(
+                INDEX_HEADER.pack(len(self.scid_index), len(self.node_index))
+            )
+            for e in self.scid_index:
+                self.stream.write(SCID_ENTRY.pack(*e))
+            for e in self.node_index:
+                self.stream.write(NODE_ENTRY.pack(*e))
+
+            self.stream.seek(0)
+            self.stream.write(
+                HEADER_V2.pack(
+                    b"GSP\x02",
+                    self.compression,
+                    self.first_timestamp or 0,
+                    self.last_timestamp or 0,
+                    self.counts[256],
+                    self.counts[258],
+                    self.counts[257],
+                    index_offset,
+                )
+            )
+            self.stream.seek(0, io.SEEK_END)
+        self.stream.close()
+
+
 class GossipStream:
+    """Iterates over the messages in a GSP file.
+
+    Supports version 1 and version 2 files. Version 2 files also allow
+    looking up the messages of a single channel or node through their
+    index without scanning the whole file.
+    """
+
     def __init__(self, file_stream, filename, decode=True):
         self.stream = file_stream
         self.decode = decode
         self.filename = filename
+        self.metadata = None
+        self._index = None
 
         # Read header
         header = self.stream.read(4)
-        assert len(header) == 4
-        assert header[:3] == b"GSP"
-        assert header[3] == 1
+        if len(header) < 4:
+            raise ValueError("Could not read header")
+        if header[:3] != b"GSP":
+            raise ValueError(f"Header mismatch, expected GSP, got {repr(header[:3])}")
+        self.version = header[3]
+
+        if self.version == 1:
+            self._messages = self._iter_v1()
+        elif self.version == 2:
+            rest = self.stream.read(HEADER_V2.size - 4)
+            (
+                _,
+                compression,
+                first_timestamp,
+                last_timestamp,
+                channel_announcements,
+                channel_updates,
+                node_announcements,
+                self.index_offset,
+            ) = HEADER_V2.unpack(header + rest)
+            self.metadata = {
+                "version": 2,
+                "compression": {v: k for k, v in COMPRESSION.items()}[compression],
+                "first_timestamp": first_timestamp,
+                "last_timestamp": last_timestamp,
+                "channel_announcements": channel_announcements,
+                "channel_updates": channel_updates,
+                "node_announcements": node_announcements,
+            }
+            self.decompressor = None
+            if compression == COMPRESSION["zstd"]:
+                self.decompressor = zstandard().ZstdDecompressor()
+            self._messages = self._iter_v2()
+        else:
+            raise ValueError(
+                f"Unsupported version {self.version}, only support up to version 2"
+            )
 
     def seek(self, offset):
         """Allow skipping to a specific point in the stream.
 
         The offset is denoted in bytes from the start, including the
-        header, and matches the value of f.tell()
+        header, and matches the value of f.tell(). For version 2 files
+        the offset must be the start of a block.
         """
         self.stream.seek(offset, io.SEEK_SET)
 
@@ -76,24 +278,109 @@ class GossipStream:
         return self
 
     def __next__(self):
-        pos = self.stream.tell()
-        length = varint_decode(self.stream)
-
-        if length is None:
-            raise StopIteration
-
-        msg = self.stream.read(length)
-        if len(msg) != length:
-            raise ValueError(
-                "Error reading snapshot at {pos}: incomplete read of {length} bytes, only got {lmsg} bytes".format(
-                    pos=pos, length=length, lmsg=len(msg)
-                )
-            )
+        msg = next(self._messages)
         if not self.decode:
             return msg
 
         return parse(msg)
 
+    def _iter_v1(self):
+        while True:
+            pos = self.stream.tell()
+            length = varint_decode(self.stream)
+
+            if length is None:
+                return
+
+            msg = self.stream.read(length)
+            if len(msg) != length:
+                raise ValueError(
+                    "Error reading snapshot at {pos}: incomplete read of {length} bytes, only got {lmsg} bytes".format(
+                        pos=pos, length=length, lmsg=len(msg)
+                    )
+                )
+            yield msg
+
+    def _read_block(self, offset):
+        self.stream.seek(offset, io.SEEK_SET)
+        header = self.stream.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            raise ValueError(f"Error reading block header at {offset}")
+        length, raw_length = BLOCK_HEADER.unpack(header)
+        payload = self.stream.read(length)
+        if len(payload) != length:
+            raise ValueError(f"Error reading block at {offset}: incomplete read")
+        if self.decompressor is not None:
+            payload = self.decompressor.decompress(payload, max_output_size=raw_length)
+        return payload
+
+    def _iter_v2(self):
+        while self.stream.tell() < self.index_offset:
+            block = self._read_block(self.stream.tell())
+            pos = self.stream.tell()
+            yield from split_gossip(io.BytesIO(block))
+            # Callers may have used the stream in between.
+            self.stream.seek(pos, io.SEEK_SET)
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        self.stream.seek(self.index_offset, io.SEEK_SET)
+        nscids, nnodes = INDEX_HEADER.unpack(self.stream.read(INDEX_HEADER.size))
+        scids = list(SCID_ENTRY.iter_unpack(self.stream.read(nscids * SCID_ENTRY.size)))
+        nodes = list(NODE_ENTRY.iter_unpack(self.stream.read(nnodes * NODE_ENTRY.size)))
+        self._index = (scids, nodes)
+        return self._index
+
+    def _lookup(self, entries, key, match):
+        if self.version == 1:
+            # No index, so we have to scan the whole file.
+            self.stream.seek(4, io.SEEK_SET)
+            blocks = [self._iter_v1()]
+        else:
+            i = bisect.bisect_left(entries, (key,))
+            offsets = []
+            while i < len(entries) and entries[i][0] == key:
+                offsets.append(entries[i][1])
+                i += 1
+            blocks = (split_gossip(io.BytesIO(self._read_block(o))) for o in offsets)
+
+        found = [m for b in blocks for m in b if match(m)]
+        return found if not self.decode else [parse(m) for m in found]
+
+    def find_channel(self, scid: int):
+        """Return the announcement and updates for the channel `scid`."""
+        scids = self._load_index()[0] if self.version == 2 else None
+        return self._lookup(scids, scid, lambda m: message_keys(m)[0] == scid)
+
+    def find_node(self, node_id: bytes):
+        """Return the node_announcements of `node_id`."""
+        nodes = self._load_index()[1] if self.version == 2 else None
+        return self._lookup(nodes, node_id, lambda m: message_keys(m)[1] == node_id)
+
+
+def write_part(fname, msgs, version, compression, compress, exec):
+    """Write a single part of a split snapshot and run its exec hook.
+
+    Runs in a worker process, so it must only use picklable arguments.
+    """
+    if compress == "bz2":
+        f = bz2.open(fname, "wb")
+    elif compress == "zst":
+        f = zstandard().open(fname, "wb")
+    else:
+        f = open(fname, "wb")
+    writer = GossipWriter(f, version, compression)
+    for m in msgs:
+        writer.write(m)
+    writer.close()
+
+    if exec is not None:
+        cmd = shlex.split(exec.replace("{}", shlex.quote(fname)))
+        logging.debug("Exec:\n> {}".format(" ".join(cmd)))
+        subprocess.run(cmd)
+    return fname
+
 
 class GossipFile(click.File):
     def __init__(self, decode=True):
@@ -101,5 +388,10 @@ class GossipFile(click.File):
         self.decode = decode
 
     def convert(self, value, param, ctx):
-        f = bz2.open(value, "rb") if value.endswith(".bz2") else open(value, "rb")
+        if value.endswith(".bz2"):
+            f = bz2.open(value, "rb")
+        elif value.endswith(".zst"):
+            f = zstandard().open(value, "rb")
+        else:
+            f = open(value, "rb")
         return GossipStream(f, value, self.decode)
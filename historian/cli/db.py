@@ -1,8 +1,18 @@
 import click
-from common import NodeAnnouncement, ChannelAnnouncement, ChannelUpdate
+from common import Base, ChannelLatest, Counters
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
 from tqdm import tqdm
-from gossipd import parse
-from cli.common import db_session, default_db
+from cli.common import db_session, default_db, get_engine
+
+# The column each table is split on when merging in parallel.
+merge_keys = {
+    "channel_announcements": "scid",
+    "channel_updates": "scid",
+    "channel_update_refreshes": "scid",
+    "node_announcements": "timestamp",
+}
 
 
 @click.group()
@@ -10,50 +20,98 @@ def db():
     pass
 
 
+def insert_ignore(engine, table):
+    """An INSERT that skips rows whose primary key already exists."""
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with("IGNORE")
+
+
+def key_ranges(lo, hi, parts):
+    """Split the closed interval [lo, hi] into `parts` half-open ranges.
+
+    The last range is closed so `hi` itself is included.
+    """
+    if lo == hi or parts <= 1:
+        return [(lo, hi, True)]
+    step = (hi - lo) / parts
+    bounds = [lo] + [lo + step * i for i in range(1, parts)] + [hi]
+    if isinstance(lo, int):
+        bounds = [int(b) for b in bounds]
+    return [
+        (bounds[i], bounds[i + 1], i == parts - 1)
+        for i in range(parts)
+        if bounds[i] < bounds[i + 1] or i == parts - 1
+    ]
+
+
+def merge_range(source, destination, table_name, lo, hi, inclusive, batch_size):
+    """Copy the rows of one key range of a table from source to destination.
+
+    Rows are copied verbatim, including their primary key, without
+    parsing the messages. Returns the number of rows read.
+    """
+    table = Base.metadata.tables[table_name]
+    key = table.c[merge_keys[table_name]]
+    query = select(table).where(key >= lo, key <= hi if inclusive else key < hi)
+
+    src, dst = get_engine(source), get_engine(destination)
+    stmt = insert_ignore(dst, table)
+    count = 0
+    try:
+        with src.connect() as sconn, dst.connect() as dconn:
+            result = sconn.execution_options(yield_per=batch_size).execute(query)
+            for part in result.partitions():
+                dconn.execute(stmt, [dict(r._mapping) for r in part])
+                dconn.commit()
+                count += len(part)
+    finally:
+        src.dispose()
+        dst.dispose()
+    return count
+
+
 @db.command()
 @click.argument("source", type=str)
 @click.argument("destination", type=str, default=default_db)
-def merge(source, destination):
+@click.option("--batch-size", type=int, default=10000)
+@click.option(
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of worker processes, each merging one key range of a table.",
+)
+def merge(source, destination, batch_size, jobs):
     """Merge two historian databases by copying from source to destination."""
+    if jobs > 1 and get_engine(destination).dialect.name == "sqlite":
+        click.echo("SQLite only supports a single writer, using --jobs=1", err=True)
+        jobs = 1
+
+    work, total = [], 0
+    with db_session(source) as session:
+        for table_name, key in merge_keys.items():
+            table = Base.metadata.tables[table_name]
+            count, lo, hi = session.execute(
+                select(func.count(), func.min(table.c[key]), func.max(table.c[key]))
+            ).one()
+            if count == 0:
+                continue
+            total += count
+            for r in key_ranges(lo, hi, jobs):
+                work.append((table_name, *r))
+
+    # Not strictly necessary, but I like progress indicators and ETAs.
+    with tqdm(total=total) as progress, ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(merge_range, source, destination, *w, batch_size)
+            for w in work
+        ]
+        for f in as_completed(futures):
+            progress.update(f.result())
 
-    meta = {
-        "channel_announcements": None,
-        "channel_updates": None,
-        "node_announcements": None,
-    }
-
-    with db_session(source) as source, db_session(destination) as target:
-        # Not strictly necessary, but I like progress indicators and ETAs.
-        for table in meta.keys():
-            rows = source.execute(f"SELECT count(*) FROM {table}")
-            (count,) = rows.fetchone()
-            meta[table] = count
-
-        for (r,) in tqdm(
-            source.execute("SELECT raw FROM channel_announcements"),
-            total=meta["channel_announcements"],
-        ):
-            msg = parse(r)
-            if isinstance(r, memoryview):
-                r = bytes(r)
-            target.merge(ChannelAnnouncement.from_gossip(msg, r))
-
-        for (r,) in tqdm(
-            source.execute("SELECT raw FROM channel_updates ORDER BY timestamp ASC"),
-            total=meta["channel_updates"],
-        ):
-            msg = parse(r)
-            if isinstance(r, memoryview):
-                r = bytes(r)
-            target.merge(ChannelUpdate.from_gossip(msg, r))
-
-        for (r,) in tqdm(
-            source.execute("SELECT raw FROM node_announcements ORDER BY timestamp ASC"),
-            total=meta["node_announcements"],
-        ):
-            msg = parse(r)
-            if isinstance(r, memoryview):
-                r = bytes(r)
-            target.merge(NodeAnnouncement.from_gossip(msg, r))
-
-        target.commit()
+    # Bulk inserts bypass the bookkeeping done during ingestion.
+    with db_session(destination) as target:
+        ChannelLatest.rebuild(target)
+        Counters.rebuild(target)
@@ -0,0 +1,267 @@
+import click
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from sqlalchemy import text
+from .common import db_session
+from common import iter_channel_updates
+import gossipd
+
+
+@click.group()
+def export():
+    pass
+
+
+def decode_channel_updates(rows):
+    cols = gossipd.parse_channel_updates(rows)
+    return {
+        "scid": cols["scid"],
+        "timestamp": cols["timestamp"],
+        "direction": cols["direction"],
+        "message_flags": cols["message_flags"],
+        "channel_flags": cols["channel_flags"],
+        "cltv_expiry_delta": cols["cltv_expiry_delta"],
+        "htlc_minimum_msat": cols["htlc_minimum_msat"],
+        "fee_base_msat": cols["fee_base_msat"],
+        "fee_proportional_millionths": cols["fee_proportional_millionths"],
+        "htlc_maximum_msat": cols["htlc_maximum_msat"],
+    }
+
+
+def decode_channel_announcements(rows):
+    cols = {
+        "scid": [],
+        "features": [],
+        "node_id_1": [],
+        "node_id_2": [],
+        "bitcoin_key_1": [],
+        "bitcoin_key_2": [],
+    }
+    for raw in rows:
+        ca = gossipd.parse(raw)
+        cols["scid"].append(ca.num_short_channel_id)
+        cols["features"].append(ca.features)
+        cols["node_id_1"].append(ca.node_ids[0])
+        cols["node_id_2"].append(ca.node_ids[1])
+        cols["bitcoin_key_1"].append(ca.bitcoin_keys[0])
+        cols["bitcoin_key_2"].append(ca.bitcoin_keys[1])
+    return cols
+
+
+def decode_node_announcements(rows):
+    cols = {
+        "node_id": [],
+        "timestamp": [],
+        "features": [],
+        "rgb_color": [],
+        "alias": [],
+        "addresses": [],
+    }
+    for raw in rows:
+        na = gossipd.parse(raw)
+        cols["node_id"].append(na.node_id)
+        cols["timestamp"].append(na.timestamp)
+        cols["features"].append(na.features)
+        cols["rgb_color"].append(na.rgb_color)
+        cols["alias"].append(na.alias.rstrip(b"\x00").decode("utf-8", "replace"))
+        cols["addresses"].append([str(a) for a in na.addresses])
+    return cols
+
+
+def schemas(pa):
+    ts = pa.timestamp("s", tz="UTC")
+    return {
+        "channel_updates": pa.schema(
+            [
+                ("scid", pa.uint64()),
+                ("timestamp", ts),
+                ("direction", pa.uint8()),
+                ("message_flags", pa.uint8()),
+                ("channel_flags", pa.uint8()),
+                ("cltv_expiry_delta", pa.uint16()),
+                ("htlc_minimum_msat", pa.uint64()),
+                ("fee_base_msat", pa.uint32()),
+                ("fee_proportional_millionths", pa.uint32()),
+                ("htlc_maximum_msat", pa.uint64()),
+            ]
+        ),
+        "channel_announcements": pa.schema(
+            [
+                ("scid", pa.uint64()),
+                ("features", pa.binary()),
+                ("node_id_1", pa.binary(33)),
+                ("node_id_2", pa.binary(33)),
+                ("bitcoin_key_1", pa.binary(33)),
+                ("bitcoin_key_2", pa.binary(33)),
+            ]
+        ),
+        "node_announcements": pa.schema(
+            [
+                ("node_id", pa.binary(33)),
+                ("timestamp", ts),
+                ("features", pa.binary()),
+                ("rgb_color", pa.binary(3)),
+                ("alias", pa.string()),
+                ("addresses", pa.list_(pa.string())),
+            ]
+        ),
+    }
+
+
+def bounded_map(executor, fn, iterable, window):
+    """Like `executor.map` but with at most `window` batches in flight.
+
+    `Executor.map` submits the whole iterable upfront, which would
+    read the entire table into memory.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def day_of(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+
+class PartitionedWriter:
+    """Writes batches into one parquet file per day.
+
+    Batches are expected in timestamp order, so only a single file is
+    open at any time. Without a timestamp column all batches go into a
+    single unpartitioned file.
+    """
+
+    def __init__(self, pq, directory, schema, partitioned):
+        self.pq = pq
+        self.directory = directory
+        self.schema = schema
+        self.partitioned = partitioned
+        self.day = None
+        self.writer = None
+        self.rows = 0
+
+    def open(self, day):
+        self.close()
+        if day is None:
+            path = self.directory
+        else:
+            path = os.path.join(self.directory, f"date={day}")
+        os.makedirs(path, exist_ok=True)
+        self.writer = self.pq.ParquetWriter(
+            os.path.join(path, "part-0000.parquet"), self.schema
+        )
+        self.day = day
+
+    def write(self, pa, cols):
+        if not self.partitioned:
+            if self.writer is None:
+                self.open(None)
+            self._write(pa, cols)
+            return
+
+        # Split the batch wherever the day changes.
+        days = [day_of(ts) for ts in cols["timestamp"]]
+        start = 0
+        for i in range(1, len(days) + 1):
+            if i < len(days) and days[i] == days[start]:
+                continue
+            if days[start] != self.day:
+                self.open(days[start])
+            self._write(pa, {k: v[start:i] for k, v in cols.items()})
+            start = i
+
+    def _write(self, pa, cols):
+        self.writer.write_table(pa.table(cols, schema=self.schema))
+        self.rows += len(next(iter(cols.values())))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+@export.command()
+@click.argument("destination", type=click.Path(file_okay=False))
+@click.option("--db", type=str, default=None)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=65536,
+    help="Rows per batch, which is also the parquet row-group size.",
+)
+@click.option(
+    "--jobs", type=int, default=os.cpu_count(), help="Number of decoding processes."
+)
+def parquet(destination, db, batch_size, jobs):
+    """Export the gossip tables as decoded, typed parquet files.
+
+    Each table is written to its own directory below DESTINATION, with
+    channel_updates and node_announcements partitioned by day.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.ClickException(
+            "pyarrow is required for parquet exports, please install it"
+        )
+
+    def query_batches(session, query):
+        result = session.execute(
+            text(query), execution_options={"yield_per": batch_size}
+        )
+        return ([bytes(r) for (r,) in part] for part in result.partitions())
+
+    def update_batches(session):
+        # Includes the keep-alives stored as deduplicated refreshes.
+        updates = iter_channel_updates(session, unsigned=True)
+        return iter(lambda: list(islice(updates, batch_size)), [])
+
+    tables = [
+        (
+            "channel_announcements",
+            lambda session: query_batches(
+                session, "SELECT raw FROM channel_announcements ORDER BY scid"
+            ),
+            decode_channel_announcements,
+            False,
+        ),
+        (
+            "channel_updates",
+            update_batches,
+            decode_channel_updates,
+            True,
+        ),
+        (
+            "node_announcements",
+            lambda session: query_batches(
+                session, "SELECT raw FROM node_announcements ORDER BY timestamp"
+            ),
+            decode_node_announcements,
+            True,
+        ),
+    ]
+    table_schemas = schemas(pa)
+
+    with db_session(db) as session, ProcessPoolExecutor(jobs) as executor:
+        for table, read_batches, decode, partitioned in tables:
+            batches = read_batches(session)
+            writer = PartitionedWriter(
+                pq,
+                os.path.join(destination, table),
+                table_schemas[table],
+                partitioned,
+            )
+            try:
+                for cols in bounded_map(executor, decode, batches, 2 * jobs):
+                    writer.write(pa, cols)
+            finally:
+                writer.close()
+            click.echo(f"Exported {writer.rows} rows from {table}", err=True)
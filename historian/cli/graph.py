@@ -0,0 +1,34 @@
+import click
+import json
+from .common import db_session
+from graph import graph_at
+
+
+@click.group()
+def graph():
+    pass
+
+
+@graph.command()
+@click.argument("when", type=click.DateTime(formats=["%Y-%m-%d %H:%M:%S"]))
+@click.argument("destination", type=click.File("wb"), default="-")
+@click.option("--db", type=str, default=None)
+@click.option("--format", "fmt", type=click.Choice(["json", "gsp"]), default="json")
+def at(when, destination, db, fmt):
+    """Rebuild the channel graph as it was at WHEN.
+
+    Writes the channels and nodes as JSON, or as a GSP snapshot that
+    can be loaded into a node with `snapshot load`.
+    """
+    with db_session(db) as session:
+        g = graph_at(session, when)
+
+    if fmt == "gsp":
+        destination.write(g.to_gsp())
+    else:
+        destination.write(json.dumps(g.to_json()).encode("utf-8"))
+        destination.write(b"\n")
+    click.echo(
+        f"Graph at {when} has {len(g.channels)} channels and {len(g.nodes)} nodes",
+        err=True,
+    )
@@ -1,12 +1,16 @@
 from binascii import hexlify
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, BigInteger, SmallInteger, DateTime, LargeBinary
+from sqlalchemy import Column, BigInteger, Boolean, SmallInteger, DateTime, LargeBinary
+from sqlalchemy import Index, String, bindparam, func, inspect, text, update
 import gossipd
 from contextlib import contextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from threading import Lock
+import heapq
 import os
+import struct
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,6 +22,13 @@ default_db = os.environ.get(
 )
 
 
+def signed64(value):
+    """`value` if it fits a BigInteger column, None otherwise."""
+    if value is None or value >= 2**63:
+        return None
+    return value
+
+
 class ChannelUpdate(Base):
     __tablename__ = "channel_updates"
     scid = Column(BigInteger, primary_key=True)
@@ -25,6 +36,35 @@ class ChannelUpdate(Base):
     timestamp = Column(DateTime, primary_key=True)
     raw = Column(LargeBinary)
 
+    # Policy fields extracted from `raw` at ingestion time, NULL for
+    # rows stored before they were added, and for amounts that don't
+    # fit a signed 64 bit column.
+    message_flags = Column(SmallInteger)
+    channel_flags = Column(SmallInteger)
+    cltv_expiry_delta = Column(BigInteger)
+    htlc_minimum_msat = Column(BigInteger)
+    fee_base_msat = Column(BigInteger)
+    fee_proportional_millionths = Column(BigInteger)
+    htlc_maximum_msat = Column(BigInteger)
+
+    __table_args__ = (
+        Index("ix_channel_updates_timestamp", "timestamp"),
+        # Covers policy history queries, so they don't touch `raw`.
+        Index(
+            "ix_channel_updates_history",
+            "scid",
+            "timestamp",
+            "direction",
+            "message_flags",
+            "channel_flags",
+            "cltv_expiry_delta",
+            "htlc_minimum_msat",
+            "fee_base_msat",
+            "fee_proportional_millionths",
+            "htlc_maximum_msat",
+        ),
+    )
+
     @classmethod
     def from_gossip(cls, gcu: gossipd.ChannelUpdate, raw: bytes) -> "ChannelUpdate":
         assert raw[:2] == b"\x01\x02"
@@ -33,6 +73,13 @@ class ChannelUpdate(Base):
         self.timestamp = datetime.fromtimestamp(gcu.timestamp)
         self.direction = gcu.direction
         self.raw = raw
+        self.message_flags = gcu.message_flags[0]
+        self.channel_flags = gcu.channel_flags[0]
+        self.cltv_expiry_delta = gcu.cltv_expiry_delta
+        self.htlc_minimum_msat = signed64(gcu.htlc_minimum_msat)
+        self.fee_base_msat = gcu.fee_base_msat
+        self.fee_proportional_millionths = gcu.fee_proportional_millionths
+        self.htlc_maximum_msat = signed64(gcu.htlc_maximum_msat)
         return self
 
     def to_json(self):
@@ -47,6 +94,171 @@ class ChannelUpdate(Base):
         }
 
 
+class ChannelLatest(Base):
+    """The most recent `channel_update` for each channel direction.
+
+    Maintained during ingestion so that snapshots don't have to search
+    `channel_updates` for the latest entry of every channel.
+    """
+
+    __tablename__ = "channel_latest"
+    scid = Column(BigInteger, primary_key=True)
+    direction = Column(SmallInteger, primary_key=True)
+    timestamp = Column(DateTime, nullable=False)
+    raw = Column(LargeBinary)
+
+    __table_args__ = (Index("ix_channel_latest_timestamp", "timestamp"),)
+
+    @classmethod
+    def track(cls, session, update: ChannelUpdate) -> None:
+        """Record `update` as the latest one for its direction if it is newer."""
+        latest = session.get(cls, (update.scid, update.direction))
+        if latest is None:
+            session.add(
+                cls(
+                    scid=update.scid,
+                    direction=update.direction,
+                    timestamp=update.timestamp,
+                    raw=update.raw,
+                )
+            )
+        elif latest.timestamp < update.timestamp:
+            latest.timestamp = update.timestamp
+            latest.raw = update.raw
+
+    @classmethod
+    def rebuild(cls, session) -> None:
+        """Recompute the table from `channel_updates`.
+
+        Used to backfill databases created before the table existed,
+        and after bulk imports that bypass `track`.
+        """
+        session.execute(text("DELETE FROM channel_latest"))
+        session.execute(
+            text(
+                """
+INSERT INTO channel_latest (scid, direction, timestamp, raw)
+SELECT
+  u.scid,
+  u.direction,
+  u.timestamp,
+  u.raw
+FROM
+  channel_updates u
+JOIN (
+  SELECT
+    scid,
+    direction,
+    MAX(timestamp) AS timestamp
+  FROM
+    channel_updates
+  GROUP BY
+    scid,
+    direction
+) m ON
+  u.scid = m.scid AND
+  u.direction = m.direction AND
+  u.timestamp = m.timestamp
+"""
+            )
+        )
+
+        # Deduplicated refreshes may be newer than the latest policy.
+        rows = session.execute(
+            text(
+                """
+SELECT
+  r.scid,
+  r.direction,
+  r.timestamp,
+  r.signature,
+  l.raw
+FROM
+  channel_update_refreshes r
+JOIN (
+  SELECT
+    scid,
+    direction,
+    MAX(timestamp) AS timestamp
+  FROM
+    channel_update_refreshes
+  GROUP BY
+    scid,
+    direction
+) m ON
+  r.scid = m.scid AND
+  r.direction = m.direction AND
+  r.timestamp = m.timestamp
+JOIN
+  channel_latest l ON l.scid = r.scid AND l.direction = r.direction
+WHERE
+  r.timestamp > l.timestamp
+"""
+            ).columns(timestamp=DateTime)
+        )
+        for scid, direction, timestamp, signature, raw in rows.all():
+            if signature is not None:
+                raw = reconstruct_update(bytes(raw), timestamp, bytes(signature))
+            session.execute(
+                update(cls)
+                .where(cls.scid == scid, cls.direction == direction)
+                .values(timestamp=timestamp, raw=raw)
+            )
+
+
+class ChannelUpdateRefresh(Base):
+    """A `channel_update` that only refreshed the previous policy.
+
+    Keep-alive updates differ from the previous update of the same
+    direction only in their timestamp and signature. When
+    deduplication is enabled they are stored here instead of in
+    `channel_updates`, which keeps the full message of every policy
+    change. The signature is optional, without it the original message
+    cannot be reconstructed.
+    """
+
+    __tablename__ = "channel_update_refreshes"
+    scid = Column(BigInteger, primary_key=True)
+    direction = Column(SmallInteger, primary_key=True)
+    timestamp = Column(DateTime, primary_key=True)
+    signature = Column(LargeBinary)
+
+    @staticmethod
+    def same_policy(a: bytes, b: bytes) -> bool:
+        """Whether two raw updates only differ in signature and timestamp."""
+        return a[66:106] == b[66:106] and a[110:] == b[110:]
+
+    @classmethod
+    def from_update(
+        cls, update: ChannelUpdate, keep_signature=True
+    ) -> "ChannelUpdateRefresh":
+        self = ChannelUpdateRefresh()
+        self.scid = update.scid
+        self.direction = update.direction
+        self.timestamp = update.timestamp
+        self.signature = bytes(update.raw[2:66]) if keep_signature else None
+        return self
+
+    def reconstruct(self, policy_raw: bytes):
+        """Rebuild the original message from the update holding its policy.
+
+        Returns `None` if the signature was not stored.
+        """
+        if self.signature is None:
+            return None
+        return reconstruct_update(policy_raw, self.timestamp, self.signature)
+
+
+def reconstruct_update(policy_raw: bytes, timestamp: datetime, signature: bytes):
+    return (
+        policy_raw[:2]
+        + signature
+        + policy_raw[66:106]
+        + struct.pack("!I", int(timestamp.timestamp()))
+        + policy_raw[110:]
+    )
+
+
 class ChannelAnnouncement(Base):
     __tablename__ = "channel_announcements"
     scid = Column(BigInteger, primary_key=True)
@@ -78,6 +290,8 @@ class NodeAnnouncement(Base):
     timestamp = Column(DateTime, primary_key=True)
     raw = Column(LargeBinary)
 
+    __table_args__ = (Index("ix_node_announcements_timestamp", "timestamp"),)
+
     @classmethod
     def from_gossip(
         cls, gna: gossipd.NodeAnnouncement, raw: bytes
@@ -97,6 +311,123 @@ class NodeAnnouncement(Base):
         }
 
 
+class Stat(Base):
+    """Per-table message counters, maintained during ingestion."""
+
+    __tablename__ = "historian_stats"
+    name = Column(String(32), primary_key=True)
+    count = Column(BigInteger, nullable=False)
+    latest = Column(DateTime)
+
+
+class Counters:
+    """In-memory message counters that are persisted with each batch.
+
+    `record` is called for every newly stored message and `flush`
+    adds the pending increments to the `historian_stats` table in the
+    same transaction as the messages themselves, so the counters never
+    need a `COUNT(*)` over the message tables once initialized.
+    """
+
+    tables = {
+        "channel_announcements": ChannelAnnouncement,
+        "channel_updates": ChannelUpdate,
+        "channel_update_refreshes": ChannelUpdateRefresh,
+        "node_announcements": NodeAnnouncement,
+    }
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = {name: 0 for name in self.tables}
+        self.latest = {name: None for name in self.tables}
+        self.pending = {name: 0 for name in self.tables}
+
+    def load(self, session) -> None:
+        """Load the counters, counting the tables once if they are missing."""
+        for name, cls in self.tables.items():
+            stat = session.get(Stat, name)
+            if stat is None:
+                stat = Stat(name=name, count=session.query(cls).count())
+                if hasattr(cls, "timestamp"):
+                    stat.latest = session.query(func.max(cls.timestamp)).scalar()
+                session.add(stat)
+            with self.lock:
+                # Deletions recorded before loading are still pending.
+                self.counts[name] = stat.count + self.pending[name]
+                self.latest[name] = stat.latest
+        session.commit()
+
+    def record(self, name, timestamp=None) -> None:
+        with self.lock:
+            self.counts[name] += 1
+            self.pending[name] += 1
+            if timestamp is not None and (
+                self.latest[name] is None or self.latest[name] < timestamp
+            ):
+                self.latest[name] = timestamp
+
+    def newest(self):
+        """The latest timestamp over all tables, None if all are empty."""
+        with self.lock:
+            return max((t for t in self.latest.values() if t is not None), default=None)
+
+    def record_deleted(self, name, count) -> None:
+        with self.lock:
+            self.counts[name] -= count
+            self.pending[name] -= count
+
+    def flush(self, session) -> None:
+        with self.lock:
+            for name, count in self.pending.items():
+                if count == 0:
+                    continue
+                session.execute(
+                    update(Stat)
+                    .where(Stat.name == name)
+                    .values(count=Stat.count + count, latest=self.latest[name])
+                )
+                self.pending[name] = 0
+
+    @classmethod
+    def rebuild(cls, session) -> None:
+        """Recount the tables, after bulk imports that bypass `record`."""
+        session.execute(text("DELETE FROM historian_stats"))
+        cls().load(session)
+
+
+def create_schema(engine) -> None:
+    """Create missing tables, columns and indexes.
+
+    `create_all` skips tables that already exist, so columns and
+    indexes added to existing tables have to be created individually.
+    Added columns must be nullable. `channel_latest` is backfilled
+    from `channel_updates` when it is created for an existing database.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    if (
+        ChannelLatest.__tablename__ not in existing_tables
+        and ChannelUpdate.__tablename__ in existing_tables
+    ):
+        with engine.begin() as conn:
+            ChannelLatest.rebuild(conn)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            with engine.begin() as conn:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                        f"{column.type.compile(dialect=engine.dialect)}"
+                    )
+                )
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 @contextmanager
 def db_session(dsn):
     """Tiny contextmanager to facilitate sqlalchemy session management"""
@@ -104,7 +435,7 @@ def db_session(dsn):
         dsn = default_db
     dsn = os.path.expandvars(dsn)
     engine = create_engine(dsn, echo=False)
-    Base.metadata.create_all(engine)
+    create_schema(engine)
     session_maker = sessionmaker(bind=engine)
     session = session_maker()
     try:
@@ -117,94 +448,128 @@ def db_session(dsn):
         session.close()
 
 
+def iter_channel_updates(session, unsigned=False, batch_size=10000):
+    """Yield all raw `channel_updates` in timestamp order.
+
+    Refreshes stored by the deduplication are reconstructed from the
+    policy they refreshed and merged into the stream. Refreshes whose
+    signature was dropped cannot be reconstructed and are skipped,
+    unless `unsigned` is set, in which case they get a zeroed
+    signature. That is only useful to consumers that don't verify
+    signatures.
+
+    Both tables are streamed in `batch_size` rows and merged by
+    timestamp, remembering the latest policy of each channel direction
+    for the refreshes that follow it.
+    """
+    updates = session.execute(
+        text(
+            """
+SELECT timestamp, 0, scid, direction, raw
+FROM channel_updates
+ORDER BY timestamp ASC
+"""
+        ).columns(timestamp=DateTime),
+        execution_options={"yield_per": batch_size},
+    )
+    refreshes = session.execute(
+        text(
+            """
+SELECT timestamp, 1, scid, direction, signature
+FROM channel_update_refreshes
+WHERE :unsigned OR signature IS NOT NULL
+ORDER BY timestamp ASC
+"""
+        )
+        .bindparams(bindparam("unsigned", type_=Boolean))
+        .columns(timestamp=DateTime),
+        {"unsigned": unsigned},
+        execution_options={"yield_per": batch_size},
+    )
+    # Updates sort before refreshes of the same timestamp, so a refresh
+    # always sees the update it refreshed.
+    latest = {}
+    for ts, refresh, scid, direction, data in heapq.merge(
+        updates, refreshes, key=lambda r: (r[0], r[1])
+    ):
+        if not refresh:
+            raw = latest[(scid, direction)] = bytes(data)
+            yield raw
+            continue
+        raw = latest.get((scid, direction))
+        if raw is not None:
+            yield reconstruct_update(raw, ts, bytes(data or bytes(64)))
+
+
 def stream_snapshot_since(since, db=None):
     with db_session(db) as session:
-        # Several nested queries here because join was a bit too
-        # restrictive. The inner SELECT in the WHERE-clause selects all scids
-        # that had any updates in the desired timerange. The outer SELECT then
-        # gets all the announcements and kicks off inner SELECTs that look for
-        # the latest update for each direction.
+        # The inner SELECT in the WHERE-clause selects all scids whose
+        # latest update is in the desired timerange, which is the same
+        # as having had any update in the timerange. The latest update
+        # for each direction is then a simple lookup in `channel_latest`.
         rows = session.execute(
-            """
+            text(
+                """
 SELECT
   a.scid,
   a.raw,
-  (
-    SELECT
-      u.raw
-    FROM
-      channel_updates u
-    WHERE
-      u.scid = a.scid AND
-      direction = 0
-    ORDER BY
-      timestamp
-    DESC LIMIT 1
-  ) as u0,
-  (
-    SELECT
-      u.raw
-    FROM
-      channel_updates u
-    WHERE
-      u.scid = a.scid AND
-      direction = 1
-    ORDER BY
-      timestamp
-    DESC LIMIT 1
-  ) as u1
+  l0.raw AS u0,
+  l1.raw AS u1
 FROM
   channel_announcements a
+LEFT JOIN
+  channel_latest l0 ON l0.scid = a.scid AND l0.direction = 0
+LEFT JOIN
+  channel_latest l1 ON l1.scid = a.scid AND l1.direction = 1
 WHERE
   a.scid IN (
     SELECT
-      u.scid
+      l.scid
     FROM
-      channel_updates u
+      channel_latest l
     WHERE
-      u.timestamp >= '{}'
-    GROUP BY
-      u.scid
+      l.timestamp >= :since
   )
 ORDER BY
   a.scid
-        """.format(since.strftime("%Y-%m-%d %H:%M:%S"))
+        """
+            ).bindparams(bindparam("since", type_=DateTime)),
+            {"since": since},
         )
-        last_scid = None
         for scid, cann, u1, u2 in rows:
-            if scid == last_scid:
-                continue
-            last_scid = scid
             yield cann
             if u1 is not None:
                 yield u1
             if u2 is not None:
                 yield u2
 
-        # Now get and return the node_announcements in the timerange. These
-        # come after the channels since no node without a
-        # channel_announcements and channel_update is allowed.
+        # Now get and return the latest node_announcement for each node
+        # in the timerange. These come after the channels since no node
+        # without a channel_announcements and channel_update is allowed.
         rows = session.execute(
-            """
+            text(
+                """
 SELECT
   n.node_id,
   n.timestamp,
   n.raw
 FROM
   node_announcements n
-WHERE
-  n.timestamp >=  '{}'
-GROUP BY
-  n.node_id,
-  n.timestamp
-HAVING
-  n.timestamp = MAX(n.timestamp)
-ORDER BY timestamp DESC
-        """.format(since.strftime("%Y-%m-%d %H:%M:%S"))
+JOIN (
+  SELECT
+    node_id,
+    MAX(timestamp) AS timestamp
+  FROM
+    node_announcements
+  WHERE
+    timestamp >= :since
+  GROUP BY
+    node_id
+) m ON n.node_id = m.node_id AND n.timestamp = m.timestamp
+ORDER BY n.timestamp DESC
+        """
+            ).bindparams(bindparam("since", type_=DateTime)),
+            {"since": since},
         )
-        last_nid = None
         for nid, ts, nann in rows:
-            if nid == last_nid:
-                continue
-            last_nid = nid
             yield nann
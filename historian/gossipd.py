@@ -5,15 +5,61 @@ import io
 import struct
 
 
+_u16 = struct.Struct("!H").unpack_from
+_u32 = struct.Struct("!I").unpack_from
+_u64 = struct.Struct("!Q").unpack_from
+
+
 class ChannelAnnouncement(object):
-    def __init__(self):
-        self.num_short_channel_id = None
-        self.node_signatures = [None, None]
-        self.bitcoin_signatures = [None, None]
-        self.features = None
-        self.chain_hash = None
-        self.node_ids = [None, None]
-        self.bitcoin_keys = [None, None]
+    """A channel_announcement backed by its raw buffer.
+
+    Fields are decoded from the buffer whenever they are accessed.
+    `offset` is the position of the message payload, i.e., after the
+    type prefix, in `buf`.
+    """
+
+    __slots__ = ("_buf", "_off")
+
+    def __init__(self, buf, offset=0):
+        self._buf = buf
+        self._off = offset
+
+    @property
+    def _features_end(self):
+        return self._off + 258 + _u16(self._buf, self._off + 256)[0]
+
+    @property
+    def node_signatures(self):
+        o = self._off
+        return (self._buf[o : o + 64], self._buf[o + 64 : o + 128])
+
+    @property
+    def bitcoin_signatures(self):
+        o = self._off + 128
+        return (self._buf[o : o + 64], self._buf[o + 64 : o + 128])
+
+    @property
+    def features(self):
+        return self._buf[self._off + 258 : self._features_end]
+
+    @property
+    def chain_hash(self):
+        o = self._features_end
+        return self._buf[o : o + 32][::-1]
+
+    @property
+    def num_short_channel_id(self):
+        return _u64(self._buf, self._features_end + 32)[0]
+
+    @property
+    def node_ids(self):
+        o = self._features_end + 40
+        return (self._buf[o : o + 33], self._buf[o + 33 : o + 66])
+
+    @property
+    def bitcoin_keys(self):
+        o = self._features_end + 106
+        return (self._buf[o : o + 33], self._buf[o + 33 : o + 66])
 
     @property
     def short_channel_id(self):
@@ -44,18 +90,62 @@ class ChannelAnnouncement(object):
 
 
 class ChannelUpdate(object):
-    def __init__(self):
-        self.signature = None
-        self.chain_hash = None
-        self.num_short_channel_id = None
-        self.timestamp = None
-        self.message_flags = None
-        self.channel_flags = None
-        self.cltv_expiry_delta = None
-        self.htlc_minimum_msat = None
-        self.fee_base_msat = None
-        self.fee_proportional_millionths = None
-        self.htlc_maximum_msat = None
+    """A channel_update backed by its raw buffer.
+
+    See `ChannelAnnouncement` for the meaning of `offset`.
+    """
+
+    __slots__ = ("_buf", "_off")
+
+    def __init__(self, buf, offset=0):
+        self._buf = buf
+        self._off = offset
+
+    @property
+    def signature(self):
+        return self._buf[self._off : self._off + 64]
+
+    @property
+    def chain_hash(self):
+        return self._buf[self._off + 64 : self._off + 96][::-1]
+
+    @property
+    def num_short_channel_id(self):
+        return _u64(self._buf, self._off + 96)[0]
+
+    @property
+    def timestamp(self):
+        return _u32(self._buf, self._off + 104)[0]
+
+    @property
+    def message_flags(self):
+        return self._buf[self._off + 108 : self._off + 109]
+
+    @property
+    def channel_flags(self):
+        return self._buf[self._off + 109 : self._off + 110]
+
+    @property
+    def cltv_expiry_delta(self):
+        return _u16(self._buf, self._off + 110)[0]
+
+    @property
+    def htlc_minimum_msat(self):
+        return _u64(self._buf, self._off + 112)[0]
+
+    @property
+    def fee_base_msat(self):
+        return _u32(self._buf, self._off + 120)[0]
+
+    @property
+    def fee_proportional_millionths(self):
+        return _u32(self._buf, self._off + 124)[0]
+
+    @property
+    def htlc_maximum_msat(self):
+        if len(self._buf) < self._off + 136:
+            return None
+        return _u64(self._buf, self._off + 128)[0]
 
     @property
     def short_channel_id(self):
@@ -67,8 +157,7 @@ class ChannelUpdate(object):
 
     @property
     def direction(self):
-        (b,) = struct.unpack("!B", self.channel_flags)
-        return b & 0x01
+        return self._buf[self._off + 109] & 0x01
 
     def serialize(self):
         raise ValueError()
@@ -94,6 +183,8 @@ class ChannelUpdate(object):
 
 
 class Address(object):
+    __slots__ = ("typ", "addr", "port")
+
     def __init__(self, typ=None, addr=None, port=None):
         self.typ = typ
         self.addr = addr
@@ -134,14 +225,65 @@ class Address(object):
 
 
 class NodeAnnouncement(object):
-    def __init__(self):
-        self.signature = None
-        self.features = ""
-        self.timestamp = None
-        self.node_id = None
-        self.rgb_color = None
-        self.alias = None
-        self.addresses = None
+    """A node_announcement backed by its raw buffer.
+
+    See `ChannelAnnouncement` for the meaning of `offset`. Only the
+    addresses are cached since they are the only field that is
+    expensive to decode.
+    """
+
+    __slots__ = ("_buf", "_off", "_addresses")
+
+    def __init__(self, buf, offset=0):
+        self._buf = buf
+        self._off = offset
+        self._addresses = None
+
+    @property
+    def _features_end(self):
+        return self._off + 66 + _u16(self._buf, self._off + 64)[0]
+
+    @property
+    def signature(self):
+        return self._buf[self._off : self._off + 64]
+
+    @property
+    def features(self):
+        return self._buf[self._off + 66 : self._features_end]
+
+    @property
+    def timestamp(self):
+        return _u32(self._buf, self._features_end)[0]
+
+    @property
+    def node_id(self):
+        o = self._features_end + 4
+        return self._buf[o : o + 33]
+
+    @property
+    def rgb_color(self):
+        o = self._features_end + 37
+        return self._buf[o : o + 3]
+
+    @property
+    def alias(self):
+        o = self._features_end + 40
+        return self._buf[o : o + 32]
+
+    @property
+    def addresses(self):
+        if self._addresses is None:
+            o = self._features_end + 72
+            (alen,) = _u16(self._buf, o)
+            abytes = io.BytesIO(self._buf[o + 2 : o + 2 + alen])
+            self._addresses = []
+            while True:
+                addr = parse_address(abytes)
+                if addr is None:
+                    break
+                else:
+                    self._addresses.append(addr)
+        return self._addresses
 
     def __str__(self):
         return "NodeAnnouncement(id={hexlify(node_id)}, alias={alias}, color={rgb_color})".format(
@@ -158,10 +300,28 @@ class NodeAnnouncement(object):
         )
 
 
+def _buffer(b, offset):
+    """Normalize the input of the parsers to a bytes buffer."""
+    if isinstance(b, io.BytesIO):
+        return b.read(), 0
+    if not isinstance(b, bytes):
+        b = bytes(b)
+    return b, offset
+
+
+def _check_length(b, length):
+    if len(b) < length:
+        raise ValueError(f"Message too short: {len(b)} < {length} bytes")
+
+
 def parse(b):
-    if not isinstance(b, io.BytesIO):
-        b = io.BytesIO(b)
-    (typ,) = struct.unpack("!H", b.read(2))
+    if isinstance(b, io.BytesIO):
+        (typ,) = struct.unpack("!H", b.read(2))
+        offset = 0
+    else:
+        # Skip the type prefix without copying the message.
+        b, offset = _buffer(b, 2)
+        (typ,) = _u16(b)
 
     parsers = {
         256: parse_channel_announcement,
@@ -174,51 +334,91 @@ def parse(b):
     if typ not in parsers:
         raise ValueError("No parser registered for type {typ}".format(typ=typ))
 
-    return parsers[typ](b)
+    return parsers[typ](b, offset)
 
 
-def parse_ignore(b):
+def parse_ignore(b, offset=0):
     return None
 
 
-def parse_channel_announcement(b):
-    if not isinstance(b, io.BytesIO):
-        b = io.BytesIO(b)
-
-    ca = ChannelAnnouncement()
-    ca.node_signatures = (b.read(64), b.read(64))
-    ca.bitcoin_signatures = (b.read(64), b.read(64))
-    (flen,) = struct.unpack("!H", b.read(2))
-    ca.features = b.read(flen)
-    ca.chain_hash = b.read(32)[::-1]
-    (ca.num_short_channel_id,) = struct.unpack("!Q", b.read(8))
-    ca.node_ids = (b.read(33), b.read(33))
-    ca.bitcoin_keys = (b.read(33), b.read(33))
+def parse_channel_announcement(b, offset=0):
+    b, offset = _buffer(b, offset)
+    _check_length(b, offset + 258)
+    ca = ChannelAnnouncement(b, offset)
+    _check_length(b, ca._features_end + 172)
     return ca
 
 
-def parse_channel_update(b):
-    if not isinstance(b, io.BytesIO):
-        b = io.BytesIO(b)
+def parse_channel_update(b, offset=0):
+    b, offset = _buffer(b, offset)
+    _check_length(b, offset + 128)
+    return ChannelUpdate(b, offset)
 
-    cu = ChannelUpdate()
-    cu.signature = b.read(64)
-    cu.chain_hash = b.read(32)[::-1]
-    (cu.num_short_channel_id,) = struct.unpack("!Q", b.read(8))
-    (cu.timestamp,) = struct.unpack("!I", b.read(4))
-    cu.message_flags = b.read(1)
-    cu.channel_flags = b.read(1)
-    (cu.cltv_expiry_delta,) = struct.unpack("!H", b.read(2))
-    (cu.htlc_minimum_msat,) = struct.unpack("!Q", b.read(8))
-    (cu.fee_base_msat,) = struct.unpack("!I", b.read(4))
-    (cu.fee_proportional_millionths,) = struct.unpack("!I", b.read(4))
-    t = b.read(8)
-    if len(t) == 8:
-        (cu.htlc_maximum_msat,) = struct.unpack("!Q", t)
-    else:
-        cu.htlc_maximum_msat = None
 
-    return cu
+# Fixed layout of a channel_update including the type prefix, skipping
+# the signature and the chain_hash.
+CHANNEL_UPDATE_FORMAT = "!H64x32xQIBBHQIIQ"
+CHANNEL_UPDATE_SIZE = struct.calcsize(CHANNEL_UPDATE_FORMAT)
+
+# Old channel_updates may not have the htlc_maximum_msat field.
+CHANNEL_UPDATE_LEGACY_FORMAT = "!H64x32xQIBBHQII"
+CHANNEL_UPDATE_LEGACY_SIZE = struct.calcsize(CHANNEL_UPDATE_LEGACY_FORMAT)
+
+
+def _unpack_channel_update(m):
+    if len(m) >= CHANNEL_UPDATE_SIZE:
+        return struct.unpack_from(CHANNEL_UPDATE_FORMAT, m)
+    if len(m) >= CHANNEL_UPDATE_LEGACY_SIZE:
+        return struct.unpack_from(CHANNEL_UPDATE_LEGACY_FORMAT, m) + (None,)
+    raise ValueError(f"Truncated channel_update of {len(m)} bytes")
+
+
+def parse_channel_updates(msgs):
+    """Decode a batch of raw channel_updates into columns.
+
+    `msgs` is either a list of raw messages, including their type
+    prefix, or a buffer of concatenated messages that all have the
+    full fixed size. Returns a dict mapping field names to tuples of
+    values, with the flags decoded as integers.
+
+    When every message has the common fixed size the whole batch is
+    decoded with a single `struct.iter_unpack`, otherwise each message
+    is unpacked individually.
+    """
+    if isinstance(msgs, (bytes, bytearray, memoryview)):
+        if len(msgs) % CHANNEL_UPDATE_SIZE != 0:
+            raise ValueError(
+                f"Buffer of {len(msgs)} bytes is not a multiple of {CHANNEL_UPDATE_SIZE}"
+            )
+        records = struct.iter_unpack(CHANNEL_UPDATE_FORMAT, msgs)
+    elif all(len(m) == CHANNEL_UPDATE_SIZE for m in msgs):
+        records = struct.iter_unpack(CHANNEL_UPDATE_FORMAT, b"".join(msgs))
+    else:
+        records = [_unpack_channel_update(m) for m in msgs]
+
+    fields = (
+        "type",
+        "scid",
+        "timestamp",
+        "message_flags",
+        "channel_flags",
+        "cltv_expiry_delta",
+        "htlc_minimum_msat",
+        "fee_base_msat",
+        "fee_proportional_millionths",
+        "htlc_maximum_msat",
+    )
+    columns = list(zip(*records))
+    if not columns:
+        columns = [()] * len(fields)
+    cols = dict(zip(fields, columns))
+
+    types = set(cols.pop("type"))
+    if types - {258}:
+        raise ValueError(f"Not a batch of channel_updates, found types {types}")
+
+    cols["direction"] = tuple(f & 0x01 for f in cols["channel_flags"])
+    return cols
 
 
 def parse_address(b):
@@ -251,26 +451,9 @@ def parse_address(b):
     return a
 
 
-def parse_node_announcement(b):
-    if not isinstance(b, io.BytesIO):
-        b = io.BytesIO(b)
-
-    na = NodeAnnouncement()
-    na.signature = b.read(64)
-    (flen,) = struct.unpack("!H", b.read(2))
-    na.features = b.read(flen)
-    (na.timestamp,) = struct.unpack("!I", b.read(4))
-    na.node_id = b.read(33)
-    na.rgb_color = b.read(3)
-    na.alias = b.read(32)
-    (alen,) = struct.unpack("!H", b.read(2))
-    abytes = io.BytesIO(b.read(alen))
-    na.addresses = []
-    while True:
-        addr = parse_address(abytes)
-        if addr is None:
-            break
-        else:
-            na.addresses.append(addr)
-
+def parse_node_announcement(b, offset=0):
+    b, offset = _buffer(b, offset)
+    _check_length(b, offset + 66)
+    na = NodeAnnouncement(b, offset)
+    _check_length(b, na._features_end + 74)
     return na
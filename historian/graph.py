@@ -0,0 +1,248 @@
+from binascii import hexlify
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import sessionmaker
+from threading import Lock
+from common import reconstruct_update
+from pyln.proto.primitives import varint_encode
+import gossipd
+import io
+import struct
+
+# Channels whose latest update in a direction is older than this at the
+# requested time are considered pruned, matching the gossip pruning rule.
+PRUNE_AGE = timedelta(weeks=2)
+
+
+class Graph:
+    """The channel graph as it looked at a given point in time.
+
+    Holds the raw gossip messages and decodes them lazily when
+    rendering, so the same instance can be served as JSON or as a GSP
+    snapshot.
+    """
+
+    def __init__(self, when: datetime):
+        self.when = when
+        # scid -> (channel_announcement, [update_dir0, update_dir1],
+        # [last_update_dir0, last_update_dir1])
+        self.channels = {}
+        # node_id -> node_announcement
+        self.nodes = {}
+
+    def to_json(self):
+        channels = []
+        for scid, (cann, updates, last_updates) in self.channels.items():
+            ca = gossipd.parse(cann)
+            for direction, raw in enumerate(updates):
+                if raw is None:
+                    continue
+                cu = gossipd.parse(raw)
+                (channel_flags,) = struct.unpack("!B", cu.channel_flags)
+                channels.append(
+                    {
+                        "short_channel_id": ca.short_channel_id,
+                        "direction": direction,
+                        "source": hexlify(ca.node_ids[direction]).decode("ASCII"),
+                        "destination": hexlify(ca.node_ids[1 - direction]).decode(
+                            "ASCII"
+                        ),
+                        "active": channel_flags & 0x02 == 0,
+                        "last_update": last_updates[direction],
+                        "base_fee_millisatoshi": cu.fee_base_msat,
+                        "fee_per_millionth": cu.fee_proportional_millionths,
+                        "delay": cu.cltv_expiry_delta,
+                        "htlc_minimum_msat": cu.htlc_minimum_msat,
+                        "htlc_maximum_msat": cu.htlc_maximum_msat,
+                    }
+                )
+
+        nodes = []
+        for node_id, raw in self.nodes.items():
+            na = gossipd.parse(raw)
+            nodes.append(
+                {
+                    "nodeid": hexlify(node_id).decode("ASCII"),
+                    "alias": na.alias.rstrip(b"\x00").decode("utf-8", "replace"),
+                    "color": hexlify(na.rgb_color).decode("ASCII"),
+                    "last_timestamp": na.timestamp,
+                    "addresses": [str(a) for a in na.addresses],
+                }
+            )
+
+        return {
+            "timestamp": int(self.when.timestamp()),
+            "channels": channels,
+            "nodes": nodes,
+        }
+
+    def to_gsp(self) -> bytes:
+        """Serialize the graph as a GSP snapshot."""
+        buff = io.BytesIO()
+        buff.write(b"GSP\x01")
+
+        def write(msg):
+            varint_encode(len(msg), buff)
+            buff.write(msg)
+
+        for cann, updates, _ in self.channels.values():
+            write(cann)
+            for u in updates:
+                if u is not None:
+                    write(u)
+        for nann in self.nodes.values():
+            write(nann)
+        return buff.getvalue()
+
+
+def graph_at(session, when: datetime) -> Graph:
+    """Rebuild the channel graph as it was at `when`.
+
+    The latest policy per direction is looked up through the
+    (scid, direction, timestamp) primary key of `channel_updates`.
+    Deduplicated refreshes count towards the last update of a
+    direction, and are reconstructed if their signature was kept.
+    """
+    graph = Graph(when)
+    params = {"when": when, "cutoff": when - PRUNE_AGE}
+    rows = session.execute(
+        text(
+            """
+SELECT
+  a.scid,
+  a.raw,
+  m.direction,
+  m.timestamp,
+  u.raw,
+  r.signature
+FROM
+  channel_announcements a
+JOIN (
+  SELECT
+    scid,
+    direction,
+    MAX(timestamp) AS timestamp
+  FROM (
+    SELECT scid, direction, timestamp FROM channel_updates
+    WHERE timestamp <= :when
+    UNION ALL
+    SELECT scid, direction, timestamp FROM channel_update_refreshes
+    WHERE timestamp <= :when
+  ) t
+  GROUP BY
+    scid,
+    direction
+  HAVING
+    MAX(timestamp) >= :cutoff
+) m ON m.scid = a.scid
+JOIN
+  channel_updates u ON
+    u.scid = m.scid AND
+    u.direction = m.direction AND
+    u.timestamp = (
+      SELECT
+        MAX(p.timestamp)
+      FROM
+        channel_updates p
+      WHERE
+        p.scid = m.scid AND
+        p.direction = m.direction AND
+        p.timestamp <= m.timestamp
+    )
+LEFT JOIN
+  channel_update_refreshes r ON
+    r.scid = m.scid AND
+    r.direction = m.direction AND
+    r.timestamp = m.timestamp
+ORDER BY
+  a.scid,
+  m.direction
+        """
+        )
+        .bindparams(
+            bindparam("when", type_=DateTime), bindparam("cutoff", type_=DateTime)
+        )
+        .columns(timestamp=DateTime),
+        params,
+    )
+
+    node_ids = set()
+    for scid, cann, direction, last_update, cupd, signature in rows:
+        if scid not in graph.channels:
+            graph.channels[scid] = (bytes(cann), [None, None], [None, None])
+            ca = gossipd.parse(cann)
+            node_ids.update(ca.node_ids)
+        cupd = bytes(cupd)
+        if signature is not None:
+            cupd = reconstruct_update(cupd, last_update, bytes(signature))
+        graph.channels[scid][1][direction] = cupd
+        graph.channels[scid][2][direction] = int(last_update.timestamp())
+
+    rows = session.execute(
+        text(
+            """
+SELECT
+  n.node_id,
+  n.raw
+FROM
+  node_announcements n
+JOIN (
+  SELECT
+    node_id,
+    MAX(timestamp) AS timestamp
+  FROM
+    node_announcements
+  WHERE
+    timestamp <= :when
+  GROUP BY
+    node_id
+) m ON n.node_id = m.node_id AND n.timestamp = m.timestamp
+        """
+        ).bindparams(bindparam("when", type_=DateTime)),
+        params,
+    )
+    for node_id, nann in rows:
+        node_id = bytes(node_id)
+        # Nodes without channels are not part of the graph.
+        if node_id in node_ids:
+            graph.nodes[node_id] = bytes(nann)
+
+    return graph
+
+
+class GraphCache:
+    """Keeps the most recently requested graphs in memory.
+
+    Only graphs strictly before the newest ingested message, as
+    returned by `latest`, are cached. Later ones still change as new
+    gossip arrives, so they are rebuilt on every request.
+    """
+
+    def __init__(self, engine, latest, size=8):
+        self.session_maker = sessionmaker(bind=engine)
+        self.latest = latest
+        self.size = size
+        self.graphs = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, timestamp: int) -> Graph:
+        with self.lock:
+            if timestamp in self.graphs:
+                self.graphs.move_to_end(timestamp)
+                return self.graphs[timestamp]
+
+        session = self.session_maker()
+        try:
+            graph = graph_at(session, datetime.fromtimestamp(timestamp))
+        finally:
+            session.close()
+
+        latest = self.latest()
+        if latest is None or graph.when >= latest:
+            return graph
+        with self.lock:
+            self.graphs[timestamp] = graph
+            while len(self.graphs) > self.size:
+                self.graphs.popitem(last=False)
+        return graph
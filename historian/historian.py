@@ -17,10 +17,13 @@ import os
 from pyln.client import Plugin
 import pika
 from sqlalchemy import create_engine
-from sqlalchemy import desc
 from sqlalchemy.orm import sessionmaker
 from threading import Thread
-from common import Base, ChannelAnnouncement, ChannelUpdate, NodeAnnouncement
+from common import Counters, create_schema
+from graph import GraphCache
+import history
+from ingest import Forwarder, Ingester, encode_varint
+from retention import Retention, create_partitioned_tables
 import logging
 import gossipd
 import struct
@@ -158,16 +161,6 @@ class FileTailer:
                 continue
 
 
-def encode_varint(value):
-    """Encode a varint value"""
-    result = bytearray()
-    while value >= 128:
-        result.append((value & 0x7F) | 0x80)
-        value >>= 7
-    result.append(value)
-    return bytes(result)
-
-
 def field_prefix(index: int, wire_type: int) -> bytes:
     """The T part of the TLV for protobuf encoded fields.
     Bits 0-2 are the type, while greater bits are the varint encoded field index.
@@ -226,22 +219,39 @@ def serialize(msg: bytes, node_id: str, network: str) -> bytes:
 
 
 class Flusher(Thread):
-    def __init__(self, engine):
+    def __init__(
+        self,
+        engine,
+        dedup="off",
+        forward=None,
+        node_id=None,
+        network=None,
+        filename="gossip_store",
+        interval=10,
+    ):
         Thread.__init__(self)
         self.engine = engine
+        self.filename = filename
+        self.interval = interval
+        self.dedup = dedup
         self.session_maker = sessionmaker(bind=engine)
-        self.session = None
+        self.ingester = None
+        self.forwarder = None
+        if forward:
+            # Messages the collector can't take yet are spilled next to
+            # the gossip_store.
+            spill_path = os.path.join(
+                os.path.dirname(filename), "historian-forward.spill"
+            )
+            self.forwarder = Forwarder(forward, spill_path=spill_path)
+        self.forwarded = 0
+        self.tailer = None
+        self.counters = Counters()
+        self.rate = 0.0
         self.RABBITMQ_URL = os.environ.get("RABBITMQ_URL")
         self.connection = None
-        my_info = plugin.rpc.getinfo()
-        if "id" in my_info:
-            self.node_id = my_info["id"]
-        else:
-            self.node_id = None
-        if "network" in my_info:
-            self.network = my_info["network"]
-        else:
-            self.network = None
+        self.node_id = node_id
+        self.network = network
 
     def rabbitmq_connect(self):
         params = pika.URLParameters(self.RABBITMQ_URL)
@@ -252,44 +262,72 @@ class Flusher(Thread):
 
     def run(self):
         logging.info("Starting flusher")
-        ft = FileTailer("gossip_store")
-        last_flush = time.time()
-        total = 0
-
-        self.session = self.session_maker()
-        for i, e in enumerate(ft.tail()):
-            self.store(e)
-            self.publish(e)
-
-            if last_flush < time.time() - 10:
-                self.session.commit()
-                self.session = self.session_maker()
-                last_flush = time.time()
+        self.tailer = FileTailer(self.filename)
+        self.ingest(self.tailer.tail())
 
         plugin.log("Filetailer exited...", level="warn")
         if self.connection:
             self.connection.close()
             plugin.log("Rabbitmq connection closed.", level="warn")
 
-    def store(self, raw: bytes) -> None:
-        try:
-            msg = gossipd.parse(raw)
-            cls = None
-            if isinstance(msg, gossipd.ChannelUpdate):
-                cls = ChannelUpdate
-
-            elif isinstance(msg, gossipd.ChannelAnnouncement):
-                cls = ChannelAnnouncement
-
-            elif isinstance(msg, gossipd.NodeAnnouncement):
-                cls = NodeAnnouncement
-
+    def ingest(self, messages) -> None:
+        """Store or forward `messages`, committing every `interval` seconds."""
+        last_flush = time.time()
+        self.ingester = Ingester(self.session_maker, self.counters, self.dedup)
+        self.counters.load(self.ingester.session)
+        for e in messages:
+            if self.forwarder is not None:
+                self.forward(e)
             else:
-                return
+                self.ingester.store(e)
+            self.publish(e)
 
-            self.session.merge(cls.from_gossip(msg, raw))
-        except Exception as e:
-            logging.warning(f"Exception parsing gossip message: {e}")
+            now = time.time()
+            if last_flush < now - self.interval:
+                self.rate = self.flush() / (now - last_flush)
+                last_flush = now
+        self.flush()
+
+    def flush(self) -> int:
+        """Commit the pending messages, returning how many there were."""
+        if self.forwarder is not None:
+            count, self.forwarded = self.forwarded, 0
+            return count
+        return self.ingester.commit()
+
+    def forward(self, raw: bytes) -> None:
+        """Forward a gossip message to the collector instead of storing it."""
+        self.forwarder.send(serialize(raw, self.node_id, self.network))
+        self.forwarded += 1
+
+    def stats(self):
+        """Ingestion statistics, answered from memory."""
+        lag = None
+        if self.tailer is not None:
+            try:
+                lag = os.stat(self.tailer.filename).st_size - self.tailer.pos
+            except OSError:
+                pass
+
+        c = self.counters
+        with c.lock:
+            counts = dict(c.counts)
+            latest = dict(c.latest)
+
+        def fmt(ts):
+            return ts.strftime("%Y/%m/%d, %H:%M:%S") if ts is not None else None
+
+        return {
+            "channel_announcements": counts["channel_announcements"],
+            "channel_updates": counts["channel_updates"],
+            "channel_update_refreshes": counts["channel_update_refreshes"],
+            "node_announcements": counts["node_announcements"],
+            "latest_node_announcement": fmt(latest["node_announcements"]),
+            "latest_channel_update": fmt(latest["channel_updates"]),
+            "ingest_rate": round(self.rate, 2),
+            "gossip_store_lag": lag,
+            "pending_commit": self.ingester.pending if self.ingester else 0,
+        }
 
     def publish(self, raw: bytes) -> None:
         """Serialize and publish a gossip message to a rabbitmq exchange."""
@@ -336,32 +374,85 @@ def init(plugin, configuration, options):
     print(options)
     try:
         engine = create_engine(options["historian-dsn"], echo=False)
-        Base.metadata.create_all(engine)
+        partition = options["historian-partition"]
+        if partition == "monthly":
+            create_partitioned_tables(engine)
+        elif partition != "none":
+            raise ValueError(f"Unknown historian-partition mode {partition}")
+        create_schema(engine)
         plugin.engine = engine
-        Flusher(engine).start()
+        dedup = options["historian-dedup-updates"]
+        if dedup not in ("off", "keep-signature", "drop-signature"):
+            raise ValueError(f"Unknown historian-dedup-updates mode {dedup}")
+        my_info = plugin.rpc.getinfo()
+        plugin.flusher = Flusher(
+            engine,
+            dedup,
+            options["historian-forward"] or None,
+            my_info.get("id"),
+            my_info.get("network"),
+        )
+        plugin.graph_cache = GraphCache(engine, plugin.flusher.counters.newest)
+        plugin.flusher.start()
+        plugin.retention = Retention(
+            engine,
+            int(options["historian-retention-days"]),
+            options["historian-retention-mode"],
+            plugin.flusher.counters,
+        )
+        plugin.retention.start()
     finally:
         engine.dispose()
 
 
 @plugin.method("historian-stats")
 def stats(plugin):
-    engine = plugin.engine
-    session_maker = sessionmaker(bind=engine)
-    session = session_maker()
-
-    return {
-        "channel_announcements": session.query(ChannelAnnouncement).count(),
-        "channel_updates": session.query(ChannelUpdate).count(),
-        "node_announcements": session.query(NodeAnnouncement).count(),
-        "latest_node_announcement": session.query(NodeAnnouncement)
-        .order_by(desc(NodeAnnouncement.timestamp))
-        .limit(1)
-        .first(),
-        "latest_channel_update": session.query(ChannelUpdate)
-        .order_by(desc(ChannelUpdate.timestamp))
-        .limit(1)
-        .first(),
-    }
+    """Message counts, latest timestamps and ingestion progress.
+
+    `ingest_rate` is the number of new messages per second over the
+    last batch, `gossip_store_lag` the number of bytes of the
+    gossip_store that haven't been read yet, and `pending_commit` the
+    number of messages waiting for the next batch to be committed.
+    """
+    return plugin.flusher.stats()
+
+
+@plugin.method("historian-graph-at")
+def graph_at(plugin, timestamp, format="json"):
+    """Reconstruct the channel graph as it was at `timestamp`.
+
+    Returns the channels with their fees and limits and the nodes with
+    their addresses as JSON, or a hex-encoded GSP snapshot if `format`
+    is "gsp".
+    """
+    if format not in ("json", "gsp"):
+        raise ValueError(f"Unknown format {format}, expected json or gsp")
+
+    graph = plugin.graph_cache.get(int(timestamp))
+    if format == "gsp":
+        return {"timestamp": int(timestamp), "gsp": graph.to_gsp().hex()}
+    return graph.to_json()
+
+
+@plugin.method("historian-channel-history")
+def channel_history(
+    plugin, scid, direction=None, since=None, until=None, limit=100, cursor=None
+):
+    """Policy history of channel `scid`, oldest first.
+
+    Returns the decoded fees, CLTV delta and HTLC limits of each
+    `channel_update` of `direction` (both if omitted) between the
+    `since` and `until` UNIX timestamps, at most `limit` at a time. If
+    there are more, pass the returned `next_cursor` as `cursor` to get
+    the next page.
+    """
+    session = sessionmaker(bind=plugin.engine)()
+    try:
+        return history.channel_history(
+            session, scid, direction, since, until, limit, cursor
+        )
+    finally:
+        session.close()
 
 
 plugin.add_option(
@@ -369,6 +460,37 @@ plugin.add_option(
     "sqlite:///historian.sqlite3",
     "SQL DSN defining where the gossip data should be stored.",
 )
+plugin.add_option(
+    "historian-dedup-updates",
+    "off",
+    "Store channel_updates that only refresh the previous policy as compact "
+    "references: off, keep-signature (original messages can be reconstructed) "
+    "or drop-signature (smallest, refreshes can't be reconstructed).",
+)
+plugin.add_option(
+    "historian-forward",
+    "",
+    "Forward messages to a historian collector at host:port or a UNIX "
+    "socket path instead of storing them locally.",
+)
+plugin.add_option(
+    "historian-partition",
+    "none",
+    "Partition new channel_updates, channel_update_refreshes and "
+    "node_announcements tables by month: none or monthly (Postgres only).",
+)
+plugin.add_option(
+    "historian-retention-days",
+    "0",
+    "Only keep the full history of the last this many days, 0 keeps everything.",
+    opt_type="int",
+)
+plugin.add_option(
+    "historian-retention-mode",
+    "downsample",
+    "What to do with older messages: downsample (keep only policy and "
+    "announcement changes) or drop.",
+)
 
 if __name__ == "__main__":
     plugin.run()
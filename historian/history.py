@@ -0,0 +1,140 @@
+from common import ChannelUpdate
+from datetime import datetime
+from sqlalchemy import select, tuple_
+import gossipd
+
+# Columns read by history queries, all of them part of the
+# `ix_channel_updates_history` index.
+POLICY_COLUMNS = [
+    ChannelUpdate.timestamp,
+    ChannelUpdate.direction,
+    ChannelUpdate.message_flags,
+    ChannelUpdate.channel_flags,
+    ChannelUpdate.cltv_expiry_delta,
+    ChannelUpdate.htlc_minimum_msat,
+    ChannelUpdate.fee_base_msat,
+    ChannelUpdate.fee_proportional_millionths,
+    ChannelUpdate.htlc_maximum_msat,
+]
+
+# Largest page returned by a single history query.
+MAX_LIMIT = 10000
+
+
+def parse_scid(scid) -> int:
+    """Accept both the numeric and the `BLOCKxTXxOUT` form of a scid."""
+    if isinstance(scid, int):
+        return scid
+    if "x" in scid:
+        block, tx, out = [int(p) for p in scid.split("x")]
+        return block << 40 | tx << 16 | out
+    return int(scid)
+
+
+def encode_cursor(timestamp: datetime, direction: int) -> str:
+    return f"{int(timestamp.timestamp())}:{direction}"
+
+
+def decode_cursor(cursor: str):
+    timestamp, direction = cursor.split(":")
+    return datetime.fromtimestamp(int(timestamp)), int(direction)
+
+
+def policy(scid: int, row, raw=None) -> dict:
+    """Render a history row, decoding `raw` if the columns are missing."""
+    if raw is not None:
+        cu = gossipd.parse(raw)
+        fields = (
+            cu.message_flags[0],
+            cu.channel_flags[0],
+            cu.cltv_expiry_delta,
+            cu.htlc_minimum_msat,
+            cu.fee_base_msat,
+            cu.fee_proportional_millionths,
+            cu.htlc_maximum_msat,
+        )
+    else:
+        fields = tuple(row[2:])
+    (
+        message_flags,
+        channel_flags,
+        cltv_expiry_delta,
+        htlc_minimum_msat,
+        fee_base_msat,
+        fee_proportional_millionths,
+        htlc_maximum_msat,
+    ) = fields
+    return {
+        "short_channel_id": "{}x{}x{}".format(
+            scid >> 40, scid >> 16 & 0xFFFFFF, scid & 0xFFFF
+        ),
+        "direction": row.direction,
+        "timestamp": int(row.timestamp.timestamp()),
+        "active": channel_flags & 0x02 == 0,
+        "message_flags": message_flags,
+        "channel_flags": channel_flags,
+        "base_fee_millisatoshi": fee_base_msat,
+        "fee_per_millionth": fee_proportional_millionths,
+        "delay": cltv_expiry_delta,
+        "htlc_minimum_msat": htlc_minimum_msat,
+        "htlc_maximum_msat": htlc_maximum_msat,
+    }
+
+
+def channel_history(
+    session, scid, direction=None, since=None, until=None, limit=100, cursor=None
+) -> dict:
+    """The policy history of a channel, oldest first.
+
+    Only full `channel_updates` are returned, i.e., refreshes that
+    were deduplicated are skipped. Results are paginated by the
+    (timestamp, direction) of the last returned update: pass
+    `next_cursor` back as `cursor` to get the following page. Rows
+    stored before the policy columns existed are decoded from `raw`.
+    `limit` must be between 1 and `MAX_LIMIT`.
+    """
+    scid = parse_scid(scid)
+    limit = int(limit)
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}, got {limit}")
+    query = select(*POLICY_COLUMNS).where(ChannelUpdate.scid == scid)
+    if direction is not None:
+        query = query.where(ChannelUpdate.direction == int(direction))
+    if since is not None:
+        query = query.where(
+            ChannelUpdate.timestamp >= datetime.fromtimestamp(int(since))
+        )
+    if until is not None:
+        query = query.where(
+            ChannelUpdate.timestamp <= datetime.fromtimestamp(int(until))
+        )
+    if cursor is not None:
+        query = query.where(
+            tuple_(ChannelUpdate.timestamp, ChannelUpdate.direction)
+            > tuple_(*decode_cursor(cursor))
+        )
+    query = query.order_by(ChannelUpdate.timestamp, ChannelUpdate.direction).limit(
+        limit + 1
+    )
+
+    rows = session.execute(query).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    updates = []
+    for row in rows:
+        raw = None
+        if (
+            row.fee_base_msat is None
+            or row.htlc_minimum_msat is None
+            or (row.htlc_maximum_msat is None and row.message_flags & 1)
+        ):
+            update = session.get(ChannelUpdate, (scid, row.direction, row.timestamp))
+            raw = update.raw
+        updates.append(policy(scid, row, raw))
+
+    last = rows[-1] if more else None
+    return {
+        "updates": updates,
+        "next_cursor": encode_cursor(last.timestamp, last.direction) if last else None,
+    }
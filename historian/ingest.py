@@ -0,0 +1,369 @@
+from collections import OrderedDict, deque
+from common import (
+    ChannelAnnouncement,
+    ChannelLatest,
+    ChannelUpdate,
+    ChannelUpdateRefresh,
+    Counters,
+    NodeAnnouncement,
+)
+from queue import Empty, Queue
+from sqlalchemy import inspect
+from sqlalchemy.orm import sessionmaker
+from threading import Thread
+import gossipd
+import hashlib
+import logging
+import os
+import socket
+import socketserver
+import time
+
+
+class Ingester:
+    """Stores raw gossip messages, skipping the ones already known.
+
+    Messages are added to the current session, and only written once
+    `commit` is called, so callers decide how large a batch is.
+    """
+
+    def __init__(self, session_maker, counters: Counters, dedup="off"):
+        self.session_maker = session_maker
+        self.session = session_maker()
+        self.counters = counters
+        self.dedup = dedup
+        self.pending = 0
+
+    def store(self, raw: bytes) -> None:
+        try:
+            msg = gossipd.parse(raw)
+            cls = None
+            if isinstance(msg, gossipd.ChannelUpdate):
+                cls = ChannelUpdate
+
+            elif isinstance(msg, gossipd.ChannelAnnouncement):
+                cls = ChannelAnnouncement
+
+            elif isinstance(msg, gossipd.NodeAnnouncement):
+                cls = NodeAnnouncement
+
+            else:
+                return
+
+            obj = cls.from_gossip(msg, raw)
+            key = inspect(cls).primary_key_from_instance(obj)
+            if self.session.get(cls, key) is not None:
+                return
+
+            if cls is ChannelUpdate and self.store_refresh(obj):
+                return
+
+            self.session.add(obj)
+            self.pending += 1
+            self.counters.record(cls.__tablename__, getattr(obj, "timestamp", None))
+            if cls is ChannelUpdate:
+                ChannelLatest.track(self.session, obj)
+        except Exception as e:
+            logging.warning(f"Exception parsing gossip message: {e}")
+
+    def store_refresh(self, update: ChannelUpdate) -> bool:
+        """Store `update` as a refresh if it doesn't change the policy.
+
+        Returns whether the update was handled, i.e., deduplication is
+        enabled and the update only refreshed the latest policy.
+        """
+        if self.dedup == "off":
+            return False
+
+        latest = self.session.get(ChannelLatest, (update.scid, update.direction))
+        if latest is None or latest.timestamp >= update.timestamp:
+            return False
+        if not ChannelUpdateRefresh.same_policy(latest.raw, update.raw):
+            return False
+
+        refresh = ChannelUpdateRefresh.from_update(
+            update, keep_signature=self.dedup == "keep-signature"
+        )
+        key = (refresh.scid, refresh.direction, refresh.timestamp)
+        if self.session.get(ChannelUpdateRefresh, key) is None:
+            self.session.add(refresh)
+            self.pending += 1
+            self.counters.record(ChannelUpdateRefresh.__tablename__, refresh.timestamp)
+        ChannelLatest.track(self.session, update)
+        return True
+
+    def commit(self) -> int:
+        """Write the pending messages, returning how many there were."""
+        self.counters.flush(self.session)
+        self.session.commit()
+        self.session = self.session_maker()
+        pending, self.pending = self.pending, 0
+        return pending
+
+
+def encode_varint(value):
+    """Encode a varint value"""
+    result = bytearray()
+    while value >= 128:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def read_varint(f):
+    """Read a varint from a file-like object, None at the end of file."""
+    value, shift = 0, 0
+    while True:
+        b = f.read(1)
+        if not b:
+            if shift != 0:
+                raise ValueError("Truncated varint")
+            return None
+        value |= (b[0] & 0x7F) << shift
+        if b[0] & 0x80 == 0:
+            return value
+        shift += 7
+
+
+def frame(data: bytes) -> bytes:
+    """Prefix `data` with its varint encoded length."""
+    return encode_varint(len(data)) + data
+
+
+def read_frames(f):
+    while True:
+        length = read_varint(f)
+        if length is None:
+            return
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError(f"Truncated frame: {len(data)} < {length}")
+        yield data
+
+
+def deserialize(data: bytes) -> bytes:
+    """Extract the raw gossip message from a `serialize`d message.
+
+    The raw message is always the first, length-delimited field.
+    """
+    if data[:1] != b"\x0a":
+        raise ValueError("Serialized message doesn't start with the raw field")
+    off, length, shift = 1, 0, 0
+    while True:
+        b = data[off]
+        off += 1
+        length |= (b & 0x7F) << shift
+        if b & 0x80 == 0:
+            break
+        shift += 7
+    return data[off : off + length]
+
+
+def parse_address(address: str):
+    """Return the socket family and address for `host:port` or a path."""
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected host:port or a UNIX socket path, got {address}")
+    return socket.AF_INET6 if ":" in host else socket.AF_INET, (
+        host.strip("[]"),
+        int(port),
+    )
+
+
+class Forwarder:
+    """Sends serialized messages to a collector, reconnecting as needed.
+
+    Socket operations time out after `timeout` seconds, and after a
+    failure reconnecting is only tried again after `retry_interval`
+    seconds, so an unreachable or hung collector doesn't stall
+    ingestion. Frames that couldn't be sent are kept in memory, up to
+    `buffer_size` bytes, and appended to `spill_path` beyond that. They
+    are sent once the collector is reachable again. A frame may be sent
+    twice after a failure, the collector drops it as a duplicate.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        timeout=10.0,
+        retry_interval=30.0,
+        buffer_size=64 * 2**20,
+        spill_path=None,
+    ):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.buffer_size = buffer_size
+        self.spill_path = spill_path
+        self.sock = None
+        self.retry_at = 0.0
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.spill = None
+        # Frames left over from a previous run are sent first.
+        self.spilled = spill_path is not None and os.path.exists(spill_path)
+
+    def connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def send(self, data: bytes) -> None:
+        self.buffer(frame(data))
+        self.flush()
+
+    def buffer(self, f: bytes) -> None:
+        if self.spilled or self.pending_bytes + len(f) > self.buffer_size:
+            if self.spill_path is None:
+                if self.pending:
+                    self.pending_bytes -= len(self.pending.popleft())
+                    logging.warning("Forward buffer full, dropping the oldest message")
+            else:
+                if self.spill is None:
+                    self.spill = open(self.spill_path, "ab")
+                self.spill.write(f)
+                self.spilled = True
+                return
+        self.pending.append(f)
+        self.pending_bytes += len(f)
+
+    def flush(self) -> bool:
+        """Send the buffered frames, returning whether all were sent."""
+        if not self.pending and not self.spilled:
+            return True
+        if self.sock is None and time.time() < self.retry_at:
+            return False
+        try:
+            if self.sock is None:
+                self.connect()
+            while self.pending:
+                self.sock.sendall(self.pending[0])
+                self.pending_bytes -= len(self.pending.popleft())
+            if self.spilled:
+                self.send_spilled()
+            return True
+        except OSError as e:
+            logging.warning(f"Could not forward messages to collector: {e}")
+            self.close()
+            self.retry_at = time.time() + self.retry_interval
+            return False
+
+    def send_spilled(self) -> None:
+        # The spilled frames are sent as they are, and only removed
+        # once all of them were sent.
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        with open(self.spill_path, "rb") as f:
+            while chunk := f.read(2**20):
+                self.sock.sendall(chunk)
+        os.remove(self.spill_path)
+        self.spilled = False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Collector:
+    """Receives messages forwarded by several plugins into one database.
+
+    Each connection is handled by its own thread, which only reads
+    frames. A single ingestion thread drops messages whose hash it has
+    already seen, as most of them will be forwarded by every node, and
+    stores the rest in batches of up to `batch_size` messages, or
+    whatever arrived within `interval` seconds.
+    """
+
+    def __init__(
+        self, engine, dedup="off", batch_size=1000, interval=1.0, remember=2**20
+    ):
+        self.engine = engine
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.interval = interval
+        self.remember = remember
+        self.queue = Queue(maxsize=16 * batch_size)
+        self.seen = OrderedDict()
+        self.received = 0
+        self.duplicates = 0
+        self.stored = 0
+
+    def is_duplicate(self, raw: bytes) -> bool:
+        h = hashlib.sha256(raw).digest()
+        if h in self.seen:
+            self.seen.move_to_end(h)
+            return True
+        self.seen[h] = None
+        if len(self.seen) > self.remember:
+            self.seen.popitem(last=False)
+        return False
+
+    def ingest(self):
+        counters = Counters()
+        ingester = Ingester(sessionmaker(bind=self.engine), counters, self.dedup)
+        counters.load(ingester.session)
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+
+            for raw in batch:
+                self.received += 1
+                if self.is_duplicate(raw):
+                    self.duplicates += 1
+                    continue
+                ingester.store(raw)
+            self.stored += ingester.commit()
+            logging.debug(
+                f"Received {self.received} messages, {self.duplicates} "
+                f"duplicates, stored {self.stored}"
+            )
+
+    def serve(self, address: str):
+        family, addr = parse_address(address)
+        collector = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    for data in read_frames(self.rfile):
+                        collector.queue.put(deserialize(data))
+                except (ValueError, IndexError) as e:
+                    logging.warning(
+                        f"Dropping connection from {self.client_address}: {e}"
+                    )
+
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+            base = socketserver.ThreadingUnixStreamServer
+        else:
+            base = socketserver.ThreadingTCPServer
+
+        class Server(base):
+            address_family = family
+            allow_reuse_address = True
+            daemon_threads = True
+
+        server = Server(addr, Handler)
+
+        Thread(target=self.ingest, daemon=True).start()
+        with server:
+            server.serve_forever()
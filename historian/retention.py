@@ -0,0 +1,306 @@
+from common import (
+    Base,
+    ChannelUpdate,
+    ChannelUpdateRefresh,
+    NodeAnnouncement,
+)
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, bindparam, delete, inspect, text, tuple_
+from threading import Thread
+import logging
+import time
+
+# Tables that grow with time and are subject to partitioning and
+# retention, with the columns identifying the channel or node a row
+# belongs to.
+TIMESERIES = {
+    ChannelUpdate.__tablename__: ("scid", "direction"),
+    ChannelUpdateRefresh.__tablename__: None,
+    NodeAnnouncement.__tablename__: ("node_id",),
+}
+
+
+def month_start(when: datetime) -> datetime:
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(when: datetime) -> datetime:
+    if when.month == 12:
+        return datetime(when.year + 1, 1, 1)
+    return datetime(when.year, when.month + 1, 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return f"{table}_{start.year:04d}_{start.month:02d}"
+
+
+def create_partitioned_tables(engine) -> None:
+    """Create the time-series tables partitioned by month.
+
+    Only supported on Postgres, and only for tables that don't exist
+    yet: existing tables stay unpartitioned. Every table gets a
+    default partition so inserts never fail for lack of a partition.
+    """
+    if engine.dialect.name != "postgresql":
+        raise ValueError("Partitioning is only supported on Postgres")
+
+    existing = inspect(engine).get_table_names()
+    for name in TIMESERIES:
+        if name in existing:
+            logging.warning(f"{name} already exists, leaving it unpartitioned")
+            continue
+        table = Base.metadata.tables[name]
+        table.dialect_kwargs["postgresql_partition_by"] = "RANGE (timestamp)"
+        try:
+            table.create(engine)
+        finally:
+            del table.dialect_kwargs["postgresql_partition_by"]
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"CREATE TABLE {name}_default PARTITION OF {name} DEFAULT")
+            )
+    ensure_partitions(engine, datetime.now())
+
+
+def partitions(conn, table: str):
+    """Return (name, start, end) for the monthly partitions of `table`."""
+    rows = conn.execute(
+        text(
+            """
+SELECT
+  c.relname
+FROM
+  pg_inherits i
+JOIN
+  pg_class c ON c.oid = i.inhrelid
+JOIN
+  pg_class p ON p.oid = i.inhparent
+WHERE
+  p.relname = :table
+"""
+        ),
+        {"table": table},
+    )
+    result = []
+    for (name,) in rows:
+        suffix = name[len(table) + 1 :]
+        try:
+            start = datetime.strptime(suffix, "%Y_%m")
+        except ValueError:
+            continue  # The default partition
+        result.append((name, start, next_month(start)))
+    return sorted(result, key=lambda p: p[1])
+
+
+def is_partitioned(conn, table: str) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    rows = conn.execute(
+        text(
+            """
+SELECT
+  1
+FROM
+  pg_partitioned_table t
+JOIN
+  pg_class c ON c.oid = t.partrelid
+WHERE
+  c.relname = :table
+"""
+        ),
+        {"table": table},
+    )
+    return rows.first() is not None
+
+
+def ensure_partitions(engine, when: datetime) -> None:
+    """Create the partitions for the month of `when` and the next one."""
+    with engine.begin() as conn:
+        for table in TIMESERIES:
+            if not is_partitioned(conn, table):
+                continue
+            start = month_start(when)
+            for _ in range(2):
+                end = next_month(start)
+                conn.execute(
+                    text(
+                        f"CREATE TABLE IF NOT EXISTS {partition_name(table, start)} "
+                        f"PARTITION OF {table} FOR VALUES "
+                        f"FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+                    )
+                )
+                start = end
+
+
+def superseded(table: str, key, source: str) -> str:
+    """SQL condition selecting rows of `source` that a later row before
+    the cutoff supersedes."""
+    match = " AND ".join(f"n.{c} = {source}.{c}" for c in key)
+    return f"""
+EXISTS (
+  SELECT
+    1
+  FROM
+    {table} n
+  WHERE
+    {match} AND
+    n.timestamp > {source}.timestamp AND
+    n.timestamp <= :cutoff
+)"""
+
+
+def drop_before(engine, table: str, cutoff: datetime) -> int:
+    """Delete the rows of `table` that are older than `cutoff`.
+
+    For channels and nodes the latest row before the cutoff is kept,
+    so their state at the cutoff is still known, and deduplicated
+    refreshes can still be reconstructed from the policy they
+    refreshed. Partitions that lie entirely before the cutoff are
+    dropped, after moving the rows that are kept to the default
+    partition. Returns the number of deleted rows.
+    """
+    key = TIMESERIES[table]
+    cutoff_param = bindparam("cutoff", type_=DateTime)
+    deleted = 0
+    with engine.begin() as conn:
+        if is_partitioned(conn, table):
+            for name, start, end in partitions(conn, table):
+                if end > cutoff:
+                    break
+                conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                (count,) = conn.execute(text(f"SELECT COUNT(*) FROM {name}")).one()
+                if key is not None:
+                    kept = conn.execute(
+                        text(
+                            f"INSERT INTO {table} SELECT * FROM {name} WHERE NOT "
+                            + superseded(table, key, name)
+                        ).bindparams(cutoff_param),
+                        {"cutoff": cutoff},
+                    ).rowcount
+                    count -= kept
+                conn.execute(text(f"DROP TABLE {name}"))
+                deleted += count
+
+        where = "timestamp < :cutoff"
+        if key is not None:
+            where += " AND " + superseded(table, key, table)
+        deleted += conn.execute(
+            text(f"DELETE FROM {table} WHERE {where}").bindparams(cutoff_param),
+            {"cutoff": cutoff},
+        ).rowcount
+    return deleted
+
+
+def same_node_announcement(a: bytes, b: bytes) -> bool:
+    """Whether two raw node_announcements only differ in signature and
+    timestamp."""
+    flen = int.from_bytes(a[66:68], "big")
+    return a[66 : 68 + flen] == b[66 : 68 + flen] and a[72 + flen :] == b[72 + flen :]
+
+
+def downsample(engine, table: str, cutoff: datetime, batch_size=10000) -> int:
+    """Thin out the rows of `table` that are older than `cutoff`.
+
+    Keeps only the rows that changed the policy of a channel direction
+    or the announcement of a node, i.e., the first of each run of
+    identical messages. Refreshes are keep-alives by definition, so
+    they are all deleted. Returns the number of deleted rows.
+    """
+    t = Base.metadata.tables[table]
+    key = TIMESERIES[table]
+    if key is None:
+        with engine.begin() as conn:
+            return conn.execute(delete(t).where(t.c.timestamp < cutoff)).rowcount
+
+    same = (
+        ChannelUpdateRefresh.same_policy
+        if table == ChannelUpdate.__tablename__
+        else same_node_announcement
+    )
+    cols = [t.c[c] for c in key]
+    query = (
+        t.select()
+        .where(t.c.timestamp < cutoff)
+        .order_by(*cols, t.c.timestamp)
+        .limit(batch_size)
+    )
+    stmt = delete(t).where(
+        *[t.c[c] == bindparam("k_" + c) for c in key],
+        t.c.timestamp == bindparam("k_timestamp"),
+    )
+
+    # SQLite locks the database for a writer while a reader is still
+    # stepping through it, so the rows are read in windows of
+    # `batch_size`, and the duplicates of each window are deleted once
+    # it was read. The next window starts after the last row read.
+    deleted = 0
+    last = None
+    prev_key, prev_raw = None, None
+    with engine.connect() as conn:
+        while True:
+            window = query
+            if last is not None:
+                window = window.where(tuple_(*cols, t.c.timestamp) > tuple_(*last))
+            rows = conn.execute(window).all()
+            if not rows:
+                break
+            keys = []
+            for row in rows:
+                m = row._mapping
+                k = tuple(m[c] for c in key)
+                raw = bytes(m["raw"])
+                if k == prev_key and same(prev_raw, raw):
+                    keys.append(
+                        {**{"k_" + c: m[c] for c in key}, "k_timestamp": m["timestamp"]}
+                    )
+                else:
+                    prev_key, prev_raw = k, raw
+            last = (*k, m["timestamp"])
+            if keys:
+                conn.execute(stmt, keys)
+            conn.commit()
+            deleted += len(keys)
+    return deleted
+
+
+class Retention(Thread):
+    """Periodically drops or downsamples rows older than `days`.
+
+    Also creates upcoming monthly partitions when partitioning is
+    enabled. Deleted rows are subtracted from `counters`.
+    """
+
+    def __init__(self, engine, days, mode="downsample", counters=None, interval=86400):
+        Thread.__init__(self, daemon=True)
+        if mode not in ("downsample", "drop"):
+            raise ValueError(f"Unknown retention mode {mode}")
+        self.engine = engine
+        self.days = days
+        self.mode = mode
+        self.counters = counters
+        self.interval = interval
+
+    def apply(self, cutoff: datetime) -> dict:
+        result = {}
+        for table in TIMESERIES:
+            if self.mode == "drop":
+                deleted = drop_before(self.engine, table, cutoff)
+            else:
+                deleted = downsample(self.engine, table, cutoff)
+            if self.counters is not None:
+                self.counters.record_deleted(table, deleted)
+            result[table] = deleted
+        return result
+
+    def run(self):
+        while True:
+            now = datetime.now()
+            try:
+                if self.engine.dialect.name == "postgresql":
+                    ensure_partitions(self.engine, now)
+                if self.days > 0:
+                    result = self.apply(now - timedelta(days=self.days))
+                    logging.info(f"Retention deleted {result}")
+            except Exception as e:
+                logging.warning(f"Retention job failed: {e}")
+            time.sleep(self.interval)
@@ -1,5 +1,7 @@
 from pyln.testing.fixtures import *
+import gossipd
 import os
+import struct
 import subprocess
 
 
@@ -28,3 +30,586 @@ def test_start(node_factory):
     from pprint import pprint
 
     pprint(help_out)
+
+
+def test_parse_channel_updates():
+    def update(scid, timestamp, channel_flags, htlc_max=True):
+        msg = struct.pack("!H", 258) + bytes(64) + bytes(32)
+        msg += struct.pack("!QIBBHQII", scid, timestamp, 1, channel_flags, 6, 1, 2, 3)
+        if htlc_max:
+            msg += struct.pack("!Q", 10**9)
+        return msg
+
+    msgs = [update(1, 100, 0), update(2, 200, 1), update(3, 300, 3)]
+    cols = gossipd.parse_channel_updates(msgs)
+    for i, m in enumerate(msgs):
+        cu = gossipd.parse(m)
+        assert cols["scid"][i] == cu.num_short_channel_id
+        assert cols["timestamp"][i] == cu.timestamp
+        assert cols["direction"][i] == cu.direction
+        assert cols["fee_proportional_millionths"][i] == cu.fee_proportional_millionths
+        assert cols["htlc_maximum_msat"][i] == cu.htlc_maximum_msat
+
+    assert gossipd.parse_channel_updates(b"".join(msgs)) == cols
+
+    # Mixed sizes fall back to per-message decoding.
+    cols = gossipd.parse_channel_updates([update(4, 400, 0, htlc_max=False)] + msgs)
+    assert cols["scid"] == (4, 1, 2, 3)
+    assert cols["htlc_maximum_msat"] == (None, 10**9, 10**9, 10**9)
+
+
+def test_downsample_sqlite(tmp_path):
+    from common import ChannelUpdate, create_schema
+    from datetime import datetime
+    from retention import downsample
+    from sqlalchemy import create_engine, func, select
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+
+    def update(scid, timestamp, fee):
+        msg = struct.pack("!H", 258) + bytes(64) + bytes(32)
+        msg += struct.pack("!QIBBHQII", scid, timestamp, 1, 0, 6, 1, 2, fee)
+        return msg + struct.pack("!Q", 10**9)
+
+    # 20 keep-alives, a policy change, and 4 more keep-alives, then a
+    # second channel with 2 keep-alives
+    rows = [(1, fee) for fee in [3] * 20 + [4] * 5] + [(2, 3)] * 3
+    with engine.begin() as conn:
+        conn.execute(
+            ChannelUpdate.__table__.insert(),
+            [
+                {
+                    "scid": scid,
+                    "direction": 0,
+                    "timestamp": datetime.fromtimestamp(1000 + i),
+                    "raw": update(scid, 1000 + i, fee),
+                }
+                for i, (scid, fee) in enumerate(rows)
+            ],
+        )
+
+    # More deletions than batch_size, read in windows of 5 rows
+    deleted = downsample(
+        engine, "channel_updates", datetime.fromtimestamp(2000), batch_size=5
+    )
+    assert deleted == 25
+    with engine.connect() as conn:
+        count = conn.execute(select(func.count()).select_from(ChannelUpdate)).scalar()
+    assert count == 3
+
+
+def test_channel_latest_backfill_on_upgrade(tmp_path):
+    from common import ChannelLatest, ChannelUpdate, create_schema
+    from datetime import datetime
+    from sqlalchemy import create_engine, select, text
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+    # A database from before `channel_latest` existed
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE channel_latest"))
+        conn.execute(
+            ChannelUpdate.__table__.insert(),
+            [
+                {
+                    "scid": 1,
+                    "direction": d,
+                    "timestamp": datetime.fromtimestamp(ts),
+                    "raw": b"\x01\x02",
+                }
+                for d, ts in [(0, 100), (0, 200), (1, 150)]
+            ],
+        )
+
+    create_schema(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(ChannelLatest.direction, ChannelLatest.timestamp).order_by(
+                ChannelLatest.direction
+            )
+        ).all()
+    assert rows == [(0, datetime.fromtimestamp(200)), (1, datetime.fromtimestamp(150))]
+
+
+def test_export_parquet_includes_refreshes(tmp_path):
+    import pytest
+
+    pq = pytest.importorskip("pyarrow.parquet")
+    from click.testing import CliRunner
+    from cli.export import export
+    from common import ChannelUpdate, ChannelUpdateRefresh, create_schema
+    from datetime import datetime
+    from sqlalchemy import create_engine
+
+    dsn = f"sqlite:///{tmp_path}/historian.sqlite3"
+    engine = create_engine(dsn)
+    create_schema(engine)
+    msg = struct.pack("!H", 258) + bytes(64) + bytes(32)
+    msg += struct.pack("!QIBBHQII", 1, 1000, 1, 0, 6, 1, 2, 3) + struct.pack(
+        "!Q", 10**9
+    )
+    with engine.begin() as conn:
+        conn.execute(
+            ChannelUpdate.__table__.insert(),
+            [
+                {
+                    "scid": 1,
+                    "direction": 0,
+                    "timestamp": datetime.fromtimestamp(1000),
+                    "raw": msg,
+                }
+            ],
+        )
+        conn.execute(
+            ChannelUpdateRefresh.__table__.insert(),
+            [
+                {
+                    "scid": 1,
+                    "direction": 0,
+                    "timestamp": datetime.fromtimestamp(ts),
+                    "signature": sig,
+                }
+                for ts, sig in [(2000, bytes(64)), (3000, None)]
+            ],
+        )
+
+    out = tmp_path / "export"
+    result = CliRunner().invoke(
+        export, ["parquet", str(out), "--db", dsn, "--jobs", "1"]
+    )
+    assert result.exit_code == 0, result.output
+    table = pq.read_table(out / "channel_updates")
+    assert sorted(ts.timestamp() for ts in table.column("timestamp").to_pylist()) == [
+        1000,
+        2000,
+        3000,
+    ]
+
+
+def test_iter_channel_updates_reconstructs_refreshes(tmp_path):
+    from common import (
+        ChannelUpdate,
+        ChannelUpdateRefresh,
+        create_schema,
+        iter_channel_updates,
+    )
+    from datetime import datetime
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+
+    def update(scid, timestamp, fee, signature=bytes(64)):
+        msg = struct.pack("!H", 258) + signature + bytes(32)
+        msg += struct.pack("!QIBBHQII", scid, timestamp, 1, 0, 6, 1, 2, fee)
+        return msg + struct.pack("!Q", 10**9)
+
+    with Session(engine) as session:
+        for scid, ts, fee in [(1, 1000, 3), (2, 1500, 7), (1, 3000, 4)]:
+            msg = update(scid, ts, fee)
+            session.add(ChannelUpdate.from_gossip(gossipd.parse(msg), msg))
+        for scid, ts, sig in [(1, 2000, b"\x01" * 64), (1, 3000, b"\x02" * 64)]:
+            session.add(
+                ChannelUpdateRefresh(
+                    scid=scid,
+                    direction=0,
+                    timestamp=datetime.fromtimestamp(ts),
+                    signature=sig,
+                )
+            )
+        # no update to refresh, skipped
+        session.add(
+            ChannelUpdateRefresh(
+                scid=3,
+                direction=0,
+                timestamp=datetime.fromtimestamp(2500),
+                signature=bytes(64),
+            )
+        )
+        session.commit()
+
+        result = list(iter_channel_updates(session, batch_size=1))
+    assert result == [
+        update(1, 1000, 3),
+        update(2, 1500, 7),
+        update(1, 2000, 3, b"\x01" * 64),
+        update(1, 3000, 4),
+        update(1, 3000, 4, b"\x02" * 64),
+    ]
+
+
+def test_channel_history_string_arguments(tmp_path):
+    import pytest
+    from common import ChannelUpdate, create_schema
+    from history import channel_history
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+    with Session(engine) as session:
+        for ts in (1000, 2000, 3000):
+            msg = struct.pack("!H", 258) + bytes(64) + bytes(32)
+            msg += struct.pack("!QIBBHQII", 1, ts, 1, 0, 6, 1, 2, 3)
+            msg += struct.pack("!Q", 10**9)
+            session.add(ChannelUpdate.from_gossip(gossipd.parse(msg), msg))
+        session.commit()
+
+        # Arguments arrive as strings from the command line
+        result = channel_history(
+            session, "0x0x1", since="1500", until="2500", limit="5"
+        )
+        assert [u["timestamp"] for u in result["updates"]] == [2000]
+
+        for limit in (0, -1, "100000"):
+            with pytest.raises(ValueError, match="limit must be between"):
+                channel_history(session, "0x0x1", limit=limit)
+
+
+def test_forwarder_buffers_while_collector_is_down(tmp_path):
+    import io
+    import socket
+    from ingest import Forwarder, read_frames
+
+    address = str(tmp_path / "collector.sock")
+    spill_path = str(tmp_path / "forward.spill")
+    forwarder = Forwarder(
+        address, timeout=1, retry_interval=0, buffer_size=10, spill_path=spill_path
+    )
+
+    # Nothing listens yet: the first message is buffered, the rest spilled
+    messages = [bytes([i]) * 6 for i in range(4)]
+    for m in messages[:3]:
+        forwarder.send(m)
+    assert len(forwarder.pending) == 1
+    assert os.path.exists(spill_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen()
+    forwarder.send(messages[3])
+    assert not forwarder.pending and not os.path.exists(spill_path)
+    forwarder.close()
+
+    conn, _ = server.accept()
+    data = b""
+    while chunk := conn.recv(4096):
+        data += chunk
+    conn.close()
+    server.close()
+    assert list(read_frames(io.BytesIO(data))) == messages
+
+
+def test_graph_cache_skips_graphs_after_the_latest_message(tmp_path):
+    from common import create_schema
+    from datetime import datetime
+    from graph import GraphCache
+    from sqlalchemy import create_engine
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+    latest = [None]
+    cache = GraphCache(engine, lambda: latest[0])
+
+    # nothing ingested yet
+    assert cache.get(1000) is not cache.get(1000)
+
+    latest[0] = datetime.fromtimestamp(2000)
+    assert cache.get(1000) is cache.get(1000)
+    assert cache.get(2000) is not cache.get(2000)
+    assert cache.get(3000) is not cache.get(3000)
+
+
+def gossip_messages():
+    """A small, valid gossip graph: 3 channels and their 2 nodes."""
+    import random
+    from cli.bench import (
+        channel_announcement,
+        channel_update,
+        node_announcement,
+        random_policy,
+    )
+
+    rng = random.Random(1)
+    nodes = sorted(b"\x02" + rng.randbytes(32) for _ in range(2))
+    msgs = []
+    for scid in (1, 2, 3):
+        msgs.append(channel_announcement(rng, scid, *nodes))
+        for ts in (1000 + scid, 2000 + scid):
+            msgs.append(channel_update(rng, scid, ts, scid % 2, random_policy(rng)))
+    msgs += [node_announcement(rng, n, 1500, False) for n in nodes]
+    return msgs, nodes
+
+
+def test_gsp_round_trip(tmp_path):
+    from cli.common import GossipStream, GossipWriter
+
+    msgs, nodes = gossip_messages()
+    for version, compression in [(1, "none"), (2, "none"), (2, "zstd")]:
+        path = tmp_path / f"snapshot-{version}-{compression}.gsp"
+        # small blocks, so messages are spread over several of them
+        writer = GossipWriter(open(path, "wb"), version, compression, block_size=500)
+        for m in msgs:
+            writer.write(m)
+        writer.close()
+
+        with open(path, "rb") as f:
+            stream = GossipStream(f, str(path), decode=False)
+            assert stream.version == version
+            assert list(stream) == msgs
+            assert stream.find_channel(2) == msgs[3:6]
+            assert stream.find_node(nodes[1]) == msgs[-1:]
+            assert stream.find_channel(4) == []
+
+        if version == 2:
+            assert stream.metadata == {
+                "version": 2,
+                "compression": compression,
+                "first_timestamp": 1001,
+                "last_timestamp": 2003,
+                "channel_announcements": 3,
+                "channel_updates": 6,
+                "node_announcements": 2,
+            }
+
+
+def test_graph_at(tmp_path):
+    import io
+    import random
+    from cli.bench import channel_update
+    from cli.common import GossipStream
+    from common import Counters, create_schema
+    from datetime import datetime
+    from graph import graph_at
+    from ingest import Ingester
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session, sessionmaker
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+    msgs, nodes = gossip_messages()
+    cann, nann = msgs[0], msgs[-2]
+    rng = random.Random(2)
+    policy_a = (6, 0, 1, 100, 10**9, False)
+    policy_b = (6, 0, 1, 200, 10**9, False)
+    update_a = channel_update(rng, 1, 1000, 0, policy_a)
+    refresh_a = channel_update(rng, 1, 2000, 0, policy_a)
+    update_b = channel_update(rng, 1, 3000, 0, policy_b)
+
+    ingester = Ingester(sessionmaker(bind=engine), Counters(), "keep-signature")
+    for m in (cann, update_a, refresh_a, update_b, nann):
+        ingester.store(m)
+    ingester.commit()
+
+    def at(ts):
+        with Session(engine) as session:
+            return graph_at(session, datetime.fromtimestamp(ts))
+
+    assert at(500).channels == {}
+
+    # the refresh is the latest update, rebuilt with its own signature
+    graph = at(2500)
+    assert graph.channels == {1: (cann, [refresh_a, None], [2000, None])}
+    assert graph.nodes == {nodes[0]: nann}
+    channels = graph.to_json()["channels"]
+    assert [(c["direction"], c["fee_per_millionth"]) for c in channels] == [(0, 100)]
+    stream = GossipStream(io.BytesIO(graph.to_gsp()), "graph.gsp", decode=False)
+    assert list(stream) == [cann, refresh_a, nann]
+
+    assert at(3000).channels[1][1] == [update_b, None]
+    # the node announced itself only after this
+    assert at(1200).nodes == {}
+    # pruned two weeks after the last update
+    assert at(3000 + 15 * 86400).channels == {}
+
+
+def test_parse_messages_from_their_buffer():
+    import io
+    import pytest
+    import random
+    from cli.bench import CHAIN_HASH, channel_announcement, channel_update
+
+    rng = random.Random(3)
+    node_1, node_2 = b"\x02" + bytes(32), b"\x03" + bytes(32)
+    raw = channel_announcement(rng, 42 << 40 | 7 << 16 | 1, node_1, node_2)
+    ca = gossipd.parse(raw)
+    assert ca.short_channel_id == "42x7x1"
+    assert ca.node_ids == (node_1, node_2)
+    assert ca.features == b""
+    assert ca.chain_hash == CHAIN_HASH[::-1]
+    assert gossipd.parse(io.BytesIO(raw)) == ca
+    assert not hasattr(ca, "__dict__")
+
+    raw = channel_update(rng, 5, 1234, 1, (40, 1, 2, 3, 10**9, True))
+    cu = gossipd.parse(bytearray(raw))
+    assert (cu.num_short_channel_id, cu.timestamp, cu.direction) == (5, 1234, 1)
+    assert cu.channel_flags == b"\x03"
+    assert (cu.cltv_expiry_delta, cu.htlc_minimum_msat) == (40, 1)
+    assert (cu.fee_base_msat, cu.fee_proportional_millionths) == (2, 3)
+    assert cu.htlc_maximum_msat == 10**9
+    # without the optional htlc_maximum_msat
+    assert gossipd.parse(raw[:-8]).htlc_maximum_msat is None
+
+    addresses = b"\x01\x01\x02\x03\x04" + struct.pack("!H", 9735)
+    features = b"\x01\x02"
+    raw = (
+        struct.pack("!H", 257)
+        + bytes(64)
+        + struct.pack("!H", len(features))
+        + features
+        + struct.pack("!I", 5678)
+        + node_1
+        + b"\xff\x00\x00"
+        + b"alias".ljust(32, b"\x00")
+        + struct.pack("!H", len(addresses))
+        + addresses
+    )
+    na = gossipd.parse(raw)
+    assert (na.node_id, na.timestamp, na.features) == (node_1, 5678, features)
+    assert na.rgb_color == b"\xff\x00\x00"
+    assert na.alias.rstrip(b"\x00") == b"alias"
+    assert [str(a) for a in na.addresses] == ["ipv4://1.2.3.4:9735"]
+
+    for truncated in (raw[:60], raw[:-10]):
+        with pytest.raises(ValueError, match="too short"):
+            gossipd.parse(truncated)
+
+
+def test_counters_load_flush_and_deletes(tmp_path):
+    from common import ChannelUpdate, Counters, Stat, create_schema
+    from datetime import datetime
+    from ingest import Ingester
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session, sessionmaker
+
+    engine = create_engine(f"sqlite:///{tmp_path}/historian.sqlite3")
+    create_schema(engine)
+    msgs, _ = gossip_messages()
+    updates = [m for m in msgs if m[:2] == b"\x01\x02"]
+
+    # rows from before the counters existed are counted once on load
+    with Session(engine) as session:
+        for m in updates[:2]:
+            session.add(ChannelUpdate.from_gossip(gossipd.parse(m), m))
+        session.commit()
+        counters = Counters()
+        counters.load(session)
+    assert counters.counts["channel_updates"] == 2
+    assert counters.latest["channel_updates"] == datetime.fromtimestamp(2001)
+
+    ingester = Ingester(sessionmaker(bind=engine), counters)
+    for m in msgs:
+        ingester.store(m)
+    assert ingester.commit() == len(msgs) - 2
+    assert counters.counts["channel_updates"] == 6
+    assert counters.counts["channel_announcements"] == 3
+    assert counters.newest() == datetime.fromtimestamp(2003)
+
+    # persisted with the batch, and deletions before a load are kept
+    restarted = Counters()
+    restarted.record_deleted("channel_updates", 1)
+    with Session(engine) as session:
+        restarted.load(session)
+        assert restarted.counts == {**counters.counts, "channel_updates": 5}
+        restarted.flush(session)
+        session.commit()
+        assert session.get(Stat, "channel_updates").count == 5
+
+        Counters.rebuild(session)
+        assert session.get(Stat, "channel_updates").count == 6
+
+
+def test_db_merge_key_ranges(tmp_path):
+    from click.testing import CliRunner
+    from cli.db import db, key_ranges, merge_range
+    from common import ChannelLatest, ChannelUpdate, Counters, Stat, create_schema
+    from datetime import datetime
+    from ingest import Ingester
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import Session, sessionmaker
+
+    assert key_ranges(0, 10, 3) == [(0, 3, False), (3, 6, False), (6, 10, True)]
+    assert key_ranges(5, 5, 4) == [(5, 5, True)]
+    lo, hi = datetime.fromtimestamp(0), datetime.fromtimestamp(90)
+    ranges = key_ranges(lo, hi, 3)
+    assert [r[0] for r in ranges] == [lo, lo + (hi - lo) / 3, lo + (hi - lo) * 2 / 3]
+    assert ranges[-1][1:] == (hi, True)
+
+    msgs, _ = gossip_messages()
+    source = f"sqlite:///{tmp_path}/source.sqlite3"
+    destination = f"sqlite:///{tmp_path}/destination.sqlite3"
+    engines = {}
+    for dsn, stored in [(source, msgs), (destination, msgs[1:2])]:
+        engines[dsn] = create_engine(dsn)
+        create_schema(engines[dsn])
+        ingester = Ingester(sessionmaker(bind=engines[dsn]), Counters())
+        for m in stored:
+            ingester.store(m)
+        ingester.commit()
+
+    # each row is read by exactly one of the ranges, empty ranges of
+    # integer keys are dropped
+    ranges = key_ranges(1, 3, 3)
+    assert ranges == [(1, 2, False), (2, 3, True)]
+    read = [
+        merge_range(
+            source, f"sqlite:///{tmp_path}/r{i}.sqlite3", "channel_updates", *r, 2
+        )
+        for i, r in enumerate(ranges)
+    ]
+    assert read == [2, 4]
+
+    result = CliRunner().invoke(db, ["merge", source, destination, "--jobs", "3"])
+    assert result.exit_code == 0, result.output
+    with Session(engines[destination]) as session:
+        assert session.scalar(select(func.count()).select_from(ChannelUpdate)) == 6
+        # rebuilt after the bulk insert
+        assert session.scalar(select(func.count()).select_from(ChannelLatest)) == 3
+        assert session.get(Stat, "channel_updates").count == 6
+        assert session.get(Stat, "node_announcements").count == 2
+
+
+def test_snapshot_split(tmp_path):
+    import bz2
+    import sys
+    from cli.common import GossipStream, GossipWriter
+
+    msgs, _ = gossip_messages()
+    cli = os.path.join(os.path.dirname(__file__), "historian-cli")
+    for version, compress, suffix in [(1, None, ""), (1, "bz2", ".bz2"), (2, None, "")]:
+        directory = tmp_path / f"v{version}{suffix}"
+        directory.mkdir()
+        path = directory / "snapshot.gsp"
+        writer = GossipWriter(open(path, "wb"), version, "zstd")
+        for m in msgs:
+            writer.write(m)
+        writer.close()
+
+        args = [sys.executable, cli, "snapshot", "split", str(path), "1000"]
+        args += ["--jobs", "2", "--max-inflight", "1", "--exec", "touch {}.done"]
+        if compress is not None:
+            args += ["--compress", compress]
+        subprocess.check_output(args, cwd=os.path.dirname(cli))
+
+        parts = sorted(str(p) for p in directory.glob(f"snapshot_*.gsp{suffix}"))
+        # one part per channel, the node announcements fit into the last
+        assert len(parts) == 3
+        result = []
+        for part in parts:
+            assert os.path.exists(part + ".done")
+            f = bz2.open(part, "rb") if compress == "bz2" else open(part, "rb")
+            with f:
+                stream = GossipStream(f, part, decode=False)
+                assert stream.version == version
+                part_msgs = list(stream)
+            if version == 1 and compress is None:
+                assert os.path.getsize(part) <= 1000
+            # channels are kept together with their updates
+            for i, m in enumerate(part_msgs):
+                if m[:2] == b"\x01\x00":
+                    j = msgs.index(m)
+                    assert part_msgs[i : i + 3] == msgs[j : j + 3]
+            result += part_msgs
+        assert sorted(result) == sorted(msgs)
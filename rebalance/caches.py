@@ -0,0 +1,247 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class ChannelCache:
+    """
+    Shared, thread-safe view of our channels, indexed by scid and peer id.
+
+    The whole `listpeerchannels` output is fetched in one call whenever the
+    cache is stale. Notifications that change channel balances or states
+    call `invalidate`, the next lookup then refreshes everything at once.
+    `max_age` is a safety net for changes we don't get notified about.
+
+    Threads waiting for a channel's HTLCs to settle sleep on a condition
+    variable of that channel, and only look at the channel again when a
+    notification that may have resolved an HTLC calls `notify`. They read
+    the shared cache, so all waiters woken by one notification share a
+    single `listpeerchannels` call.
+    """
+
+    def __init__(self, rpc, max_age: float = 60):
+        self.rpc = rpc
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.by_scid = {}
+        self.by_peer = {}
+        self.generation = 0
+        self.fetched_generation = -1
+        self.fetched_at = 0.0
+        self.conditions = {}
+        self.events = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def _index(self, channels: list):
+        for ch in channels:
+            scid = ch.get("short_channel_id")
+            if scid is not None:
+                self.by_scid[scid] = ch
+            self.by_peer.setdefault(ch["peer_id"], []).append(ch)
+
+    def _is_fresh(self):
+        return (
+            self.fetched_generation == self.generation
+            and time.time() - self.fetched_at < self.max_age
+        )
+
+    def refresh(self, force: bool = False):
+        # Only one thread fetches, the others wait and then use its result.
+        with self.refresh_lock:
+            with self.lock:
+                if not force and self._is_fresh():
+                    return
+                generation = self.generation
+            channels = self.rpc.listpeerchannels()["channels"]
+            with self.lock:
+                self.by_scid = {}
+                self.by_peer = {}
+                self._index(channels)
+                self.fetched_generation = generation
+                self.fetched_at = time.time()
+
+    def refresh_peer(self, peer_id: str):
+        """Refetch only the channels with `peer_id`, and return them."""
+        # Serialized with `refresh`, so an older full fetch never replaces
+        # the newer channels of this peer.
+        with self.refresh_lock:
+            channels = self.rpc.listpeerchannels(peer_id)["channels"]
+            with self.lock:
+                for ch in self.by_peer.pop(peer_id, []):
+                    self.by_scid.pop(ch.get("short_channel_id"), None)
+                self._index(channels)
+        return channels
+
+    def get(self, scid: str):
+        self.refresh()
+        with self.lock:
+            return self.by_scid.get(scid)
+
+    def peer_channels(self, peer_id: str):
+        self.refresh()
+        with self.lock:
+            return list(self.by_peer.get(peer_id, []))
+
+    def channels(self):
+        self.refresh()
+        with self.lock:
+            return list(self.by_scid.values())
+
+    def notify(self, scids: list = None):
+        """Wake the threads waiting on `scids`, or on all channels if None."""
+        with self.lock:
+            if scids is None:
+                scids = list(self.conditions)
+            for scid in scids:
+                self.events[scid] = self.events.get(scid, 0) + 1
+                cond = self.conditions.get(scid)
+                if cond is not None:
+                    cond.notify_all()
+
+    def _settled(self, scid: str, force: bool = False):
+        self.refresh(force)
+        with self.lock:
+            channel = self.by_scid.get(scid)
+        return channel is None or len(channel.get("htlcs", [])) == 0
+
+    def wait_settled(self, scid: str, timeout: float = 60):
+        """Wait until channel `scid` has no HTLCs, False on timeout.
+
+        Notifications invalidate the cache before they `notify`, so a
+        woken waiter sees the channel as it is after the notification.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                cond = self.conditions.setdefault(scid, threading.Condition(self.lock))
+                seen = self.events.get(scid, 0)
+            if self._settled(scid):
+                return True
+            with self.lock:
+                while self.events.get(scid, 0) == seen:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+            if time.time() >= deadline:
+                # look once more, in case we missed a notification
+                return self._settled(scid, force=True)
+
+
+class PolicyCache:
+    """
+    Forwarding policies of public channels, keyed by (scid, direction).
+
+    Warmed from a single `listchannels` call and fully refreshed after
+    `max_age` seconds. Channels missing from the snapshot are fetched one
+    by one. Entries are invalidated when a payment fails because of an
+    outdated policy, which also updates lightningd's view of the gossip.
+    """
+
+    FIELDS = ("destination", "base_fee_millisatoshi", "fee_per_millionth", "delay")
+
+    def __init__(self, rpc, max_age: float = 3600):
+        self.rpc = rpc
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.policies = {}
+        self.fetched_at = None
+
+    def _store(self, channels: list):
+        with self.lock:
+            for c in channels:
+                key = (c["short_channel_id"], c["direction"])
+                self.policies[key] = {f: c[f] for f in self.FIELDS}
+
+    def refresh(self, force: bool = False):
+        with self.refresh_lock:
+            if (
+                not force
+                and self.fetched_at is not None
+                and time.time() - self.fetched_at < self.max_age
+            ):
+                return
+            channels = self.rpc.listchannels()["channels"]
+            with self.lock:
+                self.policies = {}
+            self._store(channels)
+            self.fetched_at = time.time()
+
+    def invalidate(self, scid: str):
+        with self.lock:
+            for direction in (0, 1):
+                self.policies.pop((scid, direction), None)
+
+    def _lookup(self, scid: str, direction, destination):
+        with self.lock:
+            if direction is not None:
+                policy = self.policies.get((scid, direction))
+                if policy is not None and destination in (
+                    None,
+                    policy["destination"],
+                ):
+                    return policy
+            for d in (0, 1):
+                policy = self.policies.get((scid, d))
+                if policy is not None and policy["destination"] == destination:
+                    return policy
+        return None
+
+    def get(self, scid: str, direction: int = None, destination: str = None):
+        """The policy for forwarding over `scid` towards `destination`."""
+        self.refresh()
+        policy = self._lookup(scid, direction, destination)
+        if policy is None:
+            self._store(self.rpc.listchannels(scid)["channels"])
+            policy = self._lookup(scid, direction, destination)
+        return policy
+
+
+class AliasCache:
+    """
+    LRU cache of node aliases with a TTL, shared by all rebalance threads.
+
+    `warm` fills it from a single `listnodes` call, nodes missing later on
+    are fetched one by one. Nodes without an alias are cached with the
+    shortened node id that is shown instead.
+    """
+
+    def __init__(self, rpc, size: int = 50000, ttl: float = 3600):
+        self.rpc = rpc
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.aliases = OrderedDict()
+
+    @staticmethod
+    def alias_of(node: dict):
+        return node.get("alias") or node["nodeid"][0:7]
+
+    def _store(self, nodes: list):
+        now = time.time()
+        with self.lock:
+            for node in nodes:
+                self.aliases[node["nodeid"]] = (self.alias_of(node), now)
+                self.aliases.move_to_end(node["nodeid"])
+            while len(self.aliases) > self.size:
+                self.aliases.popitem(last=False)
+
+    def warm(self):
+        self._store(self.rpc.listnodes()["nodes"])
+
+    def get(self, node_id: str):
+        with self.lock:
+            entry = self.aliases.get(node_id)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                self.aliases.move_to_end(node_id)
+                return entry[0]
+        nodes = self.rpc.listnodes(node_id)["nodes"]
+        if len(nodes) == 0:
+            nodes = [{"nodeid": node_id}]
+        self._store(nodes)
+        return self.alias_of(nodes[0])
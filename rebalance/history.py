@@ -0,0 +1,202 @@
+from collections import namedtuple
+import sqlite3
+import threading
+import time
+
+PairStats = namedtuple("PairStats", "attempts successes amount_msat fee_msat")
+
+ADD_TOTALS = """UPDATE totals SET successes = successes + ?,
+    amount_msat = amount_msat + ?, fee_msat = fee_msat + ?"""
+
+
+def probability(stats: PairStats):
+    # success rate with a uniform prior, unknown pairs get 0.5
+    return (stats.successes + 1) / (stats.attempts + 2)
+
+
+def fee_ppm(stats: PairStats):
+    if stats.amount_msat == 0:
+        return None
+    return stats.fee_msat * 10**6 // stats.amount_msat
+
+
+class History:
+    """
+    Persistent log of rebalance attempts in a sqlite database.
+
+    Per channel pair aggregates of the last `days` are kept in memory, so
+    the scheduler can look them up for every pair without a query. Older
+    attempts are deleted, after adding the successful ones to the all-time
+    totals.
+    """
+
+    def __init__(self, path: str, days: int = 30):
+        self.days = days
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # set when the database is new, so older rebalances can be added
+        self.created_at = None
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attempts'"
+        ).fetchone()
+        if exists is None:
+            self.created_at = time.time()
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS attempts (
+                id INTEGER PRIMARY KEY,
+                started_at REAL NOT NULL,
+                duration REAL NOT NULL,
+                outgoing_scid TEXT NOT NULL,
+                incoming_scid TEXT NOT NULL,
+                amount_msat INTEGER NOT NULL,
+                fee_msat INTEGER,
+                hops INTEGER,
+                parts INTEGER,
+                status TEXT NOT NULL,
+                message TEXT,
+                erring_channel TEXT,
+                erring_node TEXT
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_attempts_started_at ON attempts (started_at)"
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS totals (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                successes INTEGER NOT NULL,
+                amount_msat INTEGER NOT NULL,
+                fee_msat INTEGER NOT NULL
+            )"""
+        )
+        self.db.execute("INSERT OR IGNORE INTO totals VALUES (0, 0, 0, 0)")
+        self.db.commit()
+        self.pairs = {}
+        self.load()
+
+    def load(self):
+        """Delete attempts that got too old, and recompute the aggregates."""
+        since = time.time() - self.days * 86400
+        with self.lock:
+            old = self.db.execute(
+                """SELECT COUNT(*), COALESCE(SUM(amount_msat), 0),
+                    COALESCE(SUM(fee_msat), 0)
+                FROM attempts WHERE started_at < ? AND status = 'complete'""",
+                (since,),
+            ).fetchone()
+            self.db.execute(ADD_TOTALS, old)
+            self.db.execute("DELETE FROM attempts WHERE started_at < ?", (since,))
+            self.db.commit()
+            rows = self.db.execute(
+                """SELECT outgoing_scid, incoming_scid, COUNT(*),
+                    SUM(status = 'complete'),
+                    SUM(CASE WHEN status = 'complete' THEN amount_msat ELSE 0 END),
+                    SUM(CASE WHEN status = 'complete' THEN fee_msat ELSE 0 END)
+                FROM attempts WHERE started_at >= ?
+                GROUP BY outgoing_scid, incoming_scid""",
+                (since,),
+            ).fetchall()
+            self.pairs = {(r[0], r[1]): PairStats(*r[2:]) for r in rows}
+
+    def record(
+        self,
+        started_at: float,
+        outgoing_scid: str,
+        incoming_scid: str,
+        amount_msat: int,
+        status: str,
+        fee_msat: int = None,
+        hops: int = None,
+        parts: int = None,
+        message: str = None,
+        erring_channel: str = None,
+        erring_node: str = None,
+    ):
+        success = status == "complete"
+        with self.lock:
+            self.db.execute(
+                """INSERT INTO attempts (started_at, duration, outgoing_scid,
+                    incoming_scid, amount_msat, fee_msat, hops, parts, status,
+                    message, erring_channel, erring_node)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    started_at,
+                    time.time() - started_at,
+                    outgoing_scid,
+                    incoming_scid,
+                    amount_msat,
+                    fee_msat,
+                    hops,
+                    parts,
+                    status,
+                    message,
+                    erring_channel,
+                    erring_node,
+                ),
+            )
+            self.db.commit()
+            key = (outgoing_scid, incoming_scid)
+            stats = self.pairs.get(key, PairStats(0, 0, 0, 0))
+            self.pairs[key] = PairStats(
+                stats.attempts + 1,
+                stats.successes + success,
+                stats.amount_msat + (amount_msat if success else 0),
+                stats.fee_msat + (fee_msat if success else 0),
+            )
+
+    def pair(self, outgoing_scid: str, incoming_scid: str):
+        with self.lock:
+            return self.pairs.get((outgoing_scid, incoming_scid), PairStats(0, 0, 0, 0))
+
+    def incoming(self):
+        """Aggregates per incoming channel, over all outgoing channels."""
+        result = {}
+        with self.lock:
+            for (_, incoming_scid), stats in self.pairs.items():
+                total = result.get(incoming_scid, PairStats(0, 0, 0, 0))
+                result[incoming_scid] = PairStats(
+                    *(a + b for a, b in zip(total, stats))
+                )
+        return result
+
+    def fee_ppms(self):
+        """Average fee rates by (outgoing, incoming) pair and by incoming channel."""
+        with self.lock:
+            pairs = dict(self.pairs)
+        result = {}
+        for key, stats in [*pairs.items(), *self.incoming().items()]:
+            ppm = fee_ppm(stats)
+            if ppm is not None:
+                result[key] = ppm
+        return result
+
+    def add_totals(self, successes: int, amount_msat: int, fee_msat: int):
+        """Add rebalances that were done before the history existed."""
+        with self.lock:
+            self.db.execute(ADD_TOTALS, (successes, amount_msat, fee_msat))
+            self.db.commit()
+
+    def totals(self):
+        """Successful rebalances of all time, with their amount and fee."""
+        with self.lock:
+            row = self.db.execute(
+                """SELECT t.successes + a.successes,
+                    t.amount_msat + a.amount_msat,
+                    t.fee_msat + a.fee_msat
+                FROM totals t, (
+                    SELECT COUNT(*) AS successes,
+                        COALESCE(SUM(amount_msat), 0) AS amount_msat,
+                        COALESCE(SUM(fee_msat), 0) AS fee_msat
+                    FROM attempts WHERE status = 'complete'
+                ) a"""
+            ).fetchone()
+        return {"successes": row[0], "amount_msat": row[1], "fee_msat": row[2]}
+
+    def summary(self):
+        """Attempts and successes of the last `days`."""
+        with self.lock:
+            stats = list(self.pairs.values())
+        return {
+            "attempts": sum(s.attempts for s in stats),
+            "successes": sum(s.successes for s in stats),
+        }
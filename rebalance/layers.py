@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+from pyln.client import RpcError
+import threading
+import time
+
+
+def disable(rpc, layer: str, exclude: str):
+    # excludes are either `scid/direction` or node ids
+    if "/" in exclude:
+        rpc.call("askrene-update-channel", [layer, exclude, False])
+    else:
+        rpc.call("askrene-disable-node", [layer, exclude])
+
+
+def recreate(rpc, layer: str):
+    try:
+        rpc.call("askrene-remove-layer", [layer])
+    except RpcError:
+        pass
+    rpc.call("askrene-create-layer", [layer])
+
+
+class AttemptLayer:
+    """
+    askrene layer with the excludes of a single rebalance attempt.
+
+    Created on first use and kept for the whole attempt, `exclude` only
+    sends the excludes that aren't in the layer yet.
+    """
+
+    def __init__(self, rpc, name: str):
+        self.rpc = rpc
+        self.name = name
+        self.applied = set()
+        self.created = False
+
+    def exclude(self, excludes: list):
+        if not self.created:
+            recreate(self.rpc, self.name)
+            self.created = True
+        for exclude in excludes:
+            if exclude not in self.applied:
+                disable(self.rpc, self.name, exclude)
+                self.applied.add(exclude)
+
+    def close(self):
+        if not self.created:
+            return
+        self.created = False
+        try:
+            self.rpc.call("askrene-remove-layer", [self.name])
+        except RpcError:
+            pass
+
+
+class KnownBadLayer:
+    """
+    askrene layer of nodes and channels to avoid, shared by all threads.
+
+    Entries expire after `ttl` seconds. askrene can't enable a disabled
+    node again, so when some of them expired, the remaining entries are
+    put into a new layer with a fresh name. The old layer is removed
+    once no `getroutes` started with `use` still refers to it.
+    """
+
+    def __init__(self, rpc, name: str = "rebalance-known-bad", ttl: float = 600):
+        self.rpc = rpc
+        self.prefix = name
+        self.name = name
+        self.generation = 0
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expiries = {}
+        self.users = {}
+        self.created = False
+
+    def _ensure(self):
+        if not self.created:
+            recreate(self.rpc, self.name)
+            for exclude in self.expiries:
+                disable(self.rpc, self.name, exclude)
+            self.created = True
+
+    def _retire(self, name: str):
+        if name != self.name and name not in self.users:
+            try:
+                self.rpc.call("askrene-remove-layer", [name])
+            except RpcError:
+                pass
+
+    def add(self, exclude: str):
+        with self.lock:
+            self._ensure()
+            if exclude not in self.expiries:
+                disable(self.rpc, self.name, exclude)
+            self.expiries[exclude] = time.time() + self.ttl
+
+    def expire(self):
+        """Drop expired entries, and make sure the layer exists."""
+        with self.lock:
+            now = time.time()
+            expired = [e for e, t in self.expiries.items() if t <= now]
+            for exclude in expired:
+                del self.expiries[exclude]
+            if expired and self.created:
+                old = self.name
+                self.generation += 1
+                self.name = f"{self.prefix}-{self.generation}"
+                self.created = False
+                self._ensure()
+                self._retire(old)
+            else:
+                self._ensure()
+
+    @contextmanager
+    def use(self):
+        """Expire entries and yield the name of the layer to use.
+
+        The layer stays in askrene until the block is left, even if it
+        is replaced in the meantime.
+        """
+        self.expire()
+        with self.lock:
+            name = self.name
+            self.users[name] = self.users.get(name, 0) + 1
+        try:
+            yield name
+        finally:
+            with self.lock:
+                self.users[name] -= 1
+                if self.users[name] == 0:
+                    del self.users[name]
+                    self._retire(name)
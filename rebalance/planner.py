@@ -0,0 +1,103 @@
+from collections import deque
+
+
+def min_cost_flow(supply: dict, demand: dict, cost) -> dict:
+    """
+    Route as much of `supply` to `demand` as possible, at minimum cost.
+
+    `supply` and `demand` map channels to amounts, `cost(src, dst)` is the
+    cost per unit of moving liquidity from `src` to `dst`, or None if that
+    isn't possible. Every supplying channel can send to every demanding
+    one, so the network is bipartite. It is solved with successive
+    shortest paths, each found with SPFA over the residual network, in
+    which moved liquidity may be routed back at a negative cost.
+
+    Returns the flow as a dict of (src, dst) to amount.
+    """
+    supply = {src: amount for src, amount in supply.items() if amount > 0}
+    demand = {dst: amount for dst, amount in demand.items() if amount > 0}
+    costs = {}
+    for src in supply:
+        for dst in demand:
+            if src != dst:
+                c = cost(src, dst)
+                if c is not None:
+                    costs.setdefault(src, {})[dst] = c
+    # flow into each dst by src, to find the backward edges
+    inflow = {dst: {} for dst in demand}
+
+    while supply and demand:
+        # nodes are ("s", src) and ("d", dst), all sources with remaining
+        # supply start at distance 0
+        dist = {("s", src): 0 for src in supply}
+        prev = {}
+        queue = deque(dist)
+        queued = set(dist)
+        while queue:
+            node = queue.popleft()
+            queued.discard(node)
+            side, name = node
+            if side == "s":
+                edges = [(("d", dst), c) for dst, c in costs.get(name, {}).items()]
+            else:
+                edges = [(("s", src), -costs[src][name]) for src in inflow[name]]
+            for nxt, c in edges:
+                if nxt not in dist or dist[node] + c < dist[nxt]:
+                    dist[nxt] = dist[node] + c
+                    prev[nxt] = node
+                    if nxt not in queued:
+                        queue.append(nxt)
+                        queued.add(nxt)
+
+        reachable = [dst for dst in demand if ("d", dst) in dist]
+        if not reachable:
+            break
+        end = min(reachable, key=lambda dst: dist[("d", dst)])
+
+        # walk back to the source, collecting the bottleneck
+        path = []
+        node = ("d", end)
+        while node in prev:
+            path.append((prev[node], node))
+            node = prev[node]
+        start = node[1]
+        amount = min(supply[start], demand[end])
+        for (side, a), (_, b) in path:
+            if side == "d":
+                # a backward edge, undoing flow from b to a
+                amount = min(amount, inflow[a][b])
+
+        for (side, a), (_, b) in path:
+            if side == "s":
+                inflow[b][a] = inflow[b].get(a, 0) + amount
+            else:
+                inflow[a][b] -= amount
+                if inflow[a][b] == 0:
+                    del inflow[a][b]
+        supply[start] -= amount
+        if supply[start] == 0:
+            del supply[start]
+        demand[end] -= amount
+        if demand[end] == 0:
+            del demand[end]
+    return {(src, dst): f for dst, srcs in inflow.items() for src, f in srcs.items()}
+
+
+def plan(balances: dict, cost, min_amount: int = 0) -> list:
+    """
+    Moves that bring all channels closer to their target, cheapest first.
+
+    `balances` maps channels to their surplus, if positive, or deficit,
+    if negative. Moves smaller than `min_amount` are left out. Returns a
+    list of (src, dst, amount, cost per unit) tuples.
+    """
+    supply = {ch: amount for ch, amount in balances.items() if amount > 0}
+    demand = {ch: -amount for ch, amount in balances.items() if amount < 0}
+    flow = min_cost_flow(supply, demand, cost)
+    moves = [
+        (src, dst, amount, cost(src, dst))
+        for (src, dst), amount in flow.items()
+        if amount >= min_amount
+    ]
+    moves.sort(key=lambda m: (m[3], -m[2]))
+    return moves
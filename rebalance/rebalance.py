@@ -7,28 +7,30 @@
 # ]
 # ///
 
+from caches import AliasCache, ChannelCache, PolicyCache
 from clnutils import cln_parse_rpcversion
+from history import History, fee_ppm, probability
+from layers import AttemptLayer, KnownBadLayer
+from planner import plan
+from scheduler import PairScheduler
 from datetime import timedelta
+from collections import namedtuple
 from functools import reduce
 from pyln.client import Plugin, Millisatoshi, RpcError
 import threading
 import time
 import uuid
 import concurrent.futures
+import os
 
 plugin = Plugin()
 plugin.rebalance_stop_by_user = False
-plugin.rebalance_stop_by_thread = False
-plugin.rebalance_stop_by_event = False
+plugin.scheduler = None
 plugin.threadids = {}
 
 
 def rebalance_stopping():
-    return (
-        plugin.rebalance_stop_by_user
-        or plugin.rebalance_stop_by_thread
-        or plugin.rebalance_stop_by_event
-    )
+    return plugin.rebalance_stop_by_user
 
 
 def get_thread_id_str():
@@ -91,6 +93,13 @@ def route_get_scid(r):
             return r["channel"]
 
 
+def route_get_direction(r):
+    scidd = r.get("short_channel_id_dir")
+    if scidd:
+        return int(scidd.split("/")[1])
+    return r.get("direction")
+
+
 def getroutes_to_sendpay(route, msat):
     if not route_uses_modern_fields(route[0]):
         sendpay_route = []
@@ -119,7 +128,7 @@ def setup_routing_fees(route, msat):
     route_set_out_msat(r, msat)
     route_set_delay(r, delay)
     node_id_out = route_get_id(route[-2])
-    channels = plugin.rpc.listpeerchannels(node_id_out).get("channels")
+    channels = plugin.channels.peer_channels(node_id_out)
     scid = route_get_scid(r)
     ch = next(
         c["updates"]["remote"]
@@ -140,9 +149,12 @@ def setup_routing_fees(route, msat):
         route_set_out_msat(r, msat)
         scid = route_get_scid(r)
         route_set_delay(r, delay)
-        channels = plugin.rpc.listchannels(scid).get("channels")
         node_id_out = route_get_id(r)
-        ch = next(c for c in channels if c["destination"] == node_id_out)
+        ch = plugin.policies.get(scid, route_get_direction(r), node_id_out)
+        if ch is None:
+            raise RpcError(
+                "rebalance", {}, {"message": f"No policy known for channel {scid}"}
+            )
         fee = Millisatoshi(ch["base_fee_millisatoshi"])
         # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
         fee += (
@@ -160,7 +172,7 @@ def setup_routing_fees(route, msat):
 
 
 def get_channel(payload, peer_id, scid, check_state: bool = False):
-    channels = plugin.rpc.listpeerchannels(peer_id)["channels"]
+    channels = plugin.channels.peer_channels(peer_id)
     channel = next(c for c in channels if c.get("short_channel_id") == scid)
     if check_state:
         if channel["state"] != "CHANNELD_NORMAL":
@@ -182,18 +194,16 @@ def get_channel(payload, peer_id, scid, check_state: bool = False):
 
 
 def amounts_from_scid(scid):
-    channels = plugin.rpc.listfunds().get("channels")
-    channel = next(c for c in channels if c.get("short_channel_id") == scid)
-    our_msat = Millisatoshi(channel["our_amount_msat"])
-    total_msat = Millisatoshi(channel["amount_msat"])
+    channel = plugin.channels.get(scid)
+    our_msat = Millisatoshi(channel["to_us_msat"])
+    total_msat = Millisatoshi(channel["total_msat"])
     return our_msat, total_msat
 
 
 def peer_from_scid(short_channel_id, my_node_id, payload):
-    channels = plugin.rpc.listpeerchannels().get("channels")
-    for ch in channels:
-        if ch.get("short_channel_id") == short_channel_id:
-            return ch["peer_id"]
+    ch = plugin.channels.get(short_channel_id)
+    if ch is not None:
+        return ch["peer_id"]
     raise RpcError(
         "rebalance",
         payload,
@@ -202,33 +212,54 @@ def peer_from_scid(short_channel_id, my_node_id, payload):
 
 
 def get_node_alias(node_id):
-    node = plugin.rpc.listnodes(node_id)["nodes"]
-    s = ""
-    if len(node) != 0 and "alias" in node[0]:
-        s += node[0]["alias"]
-    else:
-        s += node_id[0:7]
-    return s
+    return plugin.aliases.get(node_id)
+
+
+def record_attempt(payload, attempt: dict, result: dict):
+    fee = result.get("fee")
+    plugin.history.record(
+        started_at=attempt["started_at"],
+        outgoing_scid=payload["outgoing_scid"],
+        incoming_scid=payload["incoming_scid"],
+        amount_msat=int(attempt["msatoshi"]),
+        status=result.get("status"),
+        fee_msat=None if fee is None else int(fee),
+        hops=result.get("hops", attempt.get("hops")),
+        parts=result.get("parts"),
+        message=result.get("message"),
+        erring_channel=attempt.get("erring_channel"),
+        erring_node=attempt.get("erring_node"),
+    )
 
 
-def cleanup(label, payload, rpc_result, error=None):
+def cleanup(label, payload, rpc_result, error=None, attempt=None):
     try:
         plugin.rpc.delinvoice(label, "unpaid")
     except RpcError as e:
         # race condition: waitsendpay timed out, but invoice get paid
         if "status is paid" in e.error.get("message", ""):
+            if attempt is not None and rpc_result is not None:
+                record_attempt(payload, attempt, rpc_result)
             return rpc_result
 
     if error is not None:
         if isinstance(error, RpcError):
             # unwrap rebalance errors as 'normal' RPC result
             if error.method == "rebalance":
-                return {
+                rpc_result = {
                     "status": "exception",
                     "message": error.error.get("message", "error not given"),
                 }
-        raise error
+                error = None
+        if error is not None:
+            if attempt is not None:
+                record_attempt(
+                    payload, attempt, {"status": "exception", "message": str(error)}
+                )
+            raise error
 
+    if attempt is not None:
+        record_attempt(payload, attempt, rpc_result)
     return rpc_result
 
 
@@ -285,42 +316,41 @@ class NoRouteException(Exception):
     pass
 
 
+# BOLT #4 failure code flags
+PERM = 0x4000
+NODE = 0x2000
+
+
 def getroutes(
-    targetid, fromid, excludes, amount_msat: Millisatoshi, maxfee_msat: Millisatoshi
+    targetid,
+    fromid,
+    layer: AttemptLayer,
+    excludes,
+    amount_msat: Millisatoshi,
+    maxfee_msat: Millisatoshi,
+    maxparts: int = 1,
+    extra_layers: tuple = (),
 ):
     if fromid == targetid:
         raise NoRouteException
-    if len(excludes) > 0:
-        layer = str(fromid) + "-" + str(targetid)
-        try:
-            plugin.rpc.call("askrene-remove-layer", [layer])
-        except RpcError:
-            pass
-
-        plugin.rpc.call("askrene-create-layer", [layer])
-
-        for exclude in excludes:
-            if "/" in exclude:
-                plugin.rpc.call("askrene-update-channel", [layer, exclude, False])
-            else:
-                plugin.rpc.call("askrene-disable-node", [layer, exclude])
+    # only new excludes are sent to the layers
+    layer.exclude(excludes)
 
     try:
         """ This does not make special assumptions and tries all routes
             it gets. Uses less CPU and does not filter any routes.
         """
-        layers = ["xpay"]
-        if layer:
-            layers.append(layer)
-        return plugin.rpc.getroutes(
-            source=fromid,
-            destination=targetid,
-            amount_msat=amount_msat,
-            layers=layers,
-            maxfee_msat=maxfee_msat,
-            final_cltv=9,
-            maxparts=1,
-        )
+        with plugin.known_bad.use() as known_bad:
+            layers = ["xpay", known_bad, layer.name, *extra_layers]
+            return plugin.rpc.getroutes(
+                source=fromid,
+                destination=targetid,
+                amount_msat=amount_msat,
+                layers=layers,
+                maxfee_msat=maxfee_msat,
+                final_cltv=9,
+                maxparts=maxparts,
+            )
     except RpcError as e:
         # could not find route -> change params and restart loop
         if e.method == "getroutes" and e.error.get("code") == 205:
@@ -328,11 +358,262 @@ def getroutes(
         raise e
 
 
-def waitsendpay(payment_hash, start_ts, retry_for):
+RouteEnds = namedtuple(
+    "RouteEnds", "my_node_id outgoing_node_id incoming_node_id out_alias in_alias"
+)
+
+
+def build_route(route_mid, msatoshi: Millisatoshi, ends: RouteEnds):
+    # close the circle: our outgoing channel, the getroutes path, our incoming channel
+    id_field = (
+        "node_id_out" if route_uses_modern_fields(route_mid[0]) else "next_node_id"
+    )
+    route_out = {
+        id_field: ends.outgoing_node_id,
+        "short_channel_id_dir": ends.out_alias
+        + "/"
+        + str(int(not ends.my_node_id < ends.outgoing_node_id)),
+    }
+    route_in = {
+        id_field: ends.my_node_id,
+        "short_channel_id_dir": ends.in_alias
+        + "/"
+        + str(int(not ends.incoming_node_id < ends.my_node_id)),
+    }
+    route = [route_out] + route_mid + [route_in]
+    setup_routing_fees(route, msatoshi)
+    return getroutes_to_sendpay(route, msatoshi)
+
+
+def log_route(route_mid, route, fees: Millisatoshi, msatoshi: Millisatoshi, ends):
+    midroute_str = reduce(
+        lambda x, y: x + " -> " + y,
+        map(
+            lambda r: get_node_alias(route_get_id(r)),
+            route_mid,
+        ),
+    )
+    full_route_str = "%s -> %s -> %s -> %s" % (
+        get_node_alias(ends.my_node_id),
+        get_node_alias(ends.outgoing_node_id),
+        midroute_str,
+        get_node_alias(ends.my_node_id),
+    )
+    plugin.log(
+        f"Thread{get_thread_id_str()} {len(route)} hops and {fees.to_satoshi_str()} fees for {msatoshi.to_satoshi_str()} along route: {full_route_str}"
+    )
+    for r in route:
+        node_id = route_get_id(r)
+        scid = route_get_scid(r)
+        plugin.log(
+            "    - %s  %14s  %s" % (node_id, scid, route_get_msat(r)),
+            "debug",
+        )
+
+
+def is_local_node(node_id):
+    return node_id == plugin.getinfo["id"] or bool(
+        plugin.channels.peer_channels(node_id)
+    )
+
+
+def handle_sendpay_error(
+    e, payload, outgoing_scid, incoming_scid, excludes, nodes, attempt
+):
+    # raises if the rebalance can't succeed anymore, else updates excludes
+    # plugin.log(f"RpcError: {str(e)}", 'debug')
+    # check if we ran into the `rpc.waitsendpay` timeout
+    if e.method == "waitsendpay" and e.error.get("code") == 200:
+        raise RpcError("rebalance", payload, {"message": "Timeout reached"})
+    # check if we have problems with our own channels
+    erring_node = e.error.get("data", {}).get("erring_node")
+    erring_channel = e.error.get("data", {}).get("erring_channel")
+    erring_direction = e.error.get("data", {}).get("erring_direction")
+    # remember where the last route failed, for the history
+    attempt["erring_node"] = erring_node
+    attempt["erring_channel"] = erring_channel
+    if erring_channel == incoming_scid:
+        plugin.log(f"Error with incoming channel: {e}")
+        raise RpcError("rebalance", payload, {"message": "Error with incoming channel"})
+    if erring_channel == outgoing_scid:
+        plugin.log(f"Error with outgoing channel: {e}")
+        raise RpcError("rebalance", payload, {"message": "Error with outgoing channel"})
+    plugin.log(f"Other sendpay error: {e}", "debug")
+    # the error may carry a newer channel_update
+    if erring_channel is not None:
+        plugin.policies.invalidate(erring_channel)
+    # exclude other erroring channels
+    if erring_channel is not None and erring_direction is not None:
+        scidd = erring_channel + "/" + str(erring_direction)
+        err_amount_msat = e.error.get("data", {}).get("amount_msat")
+        askrene_constraint_xpay(scidd, err_amount_msat)
+    # let all threads avoid permanently failing nodes and channels, but
+    # never our own node, our peers or our channels, that would block
+    # every rebalance through them
+    failcode = e.error.get("data", {}).get("failcode", 0)
+    if failcode & PERM:
+        if failcode & NODE and erring_node:
+            if not is_local_node(erring_node):
+                plugin.known_bad.add(erring_node)
+        elif erring_channel is not None and erring_direction is not None:
+            if plugin.channels.get(erring_channel) is None:
+                plugin.known_bad.add(scidd)
+    # count and exclude nodes that produce a lot of errors, only for this
+    # attempt
+    if erring_node and plugin.erringnodes > 0:
+        if nodes.get(erring_node) is None:
+            nodes[erring_node] = 0
+        nodes[erring_node] += 1
+        if nodes[erring_node] >= plugin.erringnodes:
+            excludes.append(erring_node)
+
+
+def reached_final_hop(data: dict, hops: int):
+    # our own node as final destination rejects the random payment hash,
+    # a local failure at our outgoing channel reports our node id as well
+    return data.get("erring_index") == hops or data.get("failcode") == PERM | 15
+
+
+def learn_from_probe(route_mid, hops: int, error):
+    # feed the probe outcome into askrene, a probe that reached the final hop
+    # shows that all channels could forward the amount
+    if not isinstance(error, RpcError):
+        return
+    data = error.error.get("data", {})
+    if reached_final_hop(data, hops):
+        for r in route_mid:
+            plugin.rpc.call(
+                "askrene-inform-channel",
+                [
+                    "xpay",
+                    r["short_channel_id_dir"],
+                    data.get("amount_msat"),
+                    "unconstrained",
+                ],
+            )
+    elif (
+        data.get("erring_index") != 0
+        and data.get("erring_channel") is not None
+        and data.get("erring_direction") is not None
+    ):
+        scidd = data["erring_channel"] + "/" + str(data["erring_direction"])
+        askrene_constraint_xpay(scidd, data.get("amount_msat"))
+
+
+def probe_count(outgoing_scid, incoming_scid, msat: Millisatoshi):
+    # probes that are still pending lock the amount on both of our channels
+    # while the payment is sent, so the probes other than the winner and the
+    # payment itself must fit at once
+    out_ch = plugin.channels.get(outgoing_scid) or {}
+    in_ch = plugin.channels.get(incoming_scid) or {}
+    fits = min(
+        int(Millisatoshi(out_ch.get("spendable_msat", 0))),
+        int(Millisatoshi(in_ch.get("receivable_msat", 0))),
+    ) // max(int(msat), 1)
+    return max(1, min(plugin.probes, fits))
+
+
+def probe_routes(
+    ends: RouteEnds,
+    layer: AttemptLayer,
+    excludes: list,
+    msatoshi: Millisatoshi,
+    maxfee_msat: Millisatoshi,
+    probes: int,
+):
+    # Asks for up to `probes` different routes and sends a probe with a random
+    # payment hash over each of them at once. Returns the path of the first
+    # probe that reached our node, or None if none did. The other probes fail
+    # in the background, only those sharing a channel with the winning route
+    # are waited for, so they don't hold liquidity the payment needs.
+    candidates = []
+    probe_layer = AttemptLayer(plugin.rpc, layer.name + "-probe")
+    try:
+        probe_layer.exclude([])
+        for _ in range(probes):
+            try:
+                r = getroutes(
+                    targetid=ends.incoming_node_id,
+                    fromid=ends.outgoing_node_id,
+                    layer=layer,
+                    excludes=excludes,
+                    amount_msat=msatoshi,
+                    maxfee_msat=maxfee_msat,
+                    extra_layers=(probe_layer.name,),
+                )
+            except NoRouteException:
+                break
+            route_mid = r["routes"][0]["path"]
+            candidates.append(route_mid)
+            if len(candidates) < probes:
+                # avoid the middle channel to get a different next route
+                probe_layer.exclude(
+                    [route_mid[len(route_mid) // 2]["short_channel_id_dir"]]
+                )
+    finally:
+        probe_layer.close()
+    if len(candidates) == 0:
+        raise NoRouteException
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {}
+    for route_mid in candidates:
+        route = build_route(route_mid, msatoshi, ends)
+        payment_hash = os.urandom(32).hex()
+        try:
+            plugin.rpc.sendpay(route, payment_hash)
+        except RpcError as e:
+            plugin.log(
+                f"Thread{get_thread_id_str()} probe could not be sent: {e}", "debug"
+            )
+            continue
+        future = executor.submit(plugin.rpc.waitsendpay, payment_hash, 60)
+        future.add_done_callback(
+            lambda f, route_mid=route_mid, hops=len(route): learn_from_probe(
+                route_mid, hops, f.exception()
+            )
+        )
+        futures[future] = (route_mid, len(route))
+    executor.shutdown(wait=False)
+    winner = None
+    pending = set(futures)
+    for future in concurrent.futures.as_completed(futures):
+        pending.discard(future)
+        route_mid, hops = futures[future]
+        error = future.exception()
+        if isinstance(error, RpcError) and reached_final_hop(
+            error.error.get("data", {}), hops
+        ):
+            winner = route_mid
+            break
+    if winner is not None:
+        channels = {r["short_channel_id_dir"] for r in winner}
+        concurrent.futures.wait(
+            [
+                f
+                for f in pending
+                if any(r["short_channel_id_dir"] in channels for r in futures[f][0])
+            ]
+        )
+    if winner is None:
+        plugin.log(
+            f"Thread{get_thread_id_str()} none of {len(futures)} probes reached the final hop",
+            "debug",
+        )
+    else:
+        plugin.log(
+            f"Thread{get_thread_id_str()} probe reached the final hop, "
+            f"{len(futures)} routes probed",
+            "debug",
+        )
+    return winner
+
+
+def waitsendpay(payment_hash, start_ts, retry_for, partid=None, groupid=None):
     while True:
         try:
             timeout = min(max(retry_for + start_ts - int(time.time()), 0), 10)
-            result = plugin.rpc.waitsendpay(payment_hash, timeout)
+            result = plugin.rpc.waitsendpay(payment_hash, timeout, partid, groupid)
             return result
         except RpcError as e:
             if e.method == "waitsendpay" and e.error.get("code") == 200:
@@ -344,6 +625,155 @@ def waitsendpay(payment_hash, start_ts, retry_for):
                 raise e
 
 
+def rebalance_mpp(
+    payload,
+    ends: RouteEnds,
+    layer: AttemptLayer,
+    excludes: list,
+    nodes: dict,
+    msatoshi: Millisatoshi,
+    maxfee_msat: Millisatoshi,
+    remote_updates: dict,
+    payment_hash,
+    payment_secret,
+    start_ts: int,
+    maxparts: int,
+    attempt: dict,
+):
+    # Sends the amount in up to `maxparts` parts at once, all under the same
+    # invoice. Failed parts are routed again until all parts arrived, and we
+    # release the preimage, or we run out of time or routes.
+    retry_for = payload["retry_for"]
+    groupid = uuid.uuid4().int >> 64
+    partid = 0
+    remaining = msatoshi
+    fees_inflight = Millisatoshi(0)
+    inflight = {}
+    hops = 0
+    settled = 0
+    complete = False
+    error = None
+    executor = concurrent.futures.ThreadPoolExecutor()
+
+    def part_failed(e):
+        # updates the excludes, or returns why the rebalance can't succeed
+        try:
+            handle_sendpay_error(
+                e,
+                payload,
+                payload["outgoing_scid"],
+                payload["incoming_scid"],
+                excludes,
+                nodes,
+                attempt,
+            )
+        except RpcError as fatal:
+            return fatal.error.get("message")
+        return None
+
+    try:
+        while inflight or (remaining > Millisatoshi(0) and error is None):
+            if remaining > Millisatoshi(0) and error is None:
+                if int(time.time()) - start_ts >= retry_for or rebalance_stopping():
+                    error = "Timeout reached"
+                    continue
+                # keep room for the last hop, paid once per part
+                last_fee = Millisatoshi(
+                    remote_updates["fee_base_msat"] * maxparts
+                    + int(remaining)
+                    * remote_updates["fee_proportional_millionths"]
+                    // 1_000_000
+                )
+                if maxfee_msat <= fees_inflight + last_fee:
+                    error = "No suitable routes found"
+                    continue
+                try:
+                    r = getroutes(
+                        targetid=ends.incoming_node_id,
+                        fromid=ends.outgoing_node_id,
+                        layer=layer,
+                        excludes=excludes,
+                        amount_msat=remaining,
+                        maxfee_msat=maxfee_msat - fees_inflight - last_fee,
+                        maxparts=maxparts,
+                    )
+                except NoRouteException:
+                    error = "No suitable routes found"
+                    continue
+                resend = False
+                for part in r["routes"]:
+                    amount = Millisatoshi(part["amount_msat"])
+                    route = build_route(part["path"], amount, ends)
+                    fee = route_get_msat(route[0]) - amount
+                    log_route(part["path"], route, fee, amount, ends)
+                    partid += 1
+                    try:
+                        plugin.rpc.sendpay(
+                            route,
+                            payment_hash,
+                            amount_msat=msatoshi,
+                            payment_secret=payment_secret,
+                            partid=partid,
+                            groupid=groupid,
+                        )
+                    except RpcError as e:
+                        # the part can fail right away, e.g. at the first hop
+                        error = part_failed(e)
+                        if error is not None:
+                            break
+                        resend = True
+                        continue
+                    future = executor.submit(
+                        waitsendpay, payment_hash, start_ts, retry_for, partid, groupid
+                    )
+                    inflight[future] = (amount, fee, len(route))
+                    remaining -= amount
+                    fees_inflight += fee
+                if resend:
+                    # the parts in flight can't arrive without this amount
+                    continue
+
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                amount, fee, length = inflight.pop(future)
+                try:
+                    if future.result().get("status") == "complete":
+                        complete = True
+                        settled += 1
+                        hops = max(hops, length)
+                        continue
+                except RpcError as e:
+                    if complete:
+                        # can't happen once we released the preimage
+                        raise e
+                    # parts still in flight fail once we time out the set
+                    error = part_failed(e) or error
+                remaining += amount
+                fees_inflight -= fee
+    finally:
+        executor.shutdown(wait=False)
+
+    if not complete:
+        if error is None:
+            error = "Timeout reached"
+        raise RpcError("rebalance", payload, {"message": error})
+    fees = fees_inflight
+    return {
+        "sent": msatoshi + fees,
+        "received": msatoshi,
+        "fee": fees,
+        "fee_percentage": f"{fees / msatoshi * 100:.3}%",
+        "hops": hops,
+        "parts": settled,
+        "outgoing_scid": payload["outgoing_scid"],
+        "incoming_scid": payload["incoming_scid"],
+        "status": "complete",
+        "message": f"{msatoshi + fees} sent in {settled} parts to rebalance {msatoshi}",
+    }
+
+
 @plugin.method("rebalance")
 def rebalance(
     plugin,
@@ -353,13 +783,16 @@ def rebalance(
     retry_for: int = 60,
     maxfeepercent: float = 0.5,
     exemptfee: Millisatoshi = Millisatoshi(5000),
+    maxparts: int = None,
 ):
     """Rebalancing channel liquidity with circular payments.
 
     This tool helps to move some msatoshis between your channels.
+    With maxparts > 1 the amount may be split into several parts.
     """
     if msatoshi:
         msatoshi = Millisatoshi(msatoshi)
+    maxparts = plugin.maxparts if maxparts is None else int(maxparts)
     retry_for = int(retry_for)
     maxfeepercent = float(maxfeepercent)
     exemptfee = Millisatoshi(exemptfee)
@@ -414,6 +847,7 @@ def rebalance(
     )
 
     start_ts = int(time.time())
+    attempt = {"started_at": time.time(), "msatoshi": msatoshi}
     label = "Rebalance-" + str(uuid.uuid4())
     description = "%s to %s" % (outgoing_scid, incoming_scid)
     invoice = plugin.rpc.invoice(msatoshi, label, description, retry_for + 60)
@@ -422,6 +856,10 @@ def rebalance(
     payment_secret = invoice.get("payment_secret")
 
     rpc_result = None
+    ends = RouteEnds(
+        my_node_id, outgoing_node_id, incoming_node_id, out_alias, in_alias
+    )
+    layer = AttemptLayer(plugin.rpc, label)
     excludes = [my_node_id]  # excude all own channels to prevent shortcuts
     nodes = {}  # here we store erring node counts
 
@@ -432,22 +870,53 @@ def rebalance(
     time_sendpay = 0
 
     try:
+        if maxparts > 1:
+            rpc_result = rebalance_mpp(
+                payload,
+                ends,
+                layer,
+                excludes,
+                nodes,
+                msatoshi,
+                maxfee_msat,
+                remote_udpates,
+                payment_hash,
+                payment_secret,
+                start_ts,
+                maxparts,
+                attempt,
+            )
+            return cleanup(label, payload, rpc_result, attempt=attempt)
         while int(time.time()) - start_ts < retry_for and not rebalance_stopping():
             count += 1
             try:
                 time_start = time.time()
-                r = getroutes(
-                    targetid=incoming_node_id,
-                    fromid=outgoing_node_id,
-                    excludes=excludes,
-                    amount_msat=msatoshi,
-                    maxfee_msat=maxfee_msat - last_fee_msat,
-                )
+                if plugin.probes > 0:
+                    route_mid = probe_routes(
+                        ends,
+                        layer,
+                        excludes,
+                        msatoshi,
+                        maxfee_msat - last_fee_msat,
+                        probe_count(
+                            outgoing_scid, incoming_scid, msatoshi + maxfee_msat
+                        ),
+                    )
+                else:
+                    r = getroutes(
+                        targetid=incoming_node_id,
+                        fromid=outgoing_node_id,
+                        layer=layer,
+                        excludes=excludes,
+                        amount_msat=msatoshi,
+                        maxfee_msat=maxfee_msat - last_fee_msat,
+                    )
+                    route_mid = r["routes"][0]["path"]
                 time_getroutes += time.time() - time_start
             except NoRouteException:
                 # no more chance for a successful getroutes
                 rpc_result = {"status": "error", "message": "No suitable routes found"}
-                return cleanup(label, payload, rpc_result)
+                return cleanup(label, payload, rpc_result, attempt=attempt)
             except RpcError as e:
                 # getroutes can be successful next time with different parameters
                 if e.method == "getroutes" and e.error.get("code") == 205:
@@ -455,28 +924,12 @@ def rebalance(
                 else:
                     raise e
 
-            route_mid = r["routes"][0]["path"]
-            id_field = (
-                "node_id_out"
-                if route_uses_modern_fields(route_mid[0])
-                else "next_node_id"
-            )
-            route_out = {
-                id_field: outgoing_node_id,
-                "short_channel_id_dir": out_alias
-                + "/"
-                + str(int(not my_node_id < outgoing_node_id)),
-            }
-            route_in = {
-                id_field: my_node_id,
-                "short_channel_id_dir": in_alias
-                + "/"
-                + str(int(not incoming_node_id < my_node_id)),
-            }
-            route = [route_out] + route_mid + [route_in]
-            setup_routing_fees(route, msatoshi)
-            route = getroutes_to_sendpay(route, msatoshi)
+            if route_mid is None:
+                # the probes told askrene where the routes failed, try again
+                continue
+            route = build_route(route_mid, msatoshi, ends)
             fees = route_get_msat(route[0]) - msatoshi
+            attempt["hops"] = len(route)
 
             rpc_result = {
                 "sent": msatoshi + fees,
@@ -489,29 +942,7 @@ def rebalance(
                 "status": "complete",
                 "message": f"{msatoshi + fees} sent over {len(route)} hops to rebalance {msatoshi}",
             }
-            midroute_str = reduce(
-                lambda x, y: x + " -> " + y,
-                map(
-                    lambda r: get_node_alias(route_get_id(r)),
-                    route_mid,
-                ),
-            )
-            full_route_str = "%s -> %s -> %s -> %s" % (
-                get_node_alias(my_node_id),
-                get_node_alias(outgoing_node_id),
-                midroute_str,
-                get_node_alias(my_node_id),
-            )
-            plugin.log(
-                f"Thread{get_thread_id_str()} {len(route)} hops and {fees.to_satoshi_str()} fees for {msatoshi.to_satoshi_str()} along route: {full_route_str}"
-            )
-            for r in route:
-                node_id = route_get_id(r)
-                scid = route_get_scid(r)
-                plugin.log(
-                    "    - %s  %14s  %s" % (node_id, scid, route_get_msat(r)),
-                    "debug",
-                )
+            log_route(route_mid, route, fees, msatoshi, ends)
 
             time_start = time.time()
             count_sendpay += 1
@@ -523,7 +954,7 @@ def rebalance(
                     rpc_result["stats"] = (
                         f"running_for:{int(time.time()) - start_ts}  count_getroutes:{count}  time_getroutes:{time_getroutes}  time_getroutes_avg:{time_getroutes / count}  count_sendpay:{count_sendpay}  time_sendpay:{time_sendpay}  time_sendpay_avg:{time_sendpay / count_sendpay}"
                     )
-                    return cleanup(label, payload, rpc_result)
+                    return cleanup(label, payload, rpc_result, attempt=attempt)
 
             except RpcError as e:
                 time_sendpay += time.time() - time_start
@@ -531,42 +962,16 @@ def rebalance(
                     f"running_for:{int(time.time()) - start_ts}  count_getroutes:{count}  time_getroutes:{time_getroutes}  time_getroutes_avg:{time_getroutes / count}  count_sendpay:{count_sendpay}  time_sendpay:{time_sendpay}  time_sendpay_avg:{time_sendpay / count_sendpay}",
                     "debug",
                 )
-                # plugin.log(f"RpcError: {str(e)}", 'debug')
-                # check if we ran into the `rpc.waitsendpay` timeout
-                if e.method == "waitsendpay" and e.error.get("code") == 200:
-                    raise RpcError("rebalance", payload, {"message": "Timeout reached"})
-                # check if we have problems with our own channels
-                erring_node = e.error.get("data", {}).get("erring_node")
-                erring_channel = e.error.get("data", {}).get("erring_channel")
-                erring_direction = e.error.get("data", {}).get("erring_direction")
-                if erring_channel == incoming_scid:
-                    plugin.log(f"Error with incoming channel: {e}")
-                    raise RpcError(
-                        "rebalance", payload, {"message": "Error with incoming channel"}
-                    )
-                if erring_channel == outgoing_scid:
-                    plugin.log(f"Error with outgoing channel: {e}")
-                    raise RpcError(
-                        "rebalance", payload, {"message": "Error with outgoing channel"}
-                    )
-                plugin.log(f"Other sendpay error: {e}", "debug")
-                # exclude other erroring channels
-                if erring_channel is not None and erring_direction is not None:
-                    scidd = erring_channel + "/" + str(erring_direction)
-                    err_amount_msat = e.error.get("data", {}).get("amount_msat")
-                    askrene_constraint_xpay(scidd, err_amount_msat)
-                # count and exclude nodes that produce a lot of errors
-                if erring_node and plugin.erringnodes > 0:
-                    if nodes.get(erring_node) is None:
-                        nodes[erring_node] = 0
-                    nodes[erring_node] += 1
-                    if nodes[erring_node] >= plugin.erringnodes:
-                        excludes.append(erring_node)
+                handle_sendpay_error(
+                    e, payload, outgoing_scid, incoming_scid, excludes, nodes, attempt
+                )
 
     except Exception as e:
-        return cleanup(label, payload, rpc_result, e)
+        return cleanup(label, payload, rpc_result, e, attempt)
+    finally:
+        layer.close()
     rpc_result = {"status": "error", "message": "Timeout reached"}
-    return cleanup(label, payload, rpc_result)
+    return cleanup(label, payload, rpc_result, attempt=attempt)
 
 
 def askrene_constraint_xpay(scidd, msat):
@@ -610,10 +1015,9 @@ def could_receive(liquidity):
 
 def get_open_channels(plugin: Plugin):
     result = []
-    channels = plugin.rpc.listpeerchannels()["channels"]
-    for ch in channels:
+    for ch in plugin.channels.channels():
         if ch["state"] == "CHANNELD_NORMAL":
-            result.append(ch)
+            result.append(dict(ch))
     return result
 
 
@@ -688,16 +1092,22 @@ def get_max_amount(i: int, plugin: Plugin):
     return max(plugin.min_amount, plugin.enough_liquidity / (4**i))
 
 
-def get_max_fee(msat: Millisatoshi):
+def get_max_fee(msat: Millisatoshi, feeratio: float = None):
     # TODO: sanity check
-    return (plugin.fee_base + msat * plugin.fee_ppm / 10**6) * plugin.feeratio
+    if feeratio is None:
+        feeratio = plugin.feeratio
+    return (plugin.fee_base + msat * plugin.fee_ppm / 10**6) * feeratio
 
 
 def get_chan(scid: str):
-    channels = plugin.rpc.listpeerchannels()["channels"]
-    for chan in channels:
-        if chan.get("short_channel_id") == scid:
-            return chan
+    return plugin.channels.get(scid)
+
+
+def get_open_chan(scid: str):
+    ch = plugin.channels.get(scid)
+    if ch is None or ch["state"] != "CHANNELD_NORMAL":
+        return None
+    return ch
 
 
 def liquidity_info(channel, enough_liquidity: Millisatoshi, ideal_ratio: float):
@@ -722,63 +1132,112 @@ def liquidity_info(channel, enough_liquidity: Millisatoshi, ideal_ratio: float):
     return liquidity
 
 
-def wait_for(success, timeout: int = 60):
-    # cyclical lambda helper
-    # taken and modified from pyln-testing/pyln/testing/utils.py
-    start_time = time.time()
-    interval = 0.25
-    while not success():
-        time_left = start_time + timeout - time.time()
-        if time_left <= 0:
-            return False
-        time.sleep(min(interval, time_left))
-        interval *= 2
-        if interval > 5:
-            interval = 5
-    return True
-
-
-def wait_for_htlcs(failed_channels: list, scids: list = None):
-    # HTLC settlement helper
-    # taken and modified from pyln-testing/pyln/testing/utils.py
-    result = True
-    peers = plugin.rpc.listpeers()["peers"]
-    for p, peer in enumerate(peers):
-        pid = peer["id"]
-        channels = []
-        if "channels" in peer:
-            channels = peer["channels"]
-        elif "num_channels" in peer and peer["num_channels"] > 0:
-            channels = plugin.rpc.listpeerchannels(peer["id"])["channels"]
-        for c, channel in enumerate(channels):
-            scid = channel.get("short_channel_id")
-            if scids is not None and scid not in scids:
-                continue
-            if scid in failed_channels:
-                result = False
-                continue
-            if "htlcs" in channel:
+def pair_amount(liquidity1, liquidity2):
+    # how much to send from the first to the second channel
+    amount1 = min(must_send(liquidity1), could_receive(liquidity2))
+    amount2 = min(should_send(liquidity1), should_receive(liquidity2))
+    amount3 = min(could_send(liquidity1), must_receive(liquidity2))
+    return max(amount1, amount2, amount3)
 
-                def lam():
-                    return (
-                        len(plugin.rpc.listpeerchannels(pid)["channels"][c]["htlcs"])
-                        == 0
-                    )
 
-                if not wait_for(lam):
-                    failed_channels.append(scid)
-                    plugin.log(
-                        f"Thread{get_thread_id_str()} timeout while waiting for htlc settlement in channel {scid}"
-                    )
-                    result = False
+def imbalance(liquidity, our: Millisatoshi):
+    # distance from the ideal liquidity, missing minimum liquidity counts twice
+    their = liquidity["our"] + liquidity["their"] - our
+    return (
+        abs(int(our) - int(liquidity["ideal"]["our"]))
+        + max(int(liquidity["min"]) - int(our), 0)
+        + max(int(liquidity["min"]) - int(their), 0)
+    )
+
+
+def estimated_fee(ch_in, msat: Millisatoshi):
+    # the peer's fee of the last hop, and our own fee for the rest of the route
+    remote = ch_in.get("updates", {}).get("remote", {})
+    fee_base = remote.get("fee_base_msat", 0) + int(plugin.fee_base)
+    fee_ppm = remote.get("fee_proportional_millionths", 0) + plugin.fee_ppm
+    return fee_base + int(msat) * fee_ppm // 10**6
+
+
+# pairs that failed this often, at this success probability, are skipped
+HOPELESS_ATTEMPTS = 5
+HOPELESS_PROBABILITY = 0.1
+# successes needed before the learned fee caps the max fee
+LEARNED_SUCCESSES = 3
+
+
+def learned_fee(stats, msat: Millisatoshi):
+    # fee of the amount at the pair's average fee rate, None until it worked
+    ppm = fee_ppm(stats)
+    if ppm is None:
+        return None
+    return int(msat) * ppm // 10**6
+
+
+def pair_score(ch1, ch2, failed_channels: set):
+    # expected liquidity gain per msat of fee
+    scid1 = ch1["short_channel_id"]
+    scid2 = ch2["short_channel_id"]
+    if (
+        scid1 in failed_channels
+        or scid2 in failed_channels
+        or (scid1, scid2) in failed_channels
+    ):
+        return None
+    stats = plugin.history.pair(scid1, scid2)
+    if (
+        stats.attempts >= HOPELESS_ATTEMPTS
+        and probability(stats) < HOPELESS_PROBABILITY
+    ):
+        return None
+    liquidity1 = liquidity_info(ch1, plugin.enough_liquidity, plugin.ideal_ratio)
+    liquidity2 = liquidity_info(ch2, plugin.enough_liquidity, plugin.ideal_ratio)
+    amount = pair_amount(liquidity1, liquidity2)
+    if amount < plugin.min_amount:
+        return None
+    amount = min(amount, get_max_amount(0, plugin))
+    gain = (
+        imbalance(liquidity1, liquidity1["our"])
+        - imbalance(liquidity1, liquidity1["our"] - amount)
+        + imbalance(liquidity2, liquidity2["our"])
+        - imbalance(liquidity2, liquidity2["our"] + amount)
+    )
+    fee = learned_fee(stats, amount)
+    if fee is None:
+        fee = estimated_fee(ch2, amount)
+    elif stats.successes >= LEARNED_SUCCESSES and fee > int(get_max_fee(amount)):
+        # this pair has always been more expensive than we would pay
+        return None
+    return probability(stats) * gain / max(fee, 1)
+
+
+def wait_for_htlcs(failed_channels: set, scids: list = None):
+    # HTLC settlement helper, woken up by notifications
+    result = True
+    if scids is None:
+        channels = plugin.channels.channels()
+    else:
+        channels = [plugin.channels.get(scid) for scid in scids]
+    for channel in channels:
+        if channel is None:
+            continue
+        scid = channel.get("short_channel_id")
+        if scid in failed_channels:
+            result = False
+            continue
+        if not plugin.channels.wait_settled(scid):
+            failed_channels.add(scid)
+            plugin.log(
+                f"Thread{get_thread_id_str()} timeout while waiting for htlc settlement in channel {scid}"
+            )
+            result = False
     return result
 
 
-def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
+def maybe_rebalance_pairs(ch1, ch2, failed_channels: set):
     scid1 = ch1["short_channel_id"]
     scid2 = ch2["short_channel_id"]
     result = {"success": False, "fee_spent": Millisatoshi(0)}
-    if scid1 + ":" + scid2 in failed_channels:
+    if (scid1, scid2) in failed_channels:
         return result
     # check if HTLCs are settled
     if not wait_for_htlcs(failed_channels, [scid1, scid2]):
@@ -787,14 +1246,17 @@ def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
     while not rebalance_stopping():
         liquidity1 = liquidity_info(ch1, plugin.enough_liquidity, plugin.ideal_ratio)
         liquidity2 = liquidity_info(ch2, plugin.enough_liquidity, plugin.ideal_ratio)
-        amount1 = min(must_send(liquidity1), could_receive(liquidity2))
-        amount2 = min(should_send(liquidity1), should_receive(liquidity2))
-        amount3 = min(could_send(liquidity1), must_receive(liquidity2))
-        amount = max(amount1, amount2, amount3)
+        amount = pair_amount(liquidity1, liquidity2)
         if amount < plugin.min_amount:
             return result
         amount = min(amount, get_max_amount(i, plugin))
         maxfee = get_max_fee(amount)
+        stats = plugin.history.pair(scid1, scid2)
+        if stats.successes >= LEARNED_SUCCESSES:
+            # don't offer much more than this pair usually costs
+            maxfee = min(
+                maxfee, Millisatoshi(max(2 * learned_fee(stats, amount), 1000))
+            )
         plugin.log(
             f"Thread{get_thread_id_str()} tries to rebalance: {scid1} -> {scid2}; amount={amount.to_satoshi_str()}; maxfee={maxfee.to_satoshi_str()}"
         )
@@ -812,7 +1274,7 @@ def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
             if not res.get("status") == "complete":
                 raise Exception  # fall into exception handler below
         except Exception:
-            failed_channels.append(scid1 + ":" + scid2)
+            failed_channels.add((scid1, scid2))
             # rebalance failed, let's try with a smaller amount
             while get_max_amount(i, plugin) >= amount and get_max_amount(
                 i, plugin
@@ -839,78 +1301,62 @@ def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
     return result
 
 
-def rebalance_pair_picker(threadid, channel_pairs: list, failed_channels: list):
+def rebalance_worker(threadid, scheduler: PairScheduler, rebalance_pair):
     plugin.threadids[threading.get_ident()] = threadid
-    result = {"success": False, "fee_spent": Millisatoshi(0)}
-    idle_count = 0
+    result = {"success": False, "fee_spent": Millisatoshi(0), "success_count": 0}
     while not rebalance_stopping():
-        idle_count += 1
-        for pair in channel_pairs:
-            if rebalance_stopping():
-                return result
-            ch1 = pair[0]
-            ch2 = pair[1]
-            processed = pair[2]
-            if processed:
-                continue
-            if ch1["lock"].acquire(blocking=False):
-                if ch2["lock"].acquire(blocking=False):
-                    idle_count = 0
-                    pair[2] = True
-                    result = maybe_rebalance_pairs(ch1, ch2, failed_channels)
-                    ch2["lock"].release()
-                ch1["lock"].release()
-            if result["success"]:
-                plugin.log(
-                    f"Thread{get_thread_id_str()} restarts rebalance threads after successful rebalance"
-                )
-                plugin.rebalance_stop_by_thread = True
-                return result
-        unprocessed = [p for p in channel_pairs if not p[2]]
-        if len(unprocessed) == 0:
-            return result
-        if idle_count == 1:
-            plugin.log(
-                f"Thread{get_thread_id_str()} is idle, {len(unprocessed)} possible channel pairs remained"
-            )
-        if idle_count > 0:
-            time.sleep(10)
+        pair = scheduler.get()
+        if pair is None:
+            break
+        ch1, ch2 = pair
+        try:
+            r = rebalance_pair(ch1, ch2)
+        finally:
+            scheduler.done(ch1["short_channel_id"], ch2["short_channel_id"])
+        if r["success"]:
+            result["success"] = True
+            result["success_count"] += 1
+            result["fee_spent"] += r["fee_spent"]
     return result
 
 
-def maybe_rebalance_once(failed_channels: list):
-    channels = get_open_channels(plugin)
-    for ch in channels:
-        ch["lock"] = threading.Lock()
-    channel_pairs = []
-    for ch1 in channels:
-        for ch2 in channels:
-            if ch1 == ch2:
-                continue
-            channel_pairs.append([ch1, ch2, False])
-
-    plugin.log(f"Start to rebalance {len(channel_pairs)} possible channel pairs")
+def run_scheduler(scheduler: PairScheduler, rebalance_pair):
+    plugin.scheduler = scheduler
+    if rebalance_stopping():
+        scheduler.stop()
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=plugin.threads)
     futures = set()
     for threadid in range(plugin.threads):
         futures.add(
-            executor.submit(
-                rebalance_pair_picker, threadid, channel_pairs, failed_channels
-            )
+            executor.submit(rebalance_worker, threadid, scheduler, rebalance_pair)
         )
-    result = {"success": False, "fee_spent": Millisatoshi(0)}
+    result = {"success": False, "fee_spent": Millisatoshi(0), "success_count": 0}
     for future in concurrent.futures.as_completed(futures):
         r2 = future.result()
-        if r2["success"]:
-            if result["success"]:
-                result["fee_spent"] += r2["fee_spent"]
-                result["success_count"] = result.get("success_count", 1) + 1
-            else:
-                result = r2
-    plugin.rebalance_stop_by_thread = False
+        result["success"] |= r2["success"]
+        result["success_count"] += r2["success_count"]
+        result["fee_spent"] += r2["fee_spent"]
+    executor.shutdown()
+    plugin.scheduler = None
     return result
 
 
+def rebalance_channels():
+    refresh_parameters()
+    return get_open_channels(plugin)
+
+
+def rebalance_scheduled(failed_channels: set):
+    scheduler = PairScheduler(
+        rebalance_channels,
+        get_open_chan,
+        lambda ch1, ch2: pair_score(ch1, ch2, failed_channels),
+    )
+    return run_scheduler(
+        scheduler, lambda ch1, ch2: maybe_rebalance_pairs(ch1, ch2, failed_channels)
+    )
+
+
 def feeadjuster_toggle(new_value: bool):
     commands = [
         c
@@ -936,6 +1382,109 @@ def refresh_parameters():
     )
 
 
+def planned_moves(channels: list, min_amount: Millisatoshi, feeratio: float):
+    enough_liquidity = get_enough_liquidity_threshold(channels)
+    ideal_ratio = get_ideal_ratio(channels, enough_liquidity)
+    balances = {}
+    by_scid = {}
+    for ch in channels:
+        liquidity = liquidity_info(ch, enough_liquidity, ideal_ratio)
+        scid = ch["short_channel_id"]
+        balances[scid] = int(liquidity["our"]) - int(liquidity["ideal"]["our"])
+        by_scid[scid] = ch
+    history = plugin.history.fee_ppms()
+
+    def cost(scid1, scid2):
+        # historical fee of this pair or of the incoming channel, else estimated
+        ppm = history.get((scid1, scid2), history.get(scid2))
+        if ppm is None:
+            ppm = estimated_fee(by_scid[scid2], Millisatoshi(10**9)) // 1000
+        return ppm
+
+    moves = []
+    for scid1, scid2, amount, ppm in plan(balances, cost, int(min_amount)):
+        amount = Millisatoshi(amount)
+        moves.append(
+            {
+                "outgoing_scid": scid1,
+                "incoming_scid": scid2,
+                "amount_msat": amount,
+                "maxfee_msat": get_max_fee(amount, feeratio),
+                "estimated_fee_ppm": ppm,
+            }
+        )
+    return moves, enough_liquidity, ideal_ratio
+
+
+def execute_move(move):
+    scid1 = move["outgoing_scid"]
+    scid2 = move["incoming_scid"]
+    result = {"success": False, "fee_spent": Millisatoshi(0)}
+    plugin.log(
+        f"Thread{get_thread_id_str()} executes planned rebalance: {scid1} -> {scid2}; "
+        f"amount={move['amount_msat'].to_satoshi_str()}; maxfee={move['maxfee_msat'].to_satoshi_str()}"
+    )
+    try:
+        res = rebalance(
+            plugin,
+            outgoing_scid=scid1,
+            incoming_scid=scid2,
+            msatoshi=move["amount_msat"],
+            retry_for=1200,
+            maxfeepercent=0,
+            exemptfee=move["maxfee_msat"],
+        )
+    except Exception as e:
+        res = {"status": "exception", "message": str(e)}
+    if res.get("status") != "complete":
+        plugin.log(
+            f"Thread{get_thread_id_str()} planned rebalance failed: {scid1} -> {scid2}; {res}"
+        )
+        return result
+    result["success"] = True
+    result["fee_spent"] = res["fee"]
+    wait_for_htlcs(set(), [scid1, scid2])
+    plugin.log(f"Thread{get_thread_id_str()} planned rebalance succeeded: {res}")
+    return result
+
+
+def rebalanceplan_thread(moves: list):
+    if not plugin.mutex.acquire(blocking=False):
+        return
+    try:
+        start_ts = time.time()
+        plugin.log(f"Rebalance plan with {len(moves)} moves started")
+        # the scheduler runs moves in plan order, but never two at once
+        # on the same channel
+        remaining = {
+            (m["outgoing_scid"], m["incoming_scid"]): (len(moves) - i, m)
+            for i, m in enumerate(moves)
+        }
+        scids = {scid for key in remaining for scid in key}
+
+        def channels():
+            return [ch for ch in map(get_open_chan, scids) if ch is not None]
+
+        def score(ch1, ch2):
+            key = (ch1["short_channel_id"], ch2["short_channel_id"])
+            return remaining.get(key, (None,))[0]
+
+        def run_move(ch1, ch2):
+            key = (ch1["short_channel_id"], ch2["short_channel_id"])
+            return execute_move(remaining.pop(key)[1])
+
+        result = run_scheduler(PairScheduler(channels, get_open_chan, score), run_move)
+        elapsed_time = timedelta(seconds=time.time() - start_ts)
+        plugin.rebalanceall_msg = (
+            f"Rebalance plan finished: {result['success_count']} of {len(moves)} "
+            f"moves successful, {result['fee_spent'].to_satoshi_str()} fee spent, "
+            f"it took {str(elapsed_time)[:-3]}"
+        )
+        plugin.log(plugin.rebalanceall_msg)
+    finally:
+        plugin.mutex.release()
+
+
 def rebalanceall_thread():
     if not plugin.mutex.acquire(blocking=False):
         return
@@ -943,20 +1492,10 @@ def rebalanceall_thread():
         start_ts = time.time()
         feeadjuster_state = feeadjuster_toggle(False)
         plugin.log("Automatic rebalance started")
-        failed_channels = []
-        success = 0
-        fee_spent = Millisatoshi(0)
-        while True:
-            refresh_parameters()
-            result = maybe_rebalance_once(failed_channels)
-            if not result["success"] and not plugin.rebalance_stop_by_event:
-                break
-            if result["success"]:
-                success += result.get("success_count", 1)
-                fee_spent += result["fee_spent"]
-            plugin.rebalance_stop_by_event = False
-            if rebalance_stopping():
-                break
+        plugin.history.load()
+        result = rebalance_scheduled(set())
+        success = result["success_count"]
+        fee_spent = result["fee_spent"]
         feeadjust_would_be_nice()
         feeadjuster_toggle(feeadjuster_state)
         elapsed_time = timedelta(seconds=time.time() - start_ts)
@@ -971,45 +1510,81 @@ def rebalanceall_thread():
 
 @plugin.subscribe("forward_event")
 def forward_event(plugin: Plugin, forward_event: dict, **kwargs):
-    if not plugin.mutex.locked():
+    plugin.channels.invalidate()
+    plugin.channels.notify(
+        [
+            scid
+            for scid in (
+                forward_event.get("in_channel"),
+                forward_event.get("out_channel"),
+            )
+            if scid is not None
+        ]
+    )
+    scheduler = plugin.scheduler
+    if scheduler is None:
         return
     if forward_event["status"] == "settled":
-        plugin.log("Forward event restarts rebalance threads")
-        plugin.rebalance_stop_by_event = True
+        scids = [forward_event.get("in_channel"), forward_event.get("out_channel")]
+        scheduler.invalidate([scid for scid in scids if scid is not None])
 
 
 @plugin.subscribe("invoice_payment")
 def invoice_payment(plugin: Plugin, invoice_payment: dict, **kwargs):
-    if not plugin.mutex.locked():
+    plugin.channels.invalidate()
+    plugin.channels.notify()
+    scheduler = plugin.scheduler
+    if scheduler is None:
         return
     if invoice_payment.get("label").startswith("Rebalance"):
         return
-    plugin.log("Invoice payment restarts rebalance threads")
-    plugin.rebalance_stop_by_event = True
+    plugin.log("Invoice payment rescores rebalance channel pairs")
+    scheduler.invalidate()
 
 
 @plugin.subscribe("sendpay_success")
 def sendpay_success(plugin: Plugin, sendpay_success: dict, **kwargs):
-    if not plugin.mutex.locked():
+    plugin.channels.invalidate()
+    plugin.channels.notify()
+    scheduler = plugin.scheduler
+    if scheduler is None:
         return
     my_node_id = plugin.getinfo.get("id")
     if sendpay_success.get("destination") == my_node_id:
         return
-    plugin.log("Sendpay success restarts rebalance threads")
-    plugin.rebalance_stop_by_event = True
+    plugin.log("Sendpay success rescores rebalance channel pairs")
+    scheduler.invalidate()
 
 
 @plugin.subscribe("channel_state_changed")
 def channel_state_changed(plugin: Plugin, channel_state_changed: dict, **kwargs):
-    if not plugin.mutex.locked():
+    plugin.channels.invalidate()
+    scid = channel_state_changed.get("short_channel_id")
+    plugin.channels.notify(None if scid is None else [scid])
+    scheduler = plugin.scheduler
+    if scheduler is None:
         return
     if (
         channel_state_changed.get("old_state") != "CHANNELD_NORMAL"
         and channel_state_changed.get("new_state") != "CHANNELD_NORMAL"
     ):
         return
-    plugin.log("Channel state changed restarts rebalance threads")
-    plugin.rebalance_stop_by_event = True
+    plugin.log("Channel state changed rescores rebalance channel pairs")
+    scheduler.invalidate()
+
+
+@plugin.subscribe("sendpay_failure")
+def sendpay_failure(plugin: Plugin, sendpay_failure: dict, **kwargs):
+    plugin.channels.invalidate()
+    plugin.channels.notify()
+
+
+@plugin.subscribe("coin_movement")
+def coin_movement(plugin: Plugin, coin_movement: dict, **kwargs):
+    if coin_movement.get("type") == "channel_mvt":
+        # HTLCs are fully resolved, but the payload has no scid
+        plugin.channels.invalidate()
+        plugin.channels.notify()
 
 
 @plugin.method("rebalanceall")
@@ -1049,9 +1624,48 @@ def rebalanceall(
     }
 
 
+@plugin.method("rebalanceplan")
+def rebalanceplan(
+    plugin: Plugin,
+    min_amount: Millisatoshi = Millisatoshi("50000sat"),
+    feeratio: float = 0.5,
+    execute: bool = False,
+):
+    """Plan the rebalances that bring all channels to their ideal liquidity at once.
+    Solves a min-cost flow from channels with too much to channels with too little
+    outbound liquidity, using the fees of past rebalances, or estimated ones, as costs.
+    Moves below min_amount (default 50000sat) are left out, feeratio sets their max fee
+    like for rebalanceall. With execute=true the moves are run in the background, in
+    parallel, and can be stopped with the rebalancestop method.
+    """
+    channels = get_open_channels(plugin)
+    if len(channels) <= 1:
+        return {"message": "Error: Not enough open channels to rebalance anything"}
+    min_amount = Millisatoshi(min_amount)
+    feeratio = float(feeratio)
+    moves, enough_liquidity, ideal_ratio = planned_moves(channels, min_amount, feeratio)
+    res = {
+        "enough_liquidity_threshold": enough_liquidity,
+        "ideal_liquidity_ratio": f"{ideal_ratio * 100:.2f}%",
+        "moves": moves,
+        "total_amount_msat": sum((m["amount_msat"] for m in moves), Millisatoshi(0)),
+        "total_maxfee_msat": sum((m["maxfee_msat"] for m in moves), Millisatoshi(0)),
+    }
+    if execute and len(moves) > 0:
+        if plugin.mutex.locked():
+            res["message"] = (
+                "Rebalance is already running, this may take a while. "
+                "To stop it use the cli method 'rebalancestop'."
+            )
+        else:
+            threading.Thread(target=rebalanceplan_thread, args=(moves,)).start()
+            res["message"] = f"Rebalance plan with {len(moves)} moves started"
+    return res
+
+
 @plugin.method("rebalancestop")
 def rebalancestop(plugin: Plugin):
-    """It stops the ongoing rebalanceall."""
+    """It stops the ongoing rebalanceall or rebalanceplan."""
     if not plugin.mutex.locked():
         if plugin.rebalanceall_msg is None:
             return {"message": "No rebalance is running, nothing to stop."}
@@ -1061,6 +1675,9 @@ def rebalancestop(plugin: Plugin):
         }
     start_ts = time.time()
     plugin.rebalance_stop_by_user = True
+    scheduler = plugin.scheduler
+    if scheduler is not None:
+        scheduler.stop()
     plugin.mutex.acquire(blocking=True)
     plugin.rebalance_stop_by_user = False
     plugin.mutex.release()
@@ -1120,6 +1737,35 @@ def get_avg_forward_fees(intervals):
     return res
 
 
+def import_rebalances(before: float):
+    """Add rebalances paid before the history existed to its totals."""
+    invoices = plugin.rpc.listinvoices()["invoices"]
+    rebalances = [
+        i
+        for i in invoices
+        if i.get("status") == "paid"
+        and i.get("label").startswith("Rebalance")
+        and i.get("paid_at", 0) < before
+    ]
+    if not rebalances:
+        return
+    pays = {
+        p["payment_hash"]: p for p in plugin.rpc.listpays(status="complete")["pays"]
+    }
+    count = 0
+    total_fee = Millisatoshi(0)
+    total_amount = Millisatoshi(0)
+    for r in rebalances:
+        pay = pays.get(r["payment_hash"])
+        if pay is None:
+            continue
+        count += 1
+        total_amount += pay["amount_msat"]
+        total_fee += pay["amount_sent_msat"] - pay["amount_msat"]
+    plugin.history.add_totals(count, int(total_amount), int(total_fee))
+    plugin.log(f"Added {count} earlier rebalances to the history totals")
+
+
 @plugin.method("rebalancereport")
 def rebalancereport(plugin: Plugin, include_avg_fees: bool = True):
     """Show information about rebalance"""
@@ -1141,31 +1787,22 @@ def rebalancereport(plugin: Plugin, include_avg_fees: bool = True):
         res["enough_liquidity_threshold"] = Millisatoshi(0)
         res["ideal_liquidity_ratio"] = "0%"
     res["liquidity_health"] = f"{health_percent:.2f}%"
-    invoices = plugin.rpc.listinvoices()["invoices"]
-    rebalances = [
-        i
-        for i in invoices
-        if i.get("status") == "paid" and i.get("label").startswith("Rebalance")
-    ]
-    total_fee = Millisatoshi(0)
-    total_amount = Millisatoshi(0)
-    res["total_successful_rebalances"] = len(rebalances)
-
-    pays = plugin.rpc.listpays(status="complete")["pays"]
-
-    for r in rebalances:
-        try:
-            pay = next(p for p in pays if p["payment_hash"] == r["payment_hash"])
-            total_amount += pay["amount_msat"]
-            total_fee += pay["amount_sent_msat"] - pay["amount_msat"]
-        except Exception:
-            res["total_successful_rebalances"] -= 1
+    totals = plugin.history.totals()
+    total_fee = Millisatoshi(totals["fee_msat"])
+    total_amount = Millisatoshi(totals["amount_msat"])
+    res["total_successful_rebalances"] = totals["successes"]
     res["total_rebalanced_amount"] = total_amount
     res["total_rebalance_fee"] = total_fee
     if total_amount > Millisatoshi(0):
         res["average_rebalance_fee_ppm"] = round(total_fee / total_amount * 10**6, 2)
     else:
         res["average_rebalance_fee_ppm"] = 0
+    history = plugin.history.summary()
+    res[f"rebalance_attempts_{plugin.history.days}d"] = history["attempts"]
+    if history["attempts"] > 0:
+        res[f"rebalance_success_rate_{plugin.history.days}d"] = (
+            f"{history['successes'] / history['attempts'] * 100:.2f}%"
+        )
 
     if include_avg_fees:
         avg_forward_fees = get_avg_forward_fees([1, 7, 30])
@@ -1212,8 +1849,22 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     plugin.fee_base = Millisatoshi(config["fee-base"]["value_int"])
     plugin.fee_ppm = config["fee-per-satoshi"]["value_int"]
     plugin.mutex = threading.Lock()
+    plugin.channels = ChannelCache(plugin.rpc)
+    plugin.policies = PolicyCache(plugin.rpc)
+    plugin.aliases = AliasCache(plugin.rpc)
+    plugin.known_bad = KnownBadLayer(plugin.rpc)
+    plugin.history = History(
+        os.path.join(configuration["lightning-dir"], "rebalance.sqlite3")
+    )
+    threading.Thread(target=plugin.aliases.warm, daemon=True).start()
+    if plugin.history.created_at is not None:
+        threading.Thread(
+            target=import_rebalances, args=(plugin.history.created_at,), daemon=True
+        ).start()
     plugin.erringnodes = int(options.get("rebalance-erringnodes"))
     plugin.threads = int(options.get("rebalance-threads"))
+    plugin.maxparts = int(options.get("rebalance-maxparts"))
+    plugin.probes = int(options.get("rebalance-probes"))
     plugin.rebalanceall_msg = None
 
     plugin.log(
@@ -1221,6 +1872,8 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
         f"cltv_final:{plugin.cltv_final}  "
         f"erringnodes:{plugin.erringnodes}  "
         f"threads:{plugin.threads}  "
+        f"maxparts:{plugin.maxparts}  "
+        f"probes:{plugin.probes}  "
     )
 
 
@@ -1262,4 +1915,20 @@ plugin.add_option(
     "string",
 )
 
+plugin.add_option(
+    "rebalance-maxparts",
+    "1",
+    "Split rebalances into up to N parts sent at once over different routes. "
+    "Note: 1 sends each rebalance over a single route",
+    "string",
+)
+
+plugin.add_option(
+    "rebalance-probes",
+    "0",
+    "Probe up to N routes at once before each single route rebalance attempt, "
+    "and pay over the first one that works. Note: Use 0 to disable.",
+    "string",
+)
+
 plugin.run()
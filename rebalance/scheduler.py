@@ -0,0 +1,125 @@
+import heapq
+import itertools
+import threading
+
+
+class PairScheduler:
+    """
+    Hands out channel pairs to rebalance workers, best pair first.
+
+    `score(ch1, ch2)` rates rebalancing from `ch1` to `ch2`, pairs scoring
+    None or less than zero are not worth trying. Every pair is scored once
+    when the scheduler starts. Afterwards only the pairs of channels passed
+    to `done` or `invalidate` are scored again, older heap entries of those
+    pairs are skipped when they are popped.
+
+    A pair is only handed out while neither of its channels is used by
+    another worker. `get` returns None once nothing is left to do, i.e.
+    the queue is empty and no worker could add new pairs to it.
+    """
+
+    def __init__(self, channels, get_channel, score):
+        # `channels()` returns all channels to rebalance and is called
+        # on full reloads, `get_channel(scid)` returns None for channels
+        # that can't be rebalanced anymore.
+        self.load_channels = channels
+        self.get_channel = get_channel
+        self.score = score
+        self.cond = threading.Condition()
+        self.channels = {}
+        self.heap = []
+        self.versions = {}
+        self.counter = itertools.count()
+        self.busy = set()
+        self.dirty = set()
+        self.reload = True
+        self.stopped = False
+
+    def _push(self, scid1: str, scid2: str):
+        key = (scid1, scid2)
+        version = self.versions.get(key, 0) + 1
+        self.versions[key] = version
+        score = self.score(self.channels[scid1], self.channels[scid2])
+        if score is not None and score > 0:
+            heapq.heappush(self.heap, (-score, next(self.counter), key, version))
+
+    def _rescore(self):
+        if self.reload:
+            self.channels = {ch["short_channel_id"]: ch for ch in self.load_channels()}
+            self.heap = []
+            self.versions = {}
+            for scid1 in self.channels:
+                for scid2 in self.channels:
+                    if scid1 != scid2:
+                        self._push(scid1, scid2)
+            self.reload = False
+            self.dirty.clear()
+            return
+        dirty, self.dirty = self.dirty, set()
+        for scid in dirty:
+            ch = self.get_channel(scid)
+            if ch is None:
+                self.channels.pop(scid, None)
+                # forget the queued pairs of this channel
+                for key in self.versions:
+                    if scid in key:
+                        self.versions[key] += 1
+            else:
+                self.channels[scid] = ch
+        pairs = set()
+        for scid in dirty:
+            if scid not in self.channels:
+                continue
+            for other in self.channels:
+                if other != scid:
+                    pairs.update(((scid, other), (other, scid)))
+        for scid1, scid2 in pairs:
+            self._push(scid1, scid2)
+
+    def get(self):
+        """Block until a pair is available and return its two channels."""
+        with self.cond:
+            while not self.stopped:
+                self._rescore()
+                blocked = []
+                key = None
+                while self.heap:
+                    entry = heapq.heappop(self.heap)
+                    if self.versions.get(entry[2]) != entry[3]:
+                        continue
+                    if entry[2][0] in self.busy or entry[2][1] in self.busy:
+                        blocked.append(entry)
+                        continue
+                    key = entry[2]
+                    break
+                for entry in blocked:
+                    heapq.heappush(self.heap, entry)
+                if key is not None:
+                    self.busy.update(key)
+                    return self.channels[key[0]], self.channels[key[1]]
+                if not self.heap and not self.busy:
+                    return None
+                self.cond.wait()
+            return None
+
+    def done(self, scid1: str, scid2: str):
+        """Release a pair returned by `get` and rescore its channels."""
+        with self.cond:
+            self.busy.discard(scid1)
+            self.busy.discard(scid2)
+            self.dirty.update((scid1, scid2))
+            self.cond.notify_all()
+
+    def invalidate(self, scids: list = None):
+        """Rescore the pairs of `scids`, or reload all channels if None."""
+        with self.cond:
+            if scids is None:
+                self.reload = True
+            else:
+                self.dirty.update(scids)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
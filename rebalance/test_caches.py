@@ -0,0 +1,229 @@
+import threading
+import time
+
+from caches import AliasCache, ChannelCache, PolicyCache
+
+
+class FakeRpc:
+    def __init__(self, channels):
+        self.channels = channels
+        self.calls = []
+
+    def listpeerchannels(self, peer_id=None):
+        self.calls.append(peer_id)
+        return {
+            "channels": [
+                dict(c)
+                for c in self.channels
+                if peer_id is None or c["peer_id"] == peer_id
+            ]
+        }
+
+    def listchannels(self, scid=None):
+        self.calls.append(scid)
+        return {
+            "channels": [
+                dict(c)
+                for c in self.channels
+                if scid is None or c["short_channel_id"] == scid
+            ]
+        }
+
+    def listnodes(self, node_id=None):
+        self.calls.append(node_id)
+        return {
+            "nodes": [
+                dict(n) for n in self.nodes if node_id is None or n["nodeid"] == node_id
+            ]
+        }
+
+
+def channel(scid, peer_id, to_us=0, htlcs=None):
+    return {
+        "short_channel_id": scid,
+        "peer_id": peer_id,
+        "to_us_msat": to_us,
+        "htlcs": htlcs or [],
+    }
+
+
+def test_channel_cache_fetches_once():
+    rpc = FakeRpc([channel("1x1x1", "a"), channel("2x2x2", "a"), channel("3x3x3", "b")])
+    cache = ChannelCache(rpc)
+    assert cache.get("1x1x1")["peer_id"] == "a"
+    assert [c["short_channel_id"] for c in cache.peer_channels("a")] == [
+        "1x1x1",
+        "2x2x2",
+    ]
+    assert len(cache.channels()) == 3
+    assert cache.get("4x4x4") is None
+    assert rpc.calls == [None]
+
+
+def test_channel_cache_invalidate():
+    rpc = FakeRpc([channel("1x1x1", "a", 10)])
+    cache = ChannelCache(rpc)
+    assert cache.get("1x1x1")["to_us_msat"] == 10
+    rpc.channels = [channel("1x1x1", "a", 20)]
+    assert cache.get("1x1x1")["to_us_msat"] == 10
+    cache.invalidate()
+    assert cache.get("1x1x1")["to_us_msat"] == 20
+    assert rpc.calls == [None, None]
+
+
+def test_channel_cache_max_age():
+    rpc = FakeRpc([channel("1x1x1", "a")])
+    cache = ChannelCache(rpc, max_age=0)
+    cache.get("1x1x1")
+    cache.get("1x1x1")
+    assert rpc.calls == [None, None]
+
+
+def test_channel_cache_refresh_peer():
+    rpc = FakeRpc([channel("1x1x1", "a", htlcs=[{}]), channel("3x3x3", "b")])
+    cache = ChannelCache(rpc)
+    assert cache.get("1x1x1")["htlcs"] == [{}]
+    rpc.channels = [channel("1x1x1", "a"), channel("3x3x3", "b", 5)]
+    assert cache.refresh_peer("a")[0]["htlcs"] == []
+    assert cache.get("1x1x1")["htlcs"] == []
+    # other peers are left alone
+    assert cache.get("3x3x3")["to_us_msat"] == 0
+    assert rpc.calls == [None, "a"]
+
+
+def test_wait_settled():
+    rpc = FakeRpc(
+        [
+            channel("1x1x1", "a", htlcs=[{}]),
+            channel("2x2x2", "b"),
+            channel("3x3x3", "c", htlcs=[{}]),
+        ]
+    )
+    cache = ChannelCache(rpc)
+    assert cache.wait_settled("2x2x2")
+    result = []
+    waiters = [
+        threading.Thread(
+            target=lambda scid=scid: result.append(cache.wait_settled(scid))
+        )
+        for scid in ("1x1x1", "3x3x3")
+    ]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.1)
+    # notifications for other channels don't cause lookups
+    cache.notify(["2x2x2"])
+    time.sleep(0.1)
+    assert rpc.calls == [None]
+    rpc.channels = [channel("1x1x1", "a"), channel("2x2x2", "b"), channel("3x3x3", "c")]
+    cache.invalidate()
+    cache.notify()
+    for waiter in waiters:
+        waiter.join(1)
+    assert result == [True, True]
+    # both waiters share one lookup
+    assert rpc.calls == [None, None]
+
+
+def test_wait_settled_timeout():
+    rpc = FakeRpc([channel("1x1x1", "a", htlcs=[{}])])
+    cache = ChannelCache(rpc)
+    assert not cache.wait_settled("1x1x1", timeout=0.1)
+    # one lookup at the start, one more before giving up
+    assert rpc.calls == [None, None]
+    rpc.channels = []
+    cache.invalidate()
+    assert cache.wait_settled("1x1x1")
+
+
+def test_refresh_peer_waits_for_a_full_refresh():
+    started = threading.Event()
+    release = threading.Event()
+
+    class SlowRpc(FakeRpc):
+        def listpeerchannels(self, peer_id=None):
+            result = super().listpeerchannels(peer_id)
+            if peer_id is None:
+                started.set()
+                release.wait(1)
+            return result
+
+    rpc = SlowRpc([channel("1x1x1", "a", htlcs=[{}])])
+    cache = ChannelCache(rpc)
+    refresh = threading.Thread(target=cache.refresh)
+    refresh.start()
+    started.wait(1)
+    rpc.channels = [channel("1x1x1", "a")]
+    peer = threading.Thread(target=cache.refresh_peer, args=("a",))
+    peer.start()
+    time.sleep(0.1)
+    release.set()
+    refresh.join(1)
+    peer.join(1)
+    # the older full fetch didn't replace the newer channel of peer a
+    assert cache.by_scid["1x1x1"]["htlcs"] == []
+
+
+def policy(scid, direction, destination, base=1000):
+    return {
+        "short_channel_id": scid,
+        "direction": direction,
+        "destination": destination,
+        "base_fee_millisatoshi": base,
+        "fee_per_millionth": 10,
+        "delay": 6,
+    }
+
+
+def test_policy_cache():
+    rpc = FakeRpc([policy("1x1x1", 0, "b"), policy("1x1x1", 1, "a", 2000)])
+    cache = PolicyCache(rpc)
+    assert cache.get("1x1x1", 1)["base_fee_millisatoshi"] == 2000
+    assert cache.get("1x1x1", destination="b")["base_fee_millisatoshi"] == 1000
+    # a direction that doesn't match the destination falls back to it
+    assert cache.get("1x1x1", 0, "a")["base_fee_millisatoshi"] == 2000
+    assert rpc.calls == [None]
+
+
+def test_policy_cache_missing_and_invalidate():
+    rpc = FakeRpc([policy("1x1x1", 0, "b")])
+    cache = PolicyCache(rpc)
+    assert cache.get("1x1x1", 0)["base_fee_millisatoshi"] == 1000
+    rpc.channels = [policy("1x1x1", 0, "b", 5000), policy("2x2x2", 1, "c")]
+    assert cache.get("2x2x2", 1)["destination"] == "c"
+    assert cache.get("1x1x1", 0)["base_fee_millisatoshi"] == 1000
+    cache.invalidate("1x1x1")
+    assert cache.get("1x1x1", 0)["base_fee_millisatoshi"] == 5000
+    assert cache.get("3x3x3", 0) is None
+    assert rpc.calls == [None, "2x2x2", "1x1x1", "3x3x3"]
+
+
+def test_alias_cache():
+    rpc = FakeRpc([])
+    rpc.nodes = [
+        {"nodeid": "02aaaaaaaaaa", "alias": "alice"},
+        {"nodeid": "03bbbbbbbbbb"},
+    ]
+    cache = AliasCache(rpc)
+    cache.warm()
+    assert cache.get("02aaaaaaaaaa") == "alice"
+    assert cache.get("03bbbbbbbbbb") == "03bbbbb"
+    assert rpc.calls == [None]
+    # unknown nodes are looked up once
+    assert cache.get("02cccccccccc") == "02ccccc"
+    assert cache.get("02cccccccccc") == "02ccccc"
+    assert rpc.calls == [None, "02cccccccccc"]
+
+
+def test_alias_cache_lru_and_ttl():
+    rpc = FakeRpc([])
+    rpc.nodes = [{"nodeid": n, "alias": n.upper()} for n in ("a", "b", "c")]
+    cache = AliasCache(rpc, size=2)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert list(cache.aliases) == ["a", "c"]
+    cache.ttl = 0
+    assert cache.get("a") == "A"
+    assert rpc.calls == ["a", "b", "c", "a"]
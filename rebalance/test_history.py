@@ -0,0 +1,59 @@
+import time
+
+from history import History, PairStats, fee_ppm, probability
+
+
+def test_probability_and_fee():
+    assert probability(PairStats(0, 0, 0, 0)) == 0.5
+    assert probability(PairStats(8, 0, 0, 0)) == 0.1
+    assert fee_ppm(PairStats(1, 0, 0, 0)) is None
+    assert fee_ppm(PairStats(2, 1, 2_000_000, 500)) == 250
+
+
+def test_record_and_reload(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    history = History(path)
+    now = time.time()
+    history.record(now, "1x1x1", "2x2x2", 1_000_000, "complete", fee_msat=100, hops=4)
+    history.record(now, "1x1x1", "2x2x2", 1_000_000, "error", erring_channel="9x9x9")
+    history.record(now, "3x3x3", "2x2x2", 3_000_000, "complete", fee_msat=900)
+    assert history.pair("1x1x1", "2x2x2") == PairStats(2, 1, 1_000_000, 100)
+    assert history.pair("2x2x2", "1x1x1") == PairStats(0, 0, 0, 0)
+    assert history.incoming()["2x2x2"] == PairStats(3, 2, 4_000_000, 1000)
+    assert history.fee_ppms() == {
+        ("1x1x1", "2x2x2"): 100,
+        ("3x3x3", "2x2x2"): 300,
+        "2x2x2": 250,
+    }
+    assert history.summary() == {"attempts": 3, "successes": 2}
+
+    # aggregates survive a restart, old attempts are left out
+    history.record(now - 31 * 86400, "1x1x1", "2x2x2", 1_000_000, "error")
+    assert History(path).pair("1x1x1", "2x2x2") == PairStats(2, 1, 1_000_000, 100)
+    history.load()
+    assert history.pair("1x1x1", "2x2x2") == PairStats(2, 1, 1_000_000, 100)
+
+
+def test_prune_and_totals(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    history = History(path)
+    assert history.created_at is not None
+    now = time.time()
+    old = now - 31 * 86400
+    history.record(old, "1x1x1", "2x2x2", 1_000_000, "complete", fee_msat=100)
+    history.record(old, "1x1x1", "2x2x2", 1_000_000, "error")
+    history.record(now, "1x1x1", "2x2x2", 2_000_000, "complete", fee_msat=300)
+    history.add_totals(2, 5_000_000, 1_000)
+    totals = {"successes": 4, "amount_msat": 8_000_000, "fee_msat": 1_400}
+    assert history.totals() == totals
+
+    # old attempts are deleted, but still count for the totals
+    history.load()
+    (count,) = history.db.execute("SELECT COUNT(*) FROM attempts").fetchone()
+    assert count == 1
+    assert history.totals() == totals
+    assert history.pair("1x1x1", "2x2x2") == PairStats(1, 1, 2_000_000, 300)
+
+    reopened = History(path)
+    assert reopened.created_at is None
+    assert reopened.totals() == totals
@@ -0,0 +1,78 @@
+from pyln.client import RpcError
+
+from layers import AttemptLayer, KnownBadLayer
+
+
+class FakeRpc:
+    def __init__(self):
+        self.calls = []
+        self.layers = set()
+
+    def call(self, method, params):
+        self.calls.append((method, *params))
+        if method == "askrene-remove-layer":
+            if params[0] not in self.layers:
+                raise RpcError(method, params, {"message": "Unknown layer"})
+            self.layers.remove(params[0])
+        elif method == "askrene-create-layer":
+            self.layers.add(params[0])
+
+
+def test_attempt_layer_sends_only_new_excludes():
+    rpc = FakeRpc()
+    layer = AttemptLayer(rpc, "attempt")
+    layer.exclude(["me"])
+    layer.exclude(["me"])
+    layer.exclude(["me", "bad", "1x1x1/0"])
+    assert rpc.calls == [
+        ("askrene-remove-layer", "attempt"),
+        ("askrene-create-layer", "attempt"),
+        ("askrene-disable-node", "attempt", "me"),
+        ("askrene-disable-node", "attempt", "bad"),
+        ("askrene-update-channel", "attempt", "1x1x1/0", False),
+    ]
+    layer.close()
+    assert rpc.layers == set()
+    layer.close()
+    assert len(rpc.calls) == 6
+
+
+def test_known_bad_layer_expiry():
+    rpc = FakeRpc()
+    known_bad = KnownBadLayer(rpc, "bad", ttl=1000)
+    known_bad.expire()
+    assert rpc.layers == {"bad"}
+    known_bad.add("node1")
+    known_bad.add("node1")
+    known_bad.add("1x1x1/1")
+    rpc.calls.clear()
+    known_bad.expire()
+    assert rpc.calls == []
+
+    known_bad.expiries["node1"] = 0
+    known_bad.expire()
+    assert rpc.calls == [
+        ("askrene-remove-layer", "bad-1"),
+        ("askrene-create-layer", "bad-1"),
+        ("askrene-update-channel", "bad-1", "1x1x1/1", False),
+        ("askrene-remove-layer", "bad"),
+    ]
+    assert list(known_bad.expiries) == ["1x1x1/1"]
+    assert rpc.layers == {"bad-1"}
+
+
+def test_known_bad_layer_kept_while_in_use():
+    rpc = FakeRpc()
+    known_bad = KnownBadLayer(rpc, "bad", ttl=1000)
+    known_bad.add("node1")
+    known_bad.add("node2")
+    with known_bad.use() as name:
+        assert name == "bad"
+        # another thread expires an entry while this one runs getroutes
+        known_bad.expiries["node1"] = 0
+        with known_bad.use() as new_name:
+            assert new_name == "bad-1"
+            assert rpc.layers == {"bad", "bad-1"}
+        assert rpc.layers == {"bad", "bad-1"}
+    assert rpc.layers == {"bad-1"}
+    assert known_bad.users == {}
@@ -0,0 +1,59 @@
+import itertools
+
+from planner import min_cost_flow, plan
+
+
+def total_cost(flow, costs):
+    return sum(amount * costs[key] for key, amount in flow.items())
+
+
+def test_cheapest_assignment():
+    # moving a->c and b->d costs 2, a->d and b->c costs 20
+    costs = {("a", "c"): 1, ("a", "d"): 10, ("b", "c"): 10, ("b", "d"): 1}
+    flow = min_cost_flow({"a": 5, "b": 5}, {"c": 5, "d": 5}, lambda s, d: costs[(s, d)])
+    assert flow == {("a", "c"): 5, ("b", "d"): 5}
+
+
+def test_reroutes_earlier_flow():
+    # the first path takes a->c, the second has to undo part of it
+    costs = {("a", "c"): 1, ("a", "d"): 2, ("b", "c"): 2, ("b", "d"): 100}
+    flow = min_cost_flow(
+        {"a": 10, "b": 5}, {"c": 10, "d": 5}, lambda s, d: costs[(s, d)]
+    )
+    assert flow == {("a", "c"): 5, ("a", "d"): 5, ("b", "c"): 5}
+    assert total_cost(flow, costs) == 25
+
+
+def test_matches_brute_force():
+    supply = {"a": 3, "b": 2}
+    demand = {"c": 1, "d": 4}
+    costs = {("a", "c"): 4, ("a", "d"): 6, ("b", "c"): 1, ("b", "d"): 9}
+    flow = min_cost_flow(supply, demand, lambda s, d: costs[(s, d)])
+    best = None
+    for ac, bc in itertools.product(range(2), repeat=2):
+        if ac + bc != 1:
+            continue
+        candidate = {
+            ("a", "c"): ac,
+            ("a", "d"): 3 - ac,
+            ("b", "c"): bc,
+            ("b", "d"): 2 - bc,
+        }
+        c = total_cost(candidate, costs)
+        best = c if best is None else min(best, c)
+    assert sum(flow.values()) == 5
+    assert total_cost(flow, costs) == best
+
+
+def test_unbalanced_and_impossible_moves():
+    costs = {("a", "c"): 1, ("b", "c"): None}
+    flow = min_cost_flow({"a": 5, "b": 5}, {"c": 8}, lambda s, d: costs[(s, d)])
+    assert flow == {("a", "c"): 5}
+
+
+def test_plan():
+    balances = {"a": 100, "b": 5, "c": -50, "d": -55}
+    costs = {("a", "c"): 3, ("a", "d"): 1, ("b", "c"): 1, ("b", "d"): 1}
+    moves = plan(balances, lambda s, d: costs[(s, d)], min_amount=10)
+    # b's surplus is too small for its own move
+    assert moves == [("a", "d", 55, 1), ("a", "c", 45, 3)]
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from layers import KnownBadLayer
+from pyln.client import Millisatoshi, RpcError
+
+import rebalance
+
+ME = "02" + "00" * 32
+OUT = "02" + "aa" * 32
+IN = "02" + "bb" * 32
+
+
+def path(*scidds):
+    return [{"short_channel_id_dir": scidd, "next_node_id": IN} for scidd in scidds]
+
+
+class FakeRpc:
+    def __init__(self, routes, results):
+        self.routes = list(routes)
+        self.results = results
+        self.sent = {}
+        self.informed = []
+        # probes that don't reach the final hop fail once this is set
+        self.release = threading.Event()
+
+    def call(self, method, params):
+        if method == "askrene-inform-channel":
+            self.informed.append(tuple(params[1:]))
+
+    def getroutes(self, **kwargs):
+        if not self.routes:
+            raise RpcError("getroutes", kwargs, {"code": 205, "message": "no route"})
+        return {"routes": [{"path": self.routes.pop(0)}]}
+
+    def sendpay(self, route, payment_hash):
+        first = route[1]["short_channel_id_dir"]
+        result = self.results[first]
+        if result == "sendpay":
+            raise RpcError("sendpay", {}, {"code": 204, "message": "first hop failed"})
+        self.sent[payment_hash] = (route, result)
+
+    def waitsendpay(self, payment_hash, timeout):
+        _, data = self.sent[payment_hash]
+        if data.get("failcode") != 0x400F:
+            self.release.wait()
+        raise RpcError("waitsendpay", {}, {"code": 204, "data": data})
+
+
+def setup(monkeypatch, rpc):
+    plugin = rebalance.plugin
+    monkeypatch.setattr(plugin, "rpc", rpc, raising=False)
+    monkeypatch.setattr(plugin, "known_bad", KnownBadLayer(rpc), raising=False)
+    monkeypatch.setattr(plugin, "log", lambda *args, **kwargs: None)
+    monkeypatch.setattr(plugin, "threads", 1, raising=False)
+    # our outgoing channel, the path, and our incoming channel
+    monkeypatch.setattr(
+        rebalance,
+        "build_route",
+        lambda route_mid, msatoshi, ends: [{}] + route_mid + [{}],
+    )
+
+
+def probe(rpc, probes):
+    ends = rebalance.RouteEnds(ME, OUT, IN, "10x10x10", "11x11x11")
+    layer = rebalance.AttemptLayer(rpc, "attempt")
+    return rebalance.probe_routes(
+        ends, layer, [ME], Millisatoshi(1000), Millisatoshi(100), probes
+    )
+
+
+def wait_for(predicate):
+    deadline = time.time() + 5
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_probe_winner_and_askrene_informs(monkeypatch):
+    routes = [
+        path("1x1x1/0", "2x2x2/0"),
+        path("3x3x3/0", "4x4x4/0"),
+        path("5x5x5/0", "6x6x6/0"),
+        path("7x7x7/0", "8x8x8/0"),
+    ]
+    results = {
+        # failed at our outgoing channel, which also reports our node id
+        "1x1x1/0": {"erring_index": 0, "erring_node": ME, "erring_channel": "9x9x9"},
+        # failed in the middle of the route
+        "3x3x3/0": {
+            "erring_index": 2,
+            "erring_node": IN,
+            "erring_channel": "4x4x4",
+            "erring_direction": 0,
+            "amount_msat": 1000,
+        },
+        # rejected by our node as the final hop
+        "5x5x5/0": {
+            "erring_index": 4,
+            "erring_node": ME,
+            "failcode": 0x400F,
+            "amount_msat": 1000,
+        },
+        "7x7x7/0": "sendpay",
+    }
+    rpc = FakeRpc(routes, results)
+    setup(monkeypatch, rpc)
+
+    # the winner is returned while the other probes are still pending
+    timer = threading.Timer(5, rpc.release.set)
+    timer.start()
+    winner = probe(rpc, 4)
+    assert not rpc.release.is_set()
+    timer.cancel()
+    assert winner == routes[2]
+    rpc.release.set()
+    wait_for(lambda: len(rpc.informed) == 3)
+    assert sorted(rpc.informed) == [
+        ("4x4x4/0", 1000, "constrained"),
+        ("5x5x5/0", 1000, "unconstrained"),
+        ("6x6x6/0", 1000, "unconstrained"),
+    ]
+
+
+def test_probe_waits_for_probes_on_the_winning_route(monkeypatch):
+    routes = [path("1x1x1/0", "2x2x2/0"), path("3x3x3/0", "2x2x2/0")]
+    results = {
+        "1x1x1/0": {"erring_index": 2, "erring_node": IN, "erring_channel": "4x4x4"},
+        "3x3x3/0": {"erring_index": 4, "erring_node": ME, "failcode": 0x400F},
+    }
+    rpc = FakeRpc(routes, results)
+    setup(monkeypatch, rpc)
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(probe(rpc, 2)))
+    thread.start()
+    time.sleep(0.1)
+    # the first probe still holds liquidity of 2x2x2/0
+    assert result == []
+    rpc.release.set()
+    thread.join(5)
+    assert result == [routes[1]]
@@ -367,3 +367,48 @@ def test_rebalance_fees_and_delays(node_factory, bitcoind):
     assert result["hops"] == 4
     assert result["received"] == "500000000msat"
     assert result["sent"] == "500056102msat"
+
+
+def test_rebalance_mpp(node_factory, bitcoind):
+    l1, l2, l3, l4, l5 = node_factory.get_nodes(5, opts=[plugin_opt, {}, {}, {}, {}])
+    nodes = [l1, l2, l3, l4, l5]
+
+    # two parallel paths between l2 and l5, each too small for the amount
+    for a, b, amount in [
+        (l1, l2, 10**6),
+        (l2, l3, 3 * 10**5),
+        (l2, l4, 3 * 10**5),
+        (l3, l5, 3 * 10**5),
+        (l4, l5, 3 * 10**5),
+        (l5, l1, 10**6),
+    ]:
+        a.connect(b)
+        a.fundchannel(b, amount)
+
+    scid12 = l1.get_channel_scid(l2)
+    scid51 = l5.get_channel_scid(l1)
+    scids = [
+        scid12,
+        l2.get_channel_scid(l3),
+        l2.get_channel_scid(l4),
+        l3.get_channel_scid(l5),
+        l4.get_channel_scid(l5),
+        scid51,
+    ]
+
+    # wait for each others gossip
+    bitcoind.generate_block(6)
+    wait_for_all_active(nodes, scids)
+
+    result = l1.rpc.rebalance(
+        outgoing_scid=scid12,
+        incoming_scid=scid51,
+        msatoshi="400000000msat",
+        maxparts=4,
+    )
+    print(result)
+    assert result["status"] == "complete"
+    assert result["received"] == "400000000msat"
+    assert result["parts"] >= 2
+    assert result["hops"] == 4
+    wait_for_all_htlcs(nodes)
@@ -0,0 +1,98 @@
+import threading
+
+from scheduler import PairScheduler
+
+
+class Channels:
+    """Channels with a single `value` each, pairs score by their difference."""
+
+    def __init__(self, values: dict):
+        self.values = values
+        self.scored = []
+
+    def channels(self):
+        return [self.get(scid) for scid in self.values]
+
+    def get(self, scid):
+        if scid not in self.values:
+            return None
+        return {"short_channel_id": scid, "value": self.values[scid]}
+
+    def score(self, ch1, ch2):
+        self.scored.append((ch1["short_channel_id"], ch2["short_channel_id"]))
+        return ch1["value"] - ch2["value"]
+
+
+def scids(pair):
+    return tuple(ch["short_channel_id"] for ch in pair)
+
+
+def test_best_pair_first():
+    chans = Channels({"a": 10, "b": 5, "c": 0})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    assert scids(scheduler.get()) == ("a", "c")
+    chans.values.update({"a": 5, "c": 5})
+    scheduler.done("a", "c")
+    # only positive scores are worth trying
+    assert scheduler.get() is None
+
+
+def test_busy_channels_are_skipped():
+    chans = Channels({"a": 10, "b": 5, "c": 0, "d": -10})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    assert scids(scheduler.get()) == ("a", "d")
+    assert scids(scheduler.get()) == ("b", "c")
+
+
+def test_done_only_rescores_affected_pairs():
+    chans = Channels({"a": 10, "b": 5, "c": 2, "d": -10})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    scheduler.get()
+    assert len(chans.scored) == 12
+    chans.scored.clear()
+    chans.values.update({"a": 0, "d": 0})
+    scheduler.done("a", "d")
+    assert scids(scheduler.get()) in (("b", "a"), ("b", "d"))
+    assert all("a" in pair or "d" in pair for pair in chans.scored)
+    assert len(chans.scored) == 10
+
+
+def test_invalidate_removes_and_reloads_channels():
+    chans = Channels({"a": 10, "b": 5, "c": 0})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    scheduler.get()
+    scheduler.done("a", "c")
+    del chans.values["a"]
+    scheduler.invalidate(["a"])
+    assert scids(scheduler.get()) == ("b", "c")
+    scheduler.done("b", "c")
+    chans.values.update({"a": 4, "b": 3, "c": 3, "e": 0})
+    scheduler.invalidate()
+    assert scids(scheduler.get()) == ("a", "e")
+
+
+def test_get_waits_for_busy_workers():
+    chans = Channels({"a": 10, "b": 5, "c": 0})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    assert scids(scheduler.get()) == ("a", "c")
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(scheduler.get()))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    chans.values.update({"a": 6, "c": 10})
+    scheduler.done("a", "c")
+    waiter.join(1)
+    assert scids(result[0]) == ("c", "b")
+
+
+def test_stop():
+    chans = Channels({"a": 10, "b": 5, "c": 0})
+    scheduler = PairScheduler(chans.channels, chans.get, chans.score)
+    scheduler.get()
+    waiter = threading.Thread(target=scheduler.get)
+    waiter.start()
+    scheduler.stop()
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert scheduler.get() is None
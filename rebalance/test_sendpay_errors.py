@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+from pyln.client import RpcError
+
+import rebalance
+
+ME = "02" + "00" * 32
+PEER = "02" + "aa" * 32
+REMOTE = "02" + "bb" * 32
+
+
+class FakeRpc:
+    def call(self, method, params):
+        pass
+
+
+class FakeChannels:
+    def get(self, scid):
+        return {"peer_id": PEER} if scid == "1x1x1" else None
+
+    def peer_channels(self, peer_id):
+        return [{"short_channel_id": "1x1x1"}] if peer_id == PEER else []
+
+
+class FakeKnownBad:
+    def __init__(self):
+        self.added = []
+
+    def add(self, exclude):
+        self.added.append(exclude)
+
+
+def error(node, channel, failcode):
+    data = {
+        "erring_node": node,
+        "erring_channel": channel,
+        "erring_direction": 0,
+        "failcode": failcode,
+    }
+    return RpcError("waitsendpay", {}, {"code": 204, "data": data})
+
+
+def test_local_nodes_and_channels_are_not_known_bad(monkeypatch):
+    plugin = rebalance.plugin
+    known_bad = FakeKnownBad()
+    monkeypatch.setattr(plugin, "rpc", FakeRpc(), raising=False)
+    monkeypatch.setattr(plugin, "getinfo", {"id": ME}, raising=False)
+    monkeypatch.setattr(plugin, "channels", FakeChannels(), raising=False)
+    monkeypatch.setattr(
+        plugin, "policies", SimpleNamespace(invalidate=lambda scid: None), raising=False
+    )
+    monkeypatch.setattr(plugin, "known_bad", known_bad, raising=False)
+    monkeypatch.setattr(plugin, "erringnodes", 3, raising=False)
+    monkeypatch.setattr(plugin, "log", lambda *args, **kwargs: None)
+
+    excludes, nodes = [], {}
+    node_failure = rebalance.PERM | rebalance.NODE
+    for node, channel, failcode in [
+        (ME, "5x5x5", node_failure),
+        (PEER, "5x5x5", node_failure),
+        (REMOTE, "1x1x1", rebalance.PERM),
+        (REMOTE, "6x6x6", rebalance.PERM),
+        (REMOTE, "7x7x7", node_failure),
+    ]:
+        rebalance.handle_sendpay_error(
+            error(node, channel, failcode),
+            {},
+            "10x10x10",
+            "11x11x11",
+            excludes,
+            nodes,
+            {},
+        )
+
+    assert known_bad.added == ["6x6x6/0", REMOTE]
+    # the erringnodes threshold only excludes for this attempt
+    assert excludes == [REMOTE]